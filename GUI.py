@@ -4,22 +4,54 @@ SoJ Music Player
 import sys
 import os
 import json
-import shutil
 import ctypes
+import multiprocessing
+
+import numpy as np
 
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
                              QHBoxLayout, QPushButton, QLabel, QComboBox,
                              QCheckBox, QProgressBar, QFrame, QSpinBox, QShortcut,
-                             QTextEdit, QListWidget, QFileDialog, QMessageBox)
-from PyQt5.QtCore import Qt, QTimer
-from PyQt5.QtGui import QIcon, QKeySequence, QFont
+                             QListWidget, QFileDialog, QMessageBox)
+from PyQt5.QtCore import Qt, QTimer, QSize
+from PyQt5.QtGui import QIcon, QKeySequence, QFont, QImage, QPixmap
 import Player as GZP
 import SheetMaker as GSM
-from threads import PlaybackThread
-from widgets import NoteVisualization
+import keymaps
+import library
+import midireader
+import sinks
+import clocksync
+import preview
+import diagnostics
+import dryrun
+import engine
+import sections
+import similarity
+import stallmonitor
+import thumbnails
+import timewarp
+from prefs import SongPrefs
+from threads import PlaybackThread, ImportThread, IndexThread, ThumbnailLoader, GAME_WINDOW_TITLE
+from widgets import NoteVisualization, EnsembleDialog, SheetView
 from hotkeys import HotkeyManager
 from themes import get_theme
 
+# Quantize choices: label -> (merge window in seconds, 1/N note grid)
+QUANTIZE_PRESETS = {
+    "Off": (0.0, 0),
+    "5 ms": (0.005, 0),
+    "10 ms": (0.010, 0),
+    "1/32 note": (0.0, 32),
+    "1/64 note": (0.0, 64),
+}
+
+
+def key_label(key_add, suffix=""):
+    if key_add > 0:
+        return f"+{key_add} key{suffix}"
+    return f"{key_add} key{suffix}"
+
 
 def is_admin():
     try:
@@ -41,10 +73,29 @@ class ModernGUI(QMainWindow):
         self.is_playing = False
         self.is_paused = False
         self.key_adds = []
+        self.key_choice = {}
+        self.current_song = None
+        self.tempo_map = None
+        self.song_bpm = 120.0       # the selected song's main tempo
+        self.player_bpm = 120       # playback rate: 120 plays the song as written
+        # Per-song settings for songs that haven't saved their own
+        self.song_defaults = {'bpm': 120, 'quantize': "Off", 'allow_out': False}
+        self.ensemble = None
+        self.sync = None
+        self.sync_host = "127.0.0.1"
+        self.input_rate_limit = dryrun.DEFAULT_RATE_LIMIT
         self.settings_file = "settings.json"
+        self.song_prefs = SongPrefs()
+        self.import_thread = None
+        self.similarity = similarity.SimilarityIndex.load()
+        self.index_thread = None
+        self.index_stale = False
+        self.similar_pending = False
+        self.section_plans = {}
         self.hotkey_manager = HotkeyManager()
         
         self.init_ui()
+        self.create_playback_thread()
         
         self.load_settings()
         self.apply_theme()
@@ -116,27 +167,61 @@ class ModernGUI(QMainWindow):
         self.btn_add_midi = QPushButton("➕ Add MIDI")
         self.btn_add_midi.setFixedSize(110, 30)
         self.btn_add_midi.clicked.connect(self.add_midi_file)
+        self.btn_add_midi.setToolTip("Import MIDI files or zip archives")
         file_header.addWidget(self.btn_add_midi)
         
+        self.btn_add_folder = QPushButton("📁")
+        self.btn_add_folder.setFixedSize(40, 30)
+        self.btn_add_folder.clicked.connect(self.add_midi_folder)
+        self.btn_add_folder.setToolTip("Import a folder of MIDI files")
+        file_header.addWidget(self.btn_add_folder)
+        
         self.btn_refresh = QPushButton("🔄")
         self.btn_refresh.setFixedSize(40, 30)
         self.btn_refresh.clicked.connect(self.refresh_midi_list)
         self.btn_refresh.setToolTip("Refresh MIDI list")
         file_header.addWidget(self.btn_refresh)
         
+        self.btn_similar = QPushButton("🔍")
+        self.btn_similar.setFixedSize(40, 30)
+        self.btn_similar.clicked.connect(self.show_similar)
+        self.btn_similar.setToolTip("Find songs like the selected one, and likely duplicates in the library")
+        file_header.addWidget(self.btn_similar)
+        
         controls_layout.addLayout(file_header)
         
         self.list_midi = QListWidget()
         self.list_midi.setMaximumHeight(150)
+        self.list_midi.setIconSize(QSize(thumbnails.THUMB_WIDTH, thumbnails.THUMB_HEIGHT))
         self.list_midi.itemClicked.connect(self.midi_selected)
         controls_layout.addWidget(self.list_midi)
         
+        # Thumbnails are requested for visible rows only, after scrolling settles
+        self.thumbnail_grids = {}
+        self.thumbnail_loader = ThumbnailLoader()
+        self.thumbnail_loader.ready_signal.connect(self.thumbnail_ready)
+        self.thumbnail_timer = QTimer(self)
+        self.thumbnail_timer.setSingleShot(True)
+        self.thumbnail_timer.setInterval(50)
+        self.thumbnail_timer.timeout.connect(self.request_visible_thumbnails)
+        self.list_midi.verticalScrollBar().valueChanged.connect(self.thumbnail_timer.start)
+        
         settings_layout = QHBoxLayout()
         settings_layout.setSpacing(5)  
         
+        settings_layout.addWidget(QLabel("Layout:"))
+        self.combo_layout = QComboBox()
+        self.combo_layout.addItems(list(keymaps.PROFILES))
+        self.combo_layout.setToolTip("In-game keyboard layout")
+        self.combo_layout.activated.connect(self.layout_changed)
+        settings_layout.addWidget(self.combo_layout)
+        
+        settings_layout.addSpacing(10)
+        
         settings_layout.addWidget(QLabel("Key:"))
         self.combo_key = QComboBox()
         self.combo_key.setEnabled(False)
+        self.combo_key.activated.connect(self.key_changed)
         settings_layout.addWidget(self.combo_key)
         
         self.btn_auto_key = QPushButton("🎯 Auto")
@@ -146,7 +231,7 @@ class ModernGUI(QMainWindow):
         self.btn_auto_key.clicked.connect(self.auto_adjust_key)
         settings_layout.addWidget(self.btn_auto_key)
         
-        settings_layout.addSpacing(400) 
+        settings_layout.addSpacing(250) 
         
         bpm_label = QLabel("BPM:")
         settings_layout.addWidget(bpm_label)
@@ -154,17 +239,30 @@ class ModernGUI(QMainWindow):
         self.spin_bpm.setRange(40, 2000)
         self.spin_bpm.setValue(120)
         self.spin_bpm.setEnabled(False)
+        self.spin_bpm.setToolTip("Tempo in the song's own BPM")
         self.spin_bpm.valueChanged.connect(self.bpm_changed)
         settings_layout.addWidget(self.spin_bpm)
         
         settings_layout.addSpacing(10)
         
+        ramp_label = QLabel("Ramp:")
+        settings_layout.addWidget(ramp_label)
+        self.spin_ramp = QSpinBox()
+        self.spin_ramp.setRange(0, 16)
+        self.spin_ramp.setValue(0)
+        self.spin_ramp.setSuffix(" bars")
+        self.spin_ramp.setToolTip("Bars to ease into a new BPM over while playing (0 = at once)")
+        settings_layout.addWidget(self.spin_ramp)
+        
+        settings_layout.addSpacing(10)
+        
         wait_label = QLabel("Wait:")
         settings_layout.addWidget(wait_label)
         self.spin_wait = QSpinBox()
         self.spin_wait.setRange(0, 20)
         self.spin_wait.setValue(3)
         self.spin_wait.setSuffix("s")
+        self.spin_wait.valueChanged.connect(self.wait_changed)
         settings_layout.addWidget(self.spin_wait)
         
         settings_layout.addStretch()  
@@ -174,7 +272,44 @@ class ModernGUI(QMainWindow):
         options_layout = QHBoxLayout()
         self.check_out_range = QCheckBox("Allow out-of-range notes")
         self.check_out_range.setChecked(False)
+        self.check_out_range.clicked.connect(self.out_range_changed)
         options_layout.addWidget(self.check_out_range)
+        
+        options_layout.addSpacing(20)
+        self.check_sections = QCheckBox("Per-section keys")
+        self.check_sections.setToolTip("Pick a key for each part of the song instead of one for the whole song")
+        self.check_sections.clicked.connect(self.sections_changed)
+        options_layout.addWidget(self.check_sections)
+        
+        options_layout.addSpacing(20)
+        options_layout.addWidget(QLabel("Quantize:"))
+        self.combo_quantize = QComboBox()
+        for label in QUANTIZE_PRESETS:
+            self.combo_quantize.addItem(label)
+        self.combo_quantize.setToolTip("Merge notes played a few milliseconds apart into one chord")
+        self.combo_quantize.activated.connect(self.quantize_changed)
+        options_layout.addWidget(self.combo_quantize)
+        
+        options_layout.addSpacing(20)
+        self.btn_ensemble = QPushButton("👥 Ensemble")
+        self.btn_ensemble.setCheckable(True)
+        self.btn_ensemble.setToolTip("Play the song's tracks into several game windows at once")
+        self.btn_ensemble.clicked.connect(self.ensemble_clicked)
+        options_layout.addWidget(self.btn_ensemble)
+        
+        options_layout.addSpacing(20)
+        options_layout.addWidget(QLabel("Sync:"))
+        self.combo_sync = QComboBox()
+        self.combo_sync.addItems(["Off", "Leader", "Follower"])
+        self.combo_sync.setToolTip("Start and stay in time with other player instances")
+        self.combo_sync.activated.connect(self.sync_changed)
+        options_layout.addWidget(self.combo_sync)
+        
+        options_layout.addSpacing(20)
+        self.check_engine = QCheckBox("Engine process")
+        self.check_engine.setToolTip("Play from a separate high-priority process, so a busy window can't delay notes")
+        self.check_engine.clicked.connect(self.engine_changed)
+        options_layout.addWidget(self.check_engine)
         options_layout.addStretch()
         controls_layout.addLayout(options_layout)
         
@@ -232,16 +367,33 @@ class ModernGUI(QMainWindow):
         self.btn_show_sheet.setEnabled(False)
         sheet_header.addWidget(self.btn_show_sheet)
         
+        self.btn_preview = QPushButton("🎧 Preview")
+        self.btn_preview.setCheckable(True)
+        self.btn_preview.setEnabled(False)
+        self.btn_preview.setToolTip("Listen to the song as it will be played with the current settings")
+        self.btn_preview.clicked.connect(self.preview_clicked)
+        sheet_header.addWidget(self.btn_preview)
+        
+        self.btn_dry_run = QPushButton("🧪 Dry Run")
+        self.btn_dry_run.setEnabled(False)
+        self.btn_dry_run.setToolTip("Check dropped notes, input rate and the highest safe BPM for the current settings")
+        self.btn_dry_run.clicked.connect(self.show_dry_run)
+        sheet_header.addWidget(self.btn_dry_run)
+        
         self.btn_copy_sheet = QPushButton("Copy to Clipboard")
         self.btn_copy_sheet.clicked.connect(self.copy_sheet)
         sheet_header.addWidget(self.btn_copy_sheet)
         
         sheet_layout.addLayout(sheet_header)
         
-        self.text_sheet = QTextEdit()
-        self.text_sheet.setReadOnly(True)
-        self.text_sheet.setMaximumHeight(150)
-        sheet_layout.addWidget(self.text_sheet)
+        self.sheet_view = SheetView()
+        self.sheet_view.setMaximumHeight(150)
+        sheet_layout.addWidget(self.sheet_view)
+        
+        # Follows the player position at frame rate, only while playing
+        self.sheet_timer = QTimer(self)
+        self.sheet_timer.setInterval(33)
+        self.sheet_timer.timeout.connect(self.follow_sheet)
         
         layout.addWidget(sheet_frame)
     
@@ -249,6 +401,45 @@ class ModernGUI(QMainWindow):
         self.label_status = QLabel("Ready")
         layout.addWidget(self.label_status)
         
+        # Wakeups per second per component, toggled with Ctrl+Shift+D
+        self.label_diagnostics = QLabel()
+        self.label_diagnostics.hide()
+        layout.addWidget(self.label_diagnostics)
+        
+        self.diagnostics_timer = QTimer(self)
+        self.diagnostics_timer.setInterval(1000)
+        self.diagnostics_timer.timeout.connect(self.update_diagnostics)
+        
+        # Event loop heartbeat for the stall monitor, stopped while in the background
+        self.stall_monitor = stallmonitor.StallMonitor()
+        self.heartbeat_timer = QTimer(self)
+        self.heartbeat_timer.setInterval(int(self.stall_monitor.heartbeat * 1000))
+        self.heartbeat_timer.timeout.connect(self.heartbeat)
+        QApplication.instance().applicationStateChanged.connect(self.app_state_changed)
+        self.stall_monitor.start()
+        self.heartbeat_timer.start()
+    
+    def create_playback_thread(self):
+        self.playThread = engine.EngineClient() if self.check_engine.isChecked() else PlaybackThread()
+        self.playThread.bpm = self.player_bpm
+        self.playThread.start_delay = self.spin_wait.value()
+        self.playThread.progress_signal.connect(self.update_progress)
+        self.playThread.started_signal.connect(self.playback_started)
+        self.playThread.paused_signal.connect(self.playback_paused)
+        self.playThread.note_played_signal.connect(self.note_viz.add_note)
+        self.playThread.finished_signal.connect(self.playback_finished)
+        self.playThread.error_signal.connect(self.playback_error)
+        self.playThread.start()
+        
+    def engine_changed(self):
+        """Move playback between a thread in this process and an engine process"""
+        self.playThread.shutdown()
+        self.create_playback_thread()
+        if self.sync:
+            # Re-bind the sync callbacks to the new engine
+            self.sync_changed()
+        self.arm_playback()
+    
     def setup_shortcuts(self):
         QShortcut(QKeySequence("Space"), self, self.shortcut_play_pause)
         QShortcut(QKeySequence("Ctrl+P"), self, self.shortcut_play_pause)
@@ -256,6 +447,7 @@ class ModernGUI(QMainWindow):
         QShortcut(QKeySequence("S"), self, self.stop_clicked)
         QShortcut(QKeySequence("Esc"), self, self.stop_clicked)
         QShortcut(QKeySequence("Ctrl+S"), self, self.stop_clicked)
+        QShortcut(QKeySequence("Ctrl+Shift+D"), self, self.toggle_diagnostics)
     
     def setup_global_hotkeys(self):
         success = self.hotkey_manager.register(
@@ -274,6 +466,10 @@ class ModernGUI(QMainWindow):
             self.play_clicked()
     
     def global_play_pause(self):
+        # Runs on the hotkey hook thread: an armed song starts and a playing
+        # one pauses right here, the GUI catches up through its signals
+        if self.playThread.toggle(source='hotkey'):
+            return
         QTimer.singleShot(0, self._do_play_pause)
     
     def _do_play_pause(self):
@@ -291,6 +487,7 @@ class ModernGUI(QMainWindow):
             traceback.print_exc()
     
     def global_stop(self):
+        self.playThread.stop()
         QTimer.singleShot(0, self._do_stop)
     
     def _do_stop(self):
@@ -302,12 +499,41 @@ class ModernGUI(QMainWindow):
             import traceback
             traceback.print_exc()
     
+    def sync_changed(self):
+        """Switch between standalone, sync leader and sync follower"""
+        if self.sync:
+            self.sync.close()
+            self.sync = None
+        self.playThread.sync_leader = None
+        
+        role = self.combo_sync.currentText()
+        try:
+            if role == "Leader":
+                self.sync = clocksync.SyncLeader(self.sync_host)
+                self.playThread.sync_leader = self.sync
+            elif role == "Follower":
+                self.sync = clocksync.SyncFollower(
+                    self.sync_host,
+                    on_start=lambda start_at: self.playThread.fire(start_at),
+                    on_stop=self.playThread.stop,
+                    on_error=self.playThread.slew,
+                    position_source=self.playThread.position
+                )
+        except OSError as e:
+            self.combo_sync.setCurrentIndex(0)
+            self.label_status.setText(f"❌ Sync unavailable: {e}")
+            return
+        
+        if role != "Off":
+            self.label_status.setText(f"🔗 Sync: {role} on {self.sync_host}:{clocksync.DEFAULT_PORT}")
+    
     # ==================== Theme ====================
     
     def toggle_dark_mode(self):
         self.dark_mode = not self.dark_mode
         self.apply_theme()
         self.dark_mode_btn.setText("🌙 Dark" if not self.dark_mode else "☀️ Light")
+        self.retint_thumbnails()
     
     def apply_theme(self):
         """Apply current theme"""
@@ -320,49 +546,181 @@ class ModernGUI(QMainWindow):
         midi_files = GZP.midScanner()
         if midi_files:
             self.list_midi.addItems(midi_files)
+            self.load_library_index()
+            self.retint_thumbnails()
+            self.thumbnail_timer.start()
+            self.update_similarity_index()
         else:
             self.list_midi.addItem("No MIDI files found")
         
         if hasattr(self, 'label_status'):
             self.label_status.setText("✓ MIDI list refreshed")
     
+    def load_library_index(self):
+        """Reuse import-time analysis: cached hashes, pitches and tooltips"""
+        index = library.load_index()
+        library.seed_hash_cache(index, GZP.midiPath)
+        
+        by_file = {}
+        for entry in index.values():
+            GZP.seedPitches(entry['file'], entry['stamp'], entry['pitches'])
+            by_file[entry['file']] = entry
+        
+        for row in range(self.list_midi.count()):
+            item = self.list_midi.item(row)
+            entry = by_file.get(item.text())
+            if entry:
+                minutes, seconds = divmod(int(entry['duration']), 60)
+                item.setToolTip(f"{minutes}:{seconds:02d} · best key {entry['best_key']:+d} · "
+                                f"{entry['out']} notes out ({entry['profile']})")
+    
+    def request_visible_thumbnails(self):
+        """Queue thumbnails for the rows on screen that don't have one yet"""
+        viewport = self.list_midi.viewport().rect()
+        top = self.list_midi.indexAt(viewport.topLeft()).row()
+        bottom = self.list_midi.indexAt(viewport.bottomLeft()).row()
+        if top < 0:
+            return
+        if bottom < 0:
+            bottom = self.list_midi.count() - 1
+        
+        for row in range(top, bottom + 1):
+            name = self.list_midi.item(row).text()
+            if name not in self.thumbnail_grids and name != "No MIDI files found":
+                self.thumbnail_loader.request(name, GZP.midiPath(name))
+    
+    def thumbnail_icon(self, grid):
+        """Tint an intensity grid with the theme's note colour"""
+        height, width = grid.shape
+        color = (100, 200, 255) if self.dark_mode else (40, 110, 200)
+        pixels = np.zeros((height, width, 4), dtype=np.uint8)
+        pixels[..., 0], pixels[..., 1], pixels[..., 2] = color[2], color[1], color[0]
+        pixels[..., 3] = grid
+        image = QImage(pixels.data, width, height, width * 4, QImage.Format_ARGB32)
+        return QIcon(QPixmap.fromImage(image.copy()))
+    
+    def retint_thumbnails(self):
+        for row in range(self.list_midi.count()):
+            item = self.list_midi.item(row)
+            if item.text() in self.thumbnail_grids:
+                item.setIcon(self.thumbnail_icon(self.thumbnail_grids[item.text()]))
+    
+    def thumbnail_ready(self, name, grid):
+        self.thumbnail_grids[name] = grid
+        items = self.list_midi.findItems(name, Qt.MatchExactly)
+        if items:
+            items[0].setIcon(self.thumbnail_icon(grid))
+    
+    def update_similarity_index(self):
+        """Extract features of new library files in the background"""
+        if self.index_thread and self.index_thread.isRunning():
+            self.index_stale = True
+            return
+        
+        self.index_thread = IndexThread(self.similarity, "." + os.sep + "midi_repo")
+        self.index_thread.finished_signal.connect(self.similarity_indexed)
+        self.index_thread.error_signal.connect(self.similarity_error)
+        self.index_thread.start()
+    
+    def similarity_indexed(self, extracted):
+        if extracted:
+            print(f"[DEBUG] Similarity index: {extracted} songs analysed, {len(self.similarity)} indexed")
+        if self.index_stale:
+            self.index_stale = False
+            self.update_similarity_index()
+        elif self.similar_pending:
+            self.similar_pending = False
+            self.show_similar()
+    
+    def similarity_error(self, error_msg):
+        self.similar_pending = False
+        self.label_status.setText(f"❌ Similarity index failed: {error_msg}")
+    
+    def show_similar(self):
+        """Songs like the selected one, and near-duplicates across the library"""
+        if self.index_thread and self.index_thread.isRunning():
+            self.similar_pending = True
+            self.label_status.setText("⏳ Indexing library...")
+            return
+        
+        lines = []
+        item = self.list_midi.currentItem()
+        if item:
+            matches = self.similarity.similar(item.text())
+            if matches:
+                lines.append(f"Songs like {item.text()}:")
+                for name, score in matches:
+                    duplicate = "  (likely duplicate)" if score >= similarity.DUPLICATE_THRESHOLD else ""
+                    lines.append(f"    {score:.0%}  {name}{duplicate}")
+                lines.append("")
+        
+        pairs = self.similarity.duplicates()
+        lines.append(f"Likely duplicates in the library: {len(pairs)} pairs")
+        for first, second, score in pairs[:10]:
+            lines.append(f"    {score:.0%}  {first}  ↔  {second}")
+        
+        self.label_status.setText(f"✓ {len(self.similarity)} songs indexed, {len(pairs)} likely duplicate pairs")
+        QMessageBox.information(self, "Similar Songs", "\n".join(lines))
+    
     def add_midi_file(self):
-        file_path, _ = QFileDialog.getOpenFileName(
-            self, "Select MIDI File", "", "MIDI Files (*.mid *.midi);;All Files (*.*)"
+        file_paths, _ = QFileDialog.getOpenFileNames(
+            self, "Select MIDI Files", "", "MIDI Files (*.mid *.midi *.zip);;All Files (*.*)"
         )
+        if file_paths:
+            self.start_import(file_paths)
+    
+    def add_midi_folder(self):
+        folder = QFileDialog.getExistingDirectory(self, "Select MIDI Folder")
+        if folder:
+            self.start_import([folder])
+    
+    def start_import(self, paths):
+        """Import in the background; songs already in the library are skipped by content"""
+        if self.import_thread and self.import_thread.isRunning():
+            return
         
-        if file_path:
-            try:
-                file_name = os.path.basename(file_path)
-                midi_repo = "." + os.sep + "midi_repo"
-                
-                if not os.path.exists(midi_repo):
-                    os.makedirs(midi_repo)
-                
-                dest_path = os.path.join(midi_repo, file_name)
-                
-                if os.path.exists(dest_path):
-                    reply = QMessageBox.question(
-                        self, "File Exists",
-                        f"'{file_name}' already exists. Overwrite?",
-                        QMessageBox.Yes | QMessageBox.No
-                    )
-                    if reply == QMessageBox.No:
-                        return
-                
-                shutil.copy2(file_path, dest_path)
-                self.refresh_midi_list()
-                
-                items = self.list_midi.findItems(file_name, Qt.MatchExactly)
-                if items:
-                    self.list_midi.setCurrentItem(items[0])
-                    self.midi_selected(items[0])
-                
-                self.label_status.setText(f"✓ Added: {file_name}")
-                
-            except Exception as e:
-                QMessageBox.critical(self, "Error", f"Failed to add MIDI file:\n{str(e)}")
-                self.label_status.setText("❌ Failed to add MIDI file")
+        self.btn_add_midi.setEnabled(False)
+        self.btn_add_folder.setEnabled(False)
+        self.label_status.setText("⏳ Importing...")
+        
+        self.import_thread = ImportThread(paths, "." + os.sep + "midi_repo", self.combo_layout.currentText())
+        self.import_thread.progress_signal.connect(self.import_progress)
+        self.import_thread.finished_signal.connect(self.import_finished)
+        self.import_thread.error_signal.connect(self.import_error)
+        self.import_thread.start()
+    
+    def import_progress(self, done, total):
+        self.label_status.setText(f"⏳ Importing... {done}/{total}")
+    
+    def import_finished(self, summary):
+        # Stay disabled if a song started playing meanwhile
+        playing = not self.btn_refresh.isEnabled()
+        self.btn_add_midi.setEnabled(not playing)
+        self.btn_add_folder.setEnabled(not playing)
+        if playing:
+            return
+        self.refresh_midi_list()
+        
+        imported = summary['imported']
+        for name, error in summary['invalid']:
+            print(f"❌ Not a valid MIDI file: {name} ({error})")
+        
+        if len(imported) == 1:
+            items = self.list_midi.findItems(imported[0], Qt.MatchExactly)
+            if items:
+                self.list_midi.setCurrentItem(items[0])
+                self.midi_selected(items[0])
+        
+        self.label_status.setText(f"✓ Added {len(imported)}, "
+                                  f"{len(summary['duplicates'])} already in library, "
+                                  f"{len(summary['invalid'])} invalid")
+    
+    def import_error(self, error_msg):
+        playing = not self.btn_refresh.isEnabled()
+        self.btn_add_midi.setEnabled(not playing)
+        self.btn_add_folder.setEnabled(not playing)
+        QMessageBox.critical(self, "Error", f"Failed to import MIDI files:\n{error_msg}")
+        self.label_status.setText("❌ Failed to import MIDI files")
     
     def midi_selected(self, item=None):
         try:
@@ -370,65 +728,29 @@ class ModernGUI(QMainWindow):
                 item = self.list_midi.currentItem()
             
             if not item or item.text() == "No MIDI files found":
+                # Disarm the previous song
+                self.playThread.stop()
+                self.current_song = None
                 self.combo_key.setEnabled(False)
                 self.spin_bpm.setEnabled(False)
                 self.btn_play.setEnabled(False)
                 self.btn_show_sheet.setEnabled(False)
                 self.btn_auto_key.setEnabled(False)
+                self.stop_preview()
+                self.btn_preview.setEnabled(False)
+                self.btn_dry_run.setEnabled(False)
                 self.label_status.setText("Ready")
                 return
             
             file_name = item.text()
             print(f"[DEBUG] Selected MIDI: {file_name}")
             
-            self.combo_key.clear()
-            self.key_adds.clear()
-            
-            avail_keys = GZP.allToCMajor(file_name)
-            print(f"[DEBUG] Available keys: {avail_keys}")
-            
-            if not avail_keys and not self.check_out_range.isChecked():
-                best_key = GZP.findBestKey(file_name)
-                out_notes = GZP.getOutOfRangeNotes(file_name, best_key)
-                
-                self.label_status.setText(
-                    f"⚠️ MIDI out of range! Best key: {best_key:+d} ({len(out_notes)} notes still out). "
-                    f"Enable 'Allow out-of-range' or click 'Auto' button."
-                )
-                
-                if best_key > 0:
-                    self.combo_key.addItem(f"+{best_key} key (Auto)")
-                else:
-                    self.combo_key.addItem(f"{best_key} key (Auto)")
-                self.key_adds.append(best_key)
-                
-                self.combo_key.setEnabled(True)
-                self.btn_auto_key.setEnabled(True)
-                self.btn_play.setEnabled(False)
-                self.btn_show_sheet.setEnabled(False)
-                return
-            
-            if not avail_keys:
-                avail_keys = [0]
-            
-            for i in avail_keys:
-                if i > 0:
-                    self.combo_key.addItem(f"+{i} key")
-                else:
-                    self.combo_key.addItem(f"{i} key")
-                self.key_adds.append(i)
-            
-            self.combo_key.setEnabled(True)
-            self.spin_bpm.setEnabled(True)
-            self.btn_play.setEnabled(True)
-            self.btn_show_sheet.setEnabled(True)
-            self.btn_auto_key.setEnabled(True)
-            
-            out_notes = GZP.getOutOfRangeNotes(file_name, self.key_adds[0])
-            if out_notes:
-                self.label_status.setText(f"⚠️ Warning: {len(out_notes)} notes out of range")
-            else:
-                self.label_status.setText(f"✓ Selected: {file_name}")
+            self.current_song = library.content_hash(GZP.midiPath(file_name))
+            self.load_tempo_map(file_name)
+            self.ensemble = None
+            self.btn_ensemble.setChecked(False)
+            self.restore_song_settings(self.song_prefs.get(self.current_song))
+            self.load_key_choices(file_name)
                 
         except Exception as e:
             print(f"❌ ERROR in midi_selected: {e}")
@@ -436,77 +758,317 @@ class ModernGUI(QMainWindow):
             traceback.print_exc()
             self.label_status.setText(f"❌ Error loading MIDI: {str(e)}")
     
-    def auto_adjust_key(self):
-        current_item = self.list_midi.currentItem()
-        if not current_item:
-            return
+    def restore_song_settings(self, saved):
+        """Apply a song's saved layout, BPM, out-of-range and quantize choices"""
+        if 'layout' in saved:
+            layout_index = self.combo_layout.findText(saved['layout'])
+            if layout_index >= 0:
+                self.combo_layout.setCurrentIndex(layout_index)
         
-        file_name = current_item.text()
-        best_key = GZP.findBestKey(file_name)
-        out_notes = GZP.getOutOfRangeNotes(file_name, best_key)
+        # Anything this song hasn't saved comes from the defaults, not the previous song
+        quantize_index = self.combo_quantize.findText(saved.get('quantize', self.song_defaults['quantize']))
+        if quantize_index >= 0:
+            self.combo_quantize.setCurrentIndex(quantize_index)
         
-        self.check_out_range.setChecked(True)
+        self.check_out_range.setChecked(saved.get('allow_out', self.song_defaults['allow_out']))
         
-        self.combo_key.clear()
-        self.key_adds.clear()
+        self.check_sections.setChecked(saved.get('sections', False))
         
-        if best_key > 0:
-            self.combo_key.addItem(f"+{best_key} key (Auto-adjusted)")
-        else:
-            self.combo_key.addItem(f"{best_key} key (Auto-adjusted)")
-        self.key_adds.append(best_key)
+        self.set_player_bpm(saved.get('bpm', self.song_defaults['bpm']))
+    
+    def remember_song(self, **values):
+        """Save settings for the selected song (written behind in batches)"""
+        if self.current_song:
+            self.song_prefs.update(self.current_song, **values)
+    
+    def remember_key_choice(self):
+        fits = dict(self.song_prefs.get(self.current_song).get('fits', {}))
+        fits[self.combo_layout.currentText()] = dict(self.key_choice)
+        self.remember_song(fits=fits)
+    
+    def load_key_choices(self, file_name, reanalyse=False):
+        """Show the song's key choices for the current layout
+
+        The analysed choices are saved per layout, so selecting a song again
+        restores them directly instead of re-running the key analysis.
+        """
+        self.playThread.stop()
         
-        self.btn_play.setEnabled(True)
-        self.btn_show_sheet.setEnabled(True)
-        self.spin_bpm.setEnabled(True)
+        profile = self.combo_layout.currentText()
+        fits = self.song_prefs.get(self.current_song).get('fits', {})
+        choice = None if reanalyse else fits.get(profile)
         
+        if choice is None:
+            choice = self.analyse_keys(file_name, profile)
+            self.key_choice = choice
+            self.remember_key_choice()
+        
+        self.apply_key_choice(choice)
+    
+    def analyse_keys(self, file_name, profile):
+        """Work out the transposition choices for a song (the slow path)"""
+        avail_keys = GZP.allToCMajor(file_name, profile)
+        print(f"[DEBUG] Available keys: {avail_keys}")
+        
+        if not avail_keys and not self.check_out_range.isChecked():
+            best_key = GZP.findBestKey(file_name, profile)
+            out_notes = GZP.getOutOfRangeNotes(file_name, best_key, profile)
+            
+            return {
+                'keys': [best_key],
+                'labels': [key_label(best_key, " (Auto)")],
+                'index': 0,
+                'playable': False,
+                'status': f"⚠️ MIDI out of range! Best key: {best_key:+d} ({len(out_notes)} notes still out). "
+                          f"Enable 'Allow out-of-range' or click 'Auto' button.",
+            }
+        
+        if not avail_keys:
+            avail_keys = [0]
+        
+        out_notes = GZP.getOutOfRangeNotes(file_name, avail_keys[0], profile)
         if out_notes:
-            self.label_status.setText(
-                f"🎯 Auto-adjusted to {best_key:+d} key. {len(out_notes)} notes will be skipped. Ready to play!"
-            )
+            status = f"⚠️ Warning: {len(out_notes)} notes out of range"
         else:
-            self.label_status.setText(
-                f"✓ Auto-adjusted to {best_key:+d} key. Perfect fit! Ready to play!"
-            )
-    
-    # ==================== Playback Control ====================
+            status = f"✓ Selected: {file_name}"
+        
+        return {
+            'keys': avail_keys,
+            'labels': [key_label(i) for i in avail_keys],
+            'index': 0,
+            'playable': True,
+            'status': status,
+        }
     
-    def play_clicked(self):
-        """Start or resume playback"""
-        if self.is_paused:
-            self.playThread.resume()
-            self.is_paused = False
+    def apply_key_choice(self, choice):
+        self.key_choice = dict(choice)
+        self.key_adds = list(choice['keys'])
+        
+        self.combo_key.clear()
+        self.combo_key.addItems(choice['labels'])
+        self.combo_key.setCurrentIndex(choice['index'])
+        self.btn_auto_key.setEnabled(True)
+        
+        # A key plan overrides the single key
+        plan = self.key_plan(self.list_midi.currentItem().text())
+        self.combo_key.setEnabled(not plan)
+        
+        if choice['playable'] or plan:
+            self.spin_bpm.setEnabled(True)
+            self.btn_play.setEnabled(True)
+            self.btn_show_sheet.setEnabled(True)
+            self.btn_preview.setEnabled(True)
+            self.btn_dry_run.setEnabled(True)
+        else:
             self.btn_play.setEnabled(False)
-            self.btn_pause.setEnabled(True)
-            self.label_status.setText("▶ Playing...")
-            return
+            self.btn_show_sheet.setEnabled(False)
+            self.stop_preview()
+            self.btn_preview.setEnabled(False)
+            self.btn_dry_run.setEnabled(False)
+        
+        if plan:
+            dropped = self.section_plans[(self.current_song, self.combo_layout.currentText())][1]
+            self.label_status.setText(f"🎼 Per-section keys: {len(plan) - 1} key changes, {dropped} notes skipped")
+        else:
+            self.label_status.setText(choice['status'])
+        self.arm_playback()
+    
+    def layout_changed(self):
+        """Re-fit the selected song; fits are cached per (song, layout)"""
+        current_item = self.list_midi.currentItem()
+        if current_item and self.current_song:
+            self.remember_song(layout=self.combo_layout.currentText())
+            if self.ensemble and keymaps.get_profile(self.combo_layout.currentText()).uses_modifiers:
+                self.ensemble = None
+                self.btn_ensemble.setChecked(False)
+            self.load_key_choices(current_item.text())
+    
+    def key_changed(self, index):
+        if self.current_song:
+            self.key_choice['index'] = index
+            self.remember_key_choice()
+        self.arm_playback()
+    
+    def out_range_changed(self):
+        current_item = self.list_midi.currentItem()
+        if current_item and self.current_song:
+            self.remember_song(allow_out=self.check_out_range.isChecked())
+            self.load_key_choices(current_item.text(), reanalyse=True)
+    
+    def sections_changed(self):
+        current_item = self.list_midi.currentItem()
+        if current_item and self.current_song:
+            self.remember_song(sections=self.check_sections.isChecked())
+            self.load_key_choices(current_item.text())
+    
+    def key_plan(self, file_name):
+        """Per-section key plan for the song and layout, cached; None when off"""
+        if not self.check_sections.isChecked():
+            return None
         
-        wait_time = self.spin_wait.value()
-        if wait_time > 0:
-            self.label_status.setText(f"⏳ Starting in {wait_time}s...")
-            QTimer.singleShot(wait_time * 1000, self.start_playback)
+        cache_key = (self.current_song, self.combo_layout.currentText())
+        if cache_key not in self.section_plans:
+            self.section_plans[cache_key] = sections.plan_sections(GZP.midiPath(file_name),
+                                                                   self.combo_layout.currentText())
+        return self.section_plans[cache_key][0]
+    
+    def quantize_changed(self):
+        if self.current_song:
+            self.remember_song(quantize=self.combo_quantize.currentText())
         else:
-            self.start_playback()
+            self.song_defaults['quantize'] = self.combo_quantize.currentText()
+        self.arm_playback()
     
-    def start_playback(self):
-        """Actually start playback"""
+    def ensemble_clicked(self, checked):
+        """Turn ensemble play on (choosing parts) or back off"""
+        self.ensemble = None
+        current_item = self.list_midi.currentItem()
+        
+        if checked and current_item and self.current_song:
+            if keymaps.get_profile(self.combo_layout.currentText()).uses_modifiers:
+                # Posted key messages carry no Shift, so sharps would play as naturals
+                QMessageBox.information(self, "Ensemble", "Ensemble play needs a layout without "
+                                        "modifier keys, e.g. 21 keys.")
+                windows = None
+            else:
+                windows = sinks.find_windows(GAME_WINDOW_TITLE)
+                if not windows:
+                    QMessageBox.information(self, "Ensemble", "No game windows found.")
+            if windows:
+                track_counts = midireader.track_note_counts(GZP.midiPath(current_item.text()))
+                dialog = EnsembleDialog(track_counts, len(windows), parent=self)
+                if dialog.exec_() == EnsembleDialog.Accepted:
+                    self.ensemble = (windows, dialog.assignment())
+        
+        self.btn_ensemble.setChecked(self.ensemble is not None)
+        if self.ensemble:
+            self.label_status.setText(f"👥 Ensemble: {len(self.ensemble[0])} windows")
+        self.arm_playback()
+    
+    def auto_adjust_key(self):
         current_item = self.list_midi.currentItem()
         if not current_item:
-            self.label_status.setText("❌ No MIDI file selected")
             return
         
         file_name = current_item.text()
+        profile = self.combo_layout.currentText()
+        best_key = GZP.findBestKey(file_name, profile)
+        out_notes = GZP.getOutOfRangeNotes(file_name, best_key, profile)
+        
+        self.check_out_range.setChecked(True)
+        
+        if out_notes:
+            status = f"🎯 Auto-adjusted to {best_key:+d} key. {len(out_notes)} notes will be skipped. Ready to play!"
+        else:
+            status = f"✓ Auto-adjusted to {best_key:+d} key. Perfect fit! Ready to play!"
+        
+        self.key_choice = {
+            'keys': [best_key],
+            'labels': [key_label(best_key, " (Auto-adjusted)")],
+            'index': 0,
+            'playable': True,
+            'status': status,
+        }
+        self.remember_song(allow_out=True)
+        self.remember_key_choice()
+        self.apply_key_choice(self.key_choice)
+    
+    # ==================== Playback Control ====================
+    
+    def playback_settings(self):
+        """(file name, key, allow out-of-range, layout, MidiPlayer options) for the selected song"""
+        file_name = self.list_midi.currentItem().text()
         key_add = self.key_adds[self.combo_key.currentIndex()]
-        bpm = self.spin_bpm.value()
         allow_out = self.check_out_range.isChecked()
+        profile = self.combo_layout.currentText()
+        window, division = QUANTIZE_PRESETS[self.combo_quantize.currentText()]
         
-        self.playThread = PlaybackThread(file_name, key_add, bpm, allow_out)
-        self.playThread.progress_signal.connect(self.update_progress)
-        self.playThread.note_played_signal.connect(self.note_viz.add_note)
-        self.playThread.finished_signal.connect(self.playback_finished)
-        self.playThread.error_signal.connect(self.playback_error)
+        options = {'quantize_window': window, 'quantize_division': division}
+        plan = self.key_plan(file_name)
+        if plan:
+            options['key_plan'] = plan
+        if self.ensemble:
+            windows, track_parts = self.ensemble
+            options['sinks'] = [sinks.WindowSink(hwnd) for hwnd in windows]
+            options['track_parts'] = track_parts
+        return file_name, key_add, allow_out, profile, options
+    
+    def arm_playback(self):
+        """Prepare the selected song so the next Play/hotkey starts instantly"""
+        current_item = self.list_midi.currentItem()
+        if self.is_playing or not current_item or not self.key_adds or not self.btn_play.isEnabled():
+            return
         
-        self.playThread.start()
+        file_name, key_add, allow_out, profile, options = self.playback_settings()
+        self.playThread.arm(file_name, key_add, allow_out, profile, **options)
+        
+        # Keep an open preview in step with the settings, for quick A/B
+        if self.btn_preview.isChecked():
+            self.start_preview()
+    
+    def preview_clicked(self, checked):
+        if checked:
+            self.start_preview()
+        else:
+            self.stop_preview()
+    
+    def start_preview(self):
+        """Render (or reuse) the preview for the current settings and play it"""
+        try:
+            file_name, key_add, allow_out, profile, options = self.playback_settings()
+            path = preview.render_preview(file_name, self.player_bpm, key_add, allow_out,
+                                          profile, **options)
+        except Exception as e:
+            self.stop_preview()
+            self.label_status.setText(f"❌ Preview failed: {str(e)}")
+            return
+        
+        if preview.play(path):
+            self.label_status.setText(f"🎧 Previewing {key_label(key_add)}")
+        else:
+            self.btn_preview.setChecked(False)
+            self.label_status.setText(f"✓ Preview saved to {path}")
+    
+    def stop_preview(self):
+        self.btn_preview.setChecked(False)
+        preview.stop()
+    
+    def show_dry_run(self):
+        """Report whether the game will keep up with the song at the current settings"""
+        bpm = self.player_bpm
+        try:
+            file_name, key_add, allow_out, profile, options = self.playback_settings()
+            report = dryrun.analyse(GZP.midiPath(file_name), bpm, options.get('key_plan') or [(0.0, key_add)],
+                                    profile, options.get('track_parts'), options['quantize_window'],
+                                    options['quantize_division'], self.input_rate_limit)
+        except Exception as e:
+            self.label_status.setText(f"❌ Dry run failed: {str(e)}")
+            return
+        
+        safe = report['max_safe_bpm']
+        lines = dryrun.format_report(report, bpm, self.song_bpm)
+        if safe is None or safe < bpm:
+            self.label_status.setText(f"⚠ Too fast for the game at {self.spin_bpm.value()} BPM")
+            QMessageBox.warning(self, "Dry Run", "\n".join(lines))
+        else:
+            self.label_status.setText(f"✓ Dry run: safe up to {round(safe * self.song_bpm / 120)} BPM")
+            QMessageBox.information(self, "Dry Run", "\n".join(lines))
+    
+    def play_clicked(self):
+        """Start or resume playback"""
+        if self.is_paused:
+            self.playThread.resume()
+            return
+        
+        if not self.playThread.fire():
+            self.label_status.setText("⏳ Song is still being prepared, try again")
+    
+    def playback_started(self, delay):
+        """Update the UI once the worker has released the armed song"""
+        self.stop_preview()
+        print(f"[DEBUG] Start latency: {self.playThread.start_latency * 1000:.2f} ms")
+        if isinstance(self.sync, clocksync.SyncFollower) and self.sync.offset is not None:
+            print(f"[DEBUG] Sync offset {self.sync.offset * 1000:+.3f} ms, rtt {self.sync.rtt * 1000:.3f} ms")
         
         self.is_playing = True
         self.is_paused = False
@@ -514,33 +1076,69 @@ class ModernGUI(QMainWindow):
         self.btn_pause.setEnabled(True)
         self.btn_stop.setEnabled(True)
         self.list_midi.setEnabled(False)
+        self.combo_layout.setEnabled(False)
+        self.combo_quantize.setEnabled(False)
+        self.btn_ensemble.setEnabled(False)
+        self.check_engine.setEnabled(False)
         self.combo_key.setEnabled(False)
         self.spin_wait.setEnabled(False)
         self.btn_add_midi.setEnabled(False)
+        self.btn_add_folder.setEnabled(False)
         self.btn_refresh.setEnabled(False)
-        self.label_status.setText("▶ Playing...")
+        self.btn_preview.setEnabled(False)
+        self.btn_dry_run.setEnabled(False)
+        
+        if self.sheet_view.texts:
+            self.sheet_timer.start()
+        
+        if delay > 0:
+            self.label_status.setText(f"⏳ Starting in {delay:g}s...")
+            QTimer.singleShot(int(delay * 1000), self._countdown_done)
+        else:
+            self.label_status.setText("▶ Playing...")
+    
+    def _countdown_done(self):
+        if self.is_playing and not self.is_paused:
+            self.label_status.setText("▶ Playing...")
     
     def pause_clicked(self):
+        # The player applies the command and reports back through paused_signal
         if self.playThread and self.is_playing:
             if self.is_paused:
                 self.playThread.resume()
-                self.is_paused = False
-                self.btn_pause.setText("⏸ Pause\n(Ctrl+V)")
-                self.label_status.setText("▶ Playing...")
             else:
                 self.playThread.pause()
-                self.is_paused = True
-                self.btn_pause.setText("▶ Resume\n(Ctrl+V)")
-                self.btn_play.setEnabled(True)
-                self.label_status.setText("⏸ Paused")
+    
+    def playback_paused(self, paused):
+        """Update the UI once a pause or resume has taken effect"""
+        stats = self.playThread.command_stats()
+        print(f"[DEBUG] Command latency: {stats['latency_last'] * 1000:.2f} ms")
+        if not self.is_playing:
+            return
+        self.is_paused = paused
+        if paused:
+            self.sheet_timer.stop()
+            self.btn_pause.setText("▶ Resume\n(Ctrl+V)")
+            self.btn_play.setEnabled(True)
+            self.label_status.setText("⏸ Paused")
+        else:
+            self.btn_pause.setText("⏸ Pause\n(Ctrl+V)")
+            self.btn_play.setEnabled(False)
+            self.btn_pause.setEnabled(True)
+            self.label_status.setText("▶ Playing...")
+            if self.sheet_view.texts:
+                self.sheet_timer.start()
     
     def stop_clicked(self):
         """Stop playback"""
-        if self.playThread:
-            self.playThread.stop()
-        self.playback_finished()
+        self.playThread.stop()
+        if self.is_playing:
+            # The worker reports back through finished_signal
+            return
+        self.arm_playback()
     
-    def playback_finished(self):
+    def playback_finished(self, rearm=True):
+        self.sheet_timer.stop()
         self.is_playing = False
         self.is_paused = False
         self.btn_play.setEnabled(True)
@@ -549,16 +1147,26 @@ class ModernGUI(QMainWindow):
         self.btn_pause.setText("⏸ Pause\n(Ctrl+V)")
         self.btn_stop.setEnabled(False)
         self.list_midi.setEnabled(True)
-        self.combo_key.setEnabled(True)
+        self.combo_layout.setEnabled(True)
+        self.combo_quantize.setEnabled(True)
+        self.btn_ensemble.setEnabled(True)
+        self.check_engine.setEnabled(True)
+        self.combo_key.setEnabled(not self.check_sections.isChecked())
         self.spin_wait.setEnabled(True)
         self.btn_add_midi.setEnabled(True)
+        self.btn_add_folder.setEnabled(True)
         self.btn_refresh.setEnabled(True)
+        self.btn_preview.setEnabled(self.btn_show_sheet.isEnabled())
+        self.btn_dry_run.setEnabled(self.btn_show_sheet.isEnabled())
         self.progress_bar.setValue(0)
         self.label_time.setText("00:00 / 00:00")
         self.label_status.setText("✓ Playback finished")
+        
+        if rearm:
+            self.arm_playback()
     
     def playback_error(self, error_msg):
-        self.playback_finished()
+        self.playback_finished(rearm=False)
         self.label_status.setText(f"❌ Error: {error_msg}")
     
     def update_progress(self, current, total):
@@ -568,11 +1176,50 @@ class ModernGUI(QMainWindow):
             
             current_str = f"{int(current // 60):02d}:{int(current % 60):02d}"
             total_str = f"{int(total // 60):02d}:{int(total % 60):02d}"
-            self.label_time.setText(f"{current_str} / {total_str}")
+            if self.tempo_map:
+                # The tempo actually heard here, from the file's own tempo at this point
+                heard = self.tempo_map.bpm_at(current) * self.playThread.current_bpm() / 120
+                self.label_time.setText(f"{current_str} / {total_str}  ♩ {heard:.0f}")
+            else:
+                self.label_time.setText(f"{current_str} / {total_str}")
+    
+    def load_tempo_map(self, file_name):
+        """Read the song's tempo map so BPMs are shown in its own tempo"""
+        try:
+            self.tempo_map = timewarp.tempo_map(GZP.midiPath(file_name))
+            self.song_bpm = self.tempo_map.main_bpm()
+        except Exception as e:
+            print(f"❌ Error reading tempo map: {e}")
+            self.tempo_map = None
+            self.song_bpm = 120.0
+        self.show_bpm()
+    
+    def show_bpm(self):
+        """Show the playback rate as song BPM without changing it"""
+        scale = self.song_bpm / 120
+        self.spin_bpm.blockSignals(True)
+        self.spin_bpm.setRange(max(1, round(40 * scale)), round(2000 * scale))
+        self.spin_bpm.setValue(round(self.player_bpm * scale))
+        self.spin_bpm.blockSignals(False)
+    
+    def set_player_bpm(self, bpm):
+        self.player_bpm = bpm
+        self.show_bpm()
+        self.playThread.set_bpm(bpm)
     
     def bpm_changed(self, value):
-        if self.playThread and self.is_playing:
-            self.playThread.set_bpm(value)
+        bpm = value * 120 / self.song_bpm
+        over = 0.0
+        bars = self.spin_ramp.value()
+        position = self.playThread.position() if bars and self.tempo_map else None
+        if position is not None:
+            over = self.tempo_map.bars(position, bars)
+        self.player_bpm = bpm
+        self.playThread.set_bpm(bpm, over=over)
+        self.remember_song(bpm=bpm)
+    
+    def wait_changed(self, value):
+        self.playThread.start_delay = value
     
     # ==================== Sheet Music ====================
     
@@ -584,16 +1231,55 @@ class ModernGUI(QMainWindow):
         file_name = current_item.text()
         key_add = self.key_adds[self.combo_key.currentIndex()]
         
-        sheet = GSM.printMidiSheet(file_name, key_add)
-        self.text_sheet.clear()
-        for notes in sheet:
-            self.text_sheet.append(str(notes))
+        sheet = GSM.buildMidiSheet(file_name, key_add, self.combo_layout.currentText(), self.key_plan(file_name))
+        self.sheet_view.set_bars(sheet)
         
         self.label_status.setText("✓ Sheet generated")
     
+    def follow_sheet(self):
+        diagnostics.wakeup("sheet")
+        position = self.playThread.position()
+        if position is not None:
+            self.sheet_view.set_position(position)
+    
+    def toggle_diagnostics(self):
+        if self.diagnostics_timer.isActive():
+            self.diagnostics_timer.stop()
+            self.label_diagnostics.hide()
+        else:
+            diagnostics.rates()
+            self.label_diagnostics.setText("Measuring wakeups...")
+            self.label_diagnostics.show()
+            self.diagnostics_timer.start()
+    
+    def update_diagnostics(self):
+        diagnostics.wakeup("diagnostics")
+        text = "Wakeups: " + (diagnostics.format_rates(diagnostics.rates()) or "none")
+        if isinstance(self.playThread, engine.EngineClient):
+            status = self.playThread.status()
+            text += (f"\nEngine: late max {status.late_max * 1000:.2f} ms, mean {status.late_mean * 1000:.2f} ms"
+                     f" · underruns {status.underruns}"
+                     f" · held {status.held.rstrip(bytes(1)).decode('ascii', 'replace') or '-'}")
+        stats = self.playThread.command_stats()
+        text += (f"\nCommands: last {stats['latency_last'] * 1000:.2f} ms, max {stats['latency_max'] * 1000:.2f} ms"
+                 f" · debounced {stats['debounced']}")
+        text += "\n" + self.stall_monitor.format_recent()
+        self.label_diagnostics.setText(text)
+    
+    def heartbeat(self):
+        diagnostics.wakeup("heartbeat")
+        self.stall_monitor.beat()
+    
+    def app_state_changed(self, state):
+        if state == Qt.ApplicationActive:
+            self.stall_monitor.resume()
+            self.heartbeat_timer.start()
+        else:
+            self.heartbeat_timer.stop()
+            self.stall_monitor.pause()
+    
     def copy_sheet(self):
-        self.text_sheet.selectAll()
-        self.text_sheet.copy()
+        QApplication.clipboard().setText(self.sheet_view.text())
         self.label_status.setText("✓ Copied to clipboard")
     
     # ==================== Settings ====================
@@ -604,9 +1290,31 @@ class ModernGUI(QMainWindow):
                 with open(self.settings_file, 'r') as f:
                     settings = json.load(f)
                     self.dark_mode = settings.get('dark_mode', True)
-                    self.spin_bpm.setValue(settings.get('bpm', 120))
+                    self.song_defaults['bpm'] = settings.get('bpm', 120)
+                    self.set_player_bpm(self.song_defaults['bpm'])
+                    self.spin_ramp.setValue(settings.get('ramp_bars', 0))
                     self.spin_wait.setValue(settings.get('wait_time', 3))
                     
+                    layout_index = self.combo_layout.findText(settings.get('layout', ''))
+                    if layout_index >= 0:
+                        self.combo_layout.setCurrentIndex(layout_index)
+                    
+                    quantize_index = self.combo_quantize.findText(settings.get('quantize', ''))
+                    if quantize_index >= 0:
+                        self.combo_quantize.setCurrentIndex(quantize_index)
+                        self.song_defaults['quantize'] = settings['quantize']
+                    
+                    if settings.get('engine_process', False):
+                        self.check_engine.setChecked(True)
+                        self.engine_changed()
+                    
+                    self.sync_host = settings.get('sync_host', self.sync_host)
+                    self.input_rate_limit = settings.get('input_rate_limit', self.input_rate_limit)
+                    sync_index = self.combo_sync.findText(settings.get('sync', ''))
+                    if sync_index > 0:
+                        self.combo_sync.setCurrentIndex(sync_index)
+                        self.sync_changed()
+                    
                     if 'geometry' in settings:
                         self.restoreGeometry(bytes.fromhex(settings['geometry']))
         except:
@@ -615,8 +1323,15 @@ class ModernGUI(QMainWindow):
     def save_settings(self):
         settings = {
             'dark_mode': self.dark_mode,
-            'bpm': self.spin_bpm.value(),
+            'bpm': self.song_defaults['bpm'],
+            'ramp_bars': self.spin_ramp.value(),
             'wait_time': self.spin_wait.value(),
+            'layout': self.combo_layout.currentText(),
+            'quantize': self.song_defaults['quantize'],
+            'sync': self.combo_sync.currentText(),
+            'sync_host': self.sync_host,
+            'engine_process': self.check_engine.isChecked(),
+            'input_rate_limit': self.input_rate_limit,
             'geometry': self.saveGeometry().toHex().data().decode()
         }
         
@@ -626,16 +1341,31 @@ class ModernGUI(QMainWindow):
         except:
             pass
     
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.thumbnail_timer.start()
+    
     def closeEvent(self, event):
+        self.stop_preview()
+        self.thumbnail_loader.shutdown()
+        if self.index_thread:
+            self.index_thread.wait()
         self.save_settings()
+        self.song_prefs.flush()
+        if self.sync:
+            self.sync.close()
         self.hotkey_manager.unregister()
         
         if self.playThread:
-            self.playThread.stop()
+            self.playThread.shutdown()
+        self.heartbeat_timer.stop()
+        self.stall_monitor.stop()
         event.accept()
 
 
 if __name__ == "__main__":
+    # Library import uses a process pool, which needs this in frozen builds
+    multiprocessing.freeze_support()
     try:
         app = QApplication(sys.argv)
         app.setApplicationName("Nishuihan Music Player")
@@ -1,86 +1,108 @@
-import mido
 import os
 import time
-import ctypes
-from ctypes import wintypes
-
-# Key Map between midi file and Keyboard
-KEY_MAP = {60:'z',62:'x',64:'c',65:'v',67:'b',69:'n',71:'m',72:'a',74:'s',76:'d',77:'f',79:'g',81:'h',83:'j',84:'q',86:'w',88:'e',89:'r',91:'t',93:'y',95:'u',0:'p'}
+import bisect
+import collections
+import threading
+import clocks
+import compiler
+import diagnostics
+import keymaps
+import midireader
+import sinks as output_sinks
+import timewarp
 
 SCALES = ["C","C#","D","D#","E","F","F#","G","G#","A","A#","B"]
 
+MIDI_EXTENSIONS = ('.mid', '.midi')
+
+# Transpositions tried when fitting a song to a layout
+KEY_SHIFTS = range(-48, 48)
+
+# Analysis caches: pitches per song, and fit per (song, layout)
+_pitch_cache = {}
+_fit_cache = {}
+
+def midiPath(m_file_name):
+    return "." + os.sep + "midi_repo" + os.sep + m_file_name
+
 # Scan midi file in mid_repo folder
 def midScanner():
     m_file = os.listdir("."+os.sep+"midi_repo")
     ret = []
     for i in m_file:
-        if os.path.splitext(i)[1] == '.mid':
+        if os.path.splitext(i)[1].lower() in MIDI_EXTENSIONS:
             ret.append(i)
     return ret
 
 # Translate midi note to keyboard
-def noteTrans(m_note_value):
-    return KEY_MAP.get(m_note_value, None)
+def noteTrans(m_note_value, profile=None):
+    chord = keymaps.get_profile(profile).chord(m_note_value)
+    return keymaps.get_profile(profile).label(chord) if chord else None
 
 # Check if note is in range
-def isNoteInRange(note):
-    return note in KEY_MAP
+def isNoteInRange(note, profile=None):
+    return keymaps.get_profile(profile).in_range(note)
 
-# Player only support melody in C Major, Use this to translate other scale to C Major
-def allToCMajor(m_file_name):
-    file_name = "." + os.sep + "midi_repo" + os.sep + m_file_name
-    note_temp = []
-    avialiable_add = []
+# Distinct pitches of a song, parsed once and cached until the file changes
+def songPitches(m_file_name):
+    file_name = midiPath(m_file_name)
+    stat = os.stat(file_name)
+    stamp = (stat.st_mtime_ns, stat.st_size)
     
-    try:
-        for msg in mido.MidiFile(file_name):
-            if msg.type == "note_on":
-                if msg.note not in note_temp:
-                    note_temp.append(msg.note)
-    except Exception as e:
-        print(f"Error reading MIDI: {e}")
-        return []
+    cached = _pitch_cache.get(file_name)
+    if cached and cached[0] == stamp:
+        return cached[1]
+    
+    pitches = set()
+    for track in midireader.MidiArrays(file_name, kinds=('note_on',)).tracks:
+        pitches.update(track['data1'].tolist())
+    
+    pitches = frozenset(pitches)
+    _pitch_cache[file_name] = (stamp, pitches)
+    return pitches
 
-    for i in range(-48, 48):
-        isC = True
-        for cur in note_temp:
-            if not KEY_MAP.__contains__(int(cur)+i):
-                isC = False
-                break
-        if isC:
-            avialiable_add.append(i)
-    
-    return avialiable_add
+# Reuse pitches analysed elsewhere (e.g. at import) while the file is unchanged
+def seedPitches(m_file_name, stamp, pitches):
+    _pitch_cache[midiPath(m_file_name)] = (tuple(stamp), frozenset(pitches))
 
-# Auto-adjust to best key when out of range
-def findBestKey(m_file_name):
-    """Find the key transposition that minimizes out-of-range notes"""
-    file_name = "." + os.sep + "midi_repo" + os.sep + m_file_name
-    note_temp = []
+# Out-of-range pitch count for every transposition of a pitch set
+def pitchFit(pitches, profile=None):
+    profile = keymaps.get_profile(profile)
+    fit = {}
+    for i in KEY_SHIFTS:
+        fit[i] = sum(1 for cur in pitches if not profile.in_range(cur + i))
+    return fit
+
+# Out-of-range pitch count for every transposition, cached per (song, layout)
+def songFit(m_file_name, profile=None):
+    profile = keymaps.get_profile(profile)
+    pitches = songPitches(m_file_name)
     
+    key = (m_file_name, pitches, profile.name)
+    fit = _fit_cache.get(key)
+    if fit is None:
+        fit = _fit_cache[key] = pitchFit(pitches, profile)
+    return fit
+
+# Player only support melody in C Major, Use this to translate other scale to C Major
+def allToCMajor(m_file_name, profile=None):
     try:
-        for msg in mido.MidiFile(file_name):
-            if msg.type == "note_on":
-                if msg.note not in note_temp:
-                    note_temp.append(msg.note)
+        fit = songFit(m_file_name, profile)
     except Exception as e:
         print(f"Error reading MIDI: {e}")
-        return 0
+        return []
     
+    return [i for i in KEY_SHIFTS if fit[i] == 0]
+
+# Pick the best transposition from a fit table
+def bestKeyForFit(fit, pitch_count):
     best_key = 0
     best_score = float('inf')  # Lower is better
     
     # Try all possible transpositions
-    for i in range(-48, 48):
-        out_of_range_count = 0
-        in_range_count = 0
-        
-        for cur in note_temp:
-            transposed = int(cur) + i
-            if KEY_MAP.__contains__(transposed):
-                in_range_count += 1
-            else:
-                out_of_range_count += 1
+    for i in KEY_SHIFTS:
+        out_of_range_count = fit[i]
+        in_range_count = pitch_count - out_of_range_count
         
         # Score: prioritize more in-range notes and penalize out-of-range
         # Also prefer transpositions closer to 0 (less pitch change)
@@ -92,177 +114,547 @@ def findBestKey(m_file_name):
     
     return best_key
 
-# Check out of range notes
-def getOutOfRangeNotes(m_file_name, m_key_add):
-    file_name = "." + os.sep + "midi_repo" + os.sep + m_file_name
-    out_of_range = []
+# Auto-adjust to best key when out of range
+def findBestKey(m_file_name, profile=None):
+    """Find the key transposition that minimizes out-of-range notes"""
+    try:
+        pitches = songPitches(m_file_name)
+        fit = songFit(m_file_name, profile)
+    except Exception as e:
+        print(f"Error reading MIDI: {e}")
+        return 0
     
+    return bestKeyForFit(fit, len(pitches))
+
+# Check out of range notes
+def getOutOfRangeNotes(m_file_name, m_key_add, profile=None):
+    profile = keymaps.get_profile(profile)
     try:
-        for msg in mido.MidiFile(file_name):
-            if msg.type == "note_on":
-                note = int(msg.note) + m_key_add
-                if note not in KEY_MAP:
-                    out_of_range.append(note)
+        pitches = songPitches(m_file_name)
     except Exception as e:
         print(f"Error checking range: {e}")
+        return []
     
-    return list(set(out_of_range))
+    return [cur + m_key_add for cur in pitches if not profile.in_range(cur + m_key_add)]
+
+# Fastest anchor correction: wall seconds shifted per second of playback
+SLEW_RATE = 0.05
+
+# Pipelined decoding: groups buffered ahead of the timing loop at most, song
+# seconds decoded before a pipelined player reports itself ready, and groups
+# handed over per lock
+RING_SIZE = 2048
+PREBUFFER_SECONDS = 3.0
+DECODE_BATCH = 32
 
 # Get total MIDI duration
 def getMidiDuration(m_file_name):
-    file_name = "." + os.sep + "midi_repo" + os.sep + m_file_name
+    file_name = midiPath(m_file_name)
     try:
-        midi = mido.MidiFile(file_name)
-        return midi.length
+        return midireader.midi_length(file_name)
     except:
         return 0
 
-# SendInput related definitions
-PUL = ctypes.POINTER(ctypes.c_ulong)
-
-class KeyBdInput(ctypes.Structure):
-    _fields_ = [("wVk", ctypes.c_ushort),
-                ("wScan", ctypes.c_ushort),
-                ("dwFlags", ctypes.c_ulong),
-                ("time", ctypes.c_ulong),
-                ("dwExtraInfo", PUL)]
-
-class HardwareInput(ctypes.Structure):
-    _fields_ = [("uMsg", ctypes.c_ulong),
-                ("wParamL", ctypes.c_short),
-                ("wParamH", ctypes.c_ushort)]
-
-class MouseInput(ctypes.Structure):
-    _fields_ = [("dx", ctypes.c_long),
-                ("dy", ctypes.c_long),
-                ("mouseData", ctypes.c_ulong),
-                ("dwFlags", ctypes.c_ulong),
-                ("time",ctypes.c_ulong),
-                ("dwExtraInfo", PUL)]
-
-class Input_I(ctypes.Union):
-    _fields_ = [("ki", KeyBdInput),
-                ("mi", MouseInput),
-                ("hi", HardwareInput)]
-
-class Input(ctypes.Structure):
-    _fields_ = [("type", ctypes.c_ulong),
-                ("ii", Input_I)]
-
-
 class MidiPlayer:
-    """Enhanced MIDI player with pause/resume and real-time BPM control"""
+    """Enhanced MIDI player with pause/resume and real-time BPM control
+
+    All control methods are thread-safe: they update state under a condition
+    variable and wake the timing loop, so pause, resume, stop and seek take
+    effect immediately instead of at the next polling interval.
+    
+    Output goes to one or more sinks. By default every track is played into
+    the focused window; for ensemble play `track_parts` maps track indexes to
+    indexes in `sinks` (unlisted tracks are muted), and all parts share the
+    one compiled timeline and timing loop.
+    
+    Time comes from `clock` (clocks.RealClock by default). With a
+    clocks.VirtualClock play() runs without sleeping, which together with a
+    RecordingSink renders a song's output in a fraction of its length.
+    
+    With `pipelined=True` the song is not compiled up front: a decoder thread
+    streams compiled groups into a ring of at most RING_SIZE groups, blocking
+    while it is full, and play() consumes from it. wait_prebuffered() returns
+    once the first few seconds are ready, so the time to get ready no longer
+    depends on the file size. If the decoder ever falls behind the song
+    clock, the clock is held until it catches up and `underruns` is counted.
+    `events` stays empty in this mode.
+    
+    `key_plan`, a list of (song_seconds, key_add) from sections.plan_sections,
+    replaces `key_add` with a shift per section of the song.
+    
+    With a commandbus.CommandBus as `bus`, play() drains and applies the
+    commands posted to it (pause, resume, toggle, seek, bpm) as soon as they
+    wake the timing loop, and reports when each took effect. Posting only
+    sets an event; a relay thread takes _cond to wake the loop, so hotkey,
+    GUI and pipe threads never wait for it.
     
-    def __init__(self, file_name, bpm, key_add, allow_out_range=False):
-        self.file_name = "." + os.sep + "midi_repo" + os.sep + file_name
+    Songs are compiled by compiler.compile_groups, which caches every stage,
+    so re-creating a player with only a different key or quantise setting
+    redoes just the stages that depend on it.
+    """
+    
+    def __init__(self, file_name, bpm, key_add, allow_out_range=False, profile=None,
+                 quantize_window=0.0, quantize_division=0, sinks=None, track_parts=None,
+                 clock=None, pipelined=False, key_plan=None, bus=None):
+        self.file_name = midiPath(file_name)
         self.bpm = bpm
         self.key_add = key_add
         self.allow_out_range = allow_out_range
+        self.profile = keymaps.get_profile(profile)
+        self.quantize_window = quantize_window
+        self.quantize_division = quantize_division
+        self.sinks = sinks or [output_sinks.SendInputSink()]
+        if self.profile.uses_modifiers and not all(getattr(sink, 'supports_modifiers', True) for sink in self.sinks):
+            raise ValueError(f"The {self.profile.name} layout needs modifier keys, "
+                             f"which can't be sent to background windows")
+        self.track_parts = track_parts
+        self.key_plan = key_plan
+        self.bus = bus
+        self.clock = clock or clocks.RealClock()
         self.is_paused = False
         self.should_stop = False
         self.pressed_keys = set()
         self.current_time = 0
         self.total_time = 0
+        self.events = []
+        self.stats = {'dropped': 0}
+        self.pipelined = pipelined
+        self.underruns = 0
+        
+        # How late groups went out, wall seconds after their due time
+        self.late_max = 0.0
+        self.late_total = 0.0
+        self.groups_played = 0
+        
+        # Timing state, guarded by _cond
+        self._cond = threading.Condition()
+        self._seek_to = None
+        self._anchor = 0.0      # clock time at which song time _origin sounds
+        self._origin = 0.0
+        self._warp = timewarp.TimeWarp(0.0, bpm)   # song time -> wall time after _anchor
+        self._slew = 0.0        # anchor correction still to apply, wall seconds
+        self._slew_at = 0.0
+        self._posted = threading.Event()    # set by the bus, relayed to _cond
+        self._relaying = False
         
-        # Windows API setup
-        self.SendInput = ctypes.windll.user32.SendInput
-        self.MapVirtualKey = ctypes.windll.user32.MapVirtualKeyW
+        # Groups waiting to be played, also guarded by _cond
+        self._ring = collections.deque()
+        self._decoded_until = 0.0
+        self._decode_done = False
+        self._decoder = 0           # generation of the decoder thread feeding _ring
+        self._starved = False       # timing loop waits for the decoder
+        self._producer_waiting = False
+        self.decode_error = None
         
-        # Load MIDI
+        # Compile through the staged compiler, reusing whatever it has cached
         try:
-            self.midi = mido.MidiFile(self.file_name)
-            self.total_time = self.midi.length
+            if pipelined:
+                self._start_decoder(0.0)
+            else:
+                self.events = list(self._pipeline(self.stats))
+                self.total_time = self.stats['length']
+                self._decoded_until = self.total_time
+                self._decode_done = True
         except Exception as e:
             raise Exception(f"Failed to load MIDI: {e}")
     
-    def send_key(self, key, is_press):
-        """Send keyboard input using SendInput"""
-        if key is None:
-            return
+    @property
+    def redundant_events(self):
+        return self.stats['dropped']
+    
+    def _pipeline(self, stats):
+        """Compiled (song_time, actions) groups, streamed; see compiler.py"""
+        return compiler.compile_groups(self.file_name, self.key_plan or [(0.0, self.key_add)],
+                                       self.profile, self.track_parts, self.quantize_window,
+                                       self.quantize_division, stats, streaming=self.pipelined)
+    
+    # ==================== Pipelined decoding ====================
+    
+    def _start_decoder(self, start):
+        """Refill the ring from song time `start` on a new decoder thread (caller holds _cond or is __init__)"""
+        self._decoder += 1
+        self._ring.clear()
+        self._decoded_until = start
+        self._decode_done = False
+        thread = threading.Thread(target=self._decode, args=(self._decoder, start), daemon=True)
+        thread.start()
+    
+    def _decode(self, generation, start):
+        try:
+            stats = {'dropped': 0}
+            groups = self._pipeline(stats)
+            if 'length' in stats:
+                # Compiled from cached stages: the length is already known
+                with self._cond:
+                    self.total_time = max(self.total_time, stats['length'])
+            batch = []
+            for group in groups:
+                if group[0] < start:
+                    continue
+                batch.append(group)
+                if len(batch) >= DECODE_BATCH:
+                    if not self._push(generation, batch):
+                        return
+                    batch = []
+            if batch and not self._push(generation, batch):
+                return
             
-        vk_code = ord(key.upper())
-        scan_code = self.MapVirtualKey(vk_code, 0)
-        extra = ctypes.c_ulong(0)
-        ii_ = Input_I()
+            with self._cond:
+                if self._decoder == generation:
+                    self.stats = stats
+                    self.total_time = max(self.total_time, stats['length'])
+                    self._decoded_until = self.total_time
+                    self._decode_done = True
+                    self._cond.notify_all()
+        except Exception as e:
+            with self._cond:
+                self.decode_error = e
+                self._decode_done = True
+                self._cond.notify_all()
+    
+    def _push(self, generation, batch):
+        """Append decoded groups to the ring, waiting for room; False if cancelled"""
+        with self._cond:
+            # Backpressure: wait for the timing loop to make room
+            while (len(self._ring) >= RING_SIZE and self._decoder == generation
+                   and not self.should_stop):
+                self._producer_waiting = True
+                self._cond.wait()
+            if self._decoder != generation or self.should_stop:
+                return False
+            self._ring.extend(batch)
+            self._decoded_until = batch[-1][0]
+            woke = self._starved
+            if woke:
+                self._cond.notify_all()
+        if woke:
+            # Hand the GIL over so the waiting thread runs now, not after
+            # this thread's switch interval
+            time.sleep(0)
+        return True
+    
+    def _measure(self):
+        """Find the song length for progress display while decoding runs"""
+        try:
+            length = midireader.midi_length(self.file_name)
+        except Exception:
+            return
+        with self._cond:
+            self.total_time = max(self.total_time, length)
+    
+    def wait_prebuffered(self, seconds=PREBUFFER_SECONDS):
+        """Block until `seconds` of song are decoded (or decoding has ended)"""
+        with self._cond:
+            self._starved = True
+            self._cond.wait_for(lambda: self._decode_done or self.should_stop or
+                                self._decoded_until >= seconds or len(self._ring) >= RING_SIZE)
+            self._starved = False
+            if self.decode_error:
+                raise Exception(f"Failed to load MIDI: {self.decode_error}")
+            measure = not self._decode_done and not self.total_time
         
-        flags = 0 if is_press else 0x0002
-        ii_.ki = KeyBdInput(vk_code, scan_code, flags, 0, ctypes.pointer(extra))
-        x = Input(ctypes.c_ulong(1), ii_)
-        self.SendInput(1, ctypes.pointer(x), ctypes.sizeof(x))
+        # Only now, so the length scan doesn't slow the prebuffering down
+        if measure:
+            threading.Thread(target=self._measure, daemon=True).start()
+    
+    def send_keys(self, actions, part=0):
+        """Send a batch of (chord, is_press) actions to one part's sink"""
+        if actions:
+            self.sinks[part].write(actions)
+    
+    def send_key(self, chord, is_press, part=0):
+        """Send keyboard input through the part's sink"""
+        if chord is None:
+            return
+        self.send_keys([(chord, is_press)], part)
+    
+    def release_all(self):
+        """Release every key still held down, on every sink"""
+        for part in range(len(self.sinks)):
+            self.send_keys([(chord, False) for held_part, chord in self.pressed_keys if held_part == part], part)
+        self.pressed_keys.clear()
+    
+    def _song_position(self, now):
+        """Song time reached at clock time `now` (caller holds _cond)"""
+        return self._warp.song(now - self._anchor)
+    
+    def _wall_until(self, song_time, now):
+        """Clock seconds from `now` until `song_time` sounds (caller holds _cond)"""
+        return self._warp.wall(song_time) - (now - self._anchor)
+    
+    def _rebase(self, origin, now=None):
+        """Count song time from `origin`, at clock time `now` if given (caller holds _cond)"""
+        self._origin = origin
+        self._warp.rebase(origin)
+        if now is not None:
+            self._anchor = now
+    
+    def position(self, now=None):
+        """Song position at clock time `now` (default: now)"""
+        with self._cond:
+            if self.is_paused:
+                return self._origin
+            return self._song_position(self.clock.now() if now is None else now)
+    
+    def slew(self, error):
+        """Correct a drift of `error` song seconds ahead of a reference clock
+
+        The correction is spread out at SLEW_RATE instead of jumping, so
+        followers in a group never skip or bunch up notes.
+        """
+        with self._cond:
+            now = self.clock.now()
+            self._slew = error * 120 / self._warp.bpm_at(self._song_position(now))
+            self._slew_at = now
+            self._cond.notify_all()
+    
+    def _apply_slew(self, now):
+        """Move the anchor towards the pending correction (caller holds _cond)"""
+        limit = SLEW_RATE * (now - self._slew_at)
+        step = max(-limit, min(limit, self._slew))
+        self._anchor += step
+        self._slew -= step
+        self._slew_at = now
     
     def pause(self):
         """Pause playback"""
-        self.is_paused = True
+        with self._cond:
+            self.is_paused = True
+            self._cond.notify_all()
     
     def resume(self):
         """Resume playback"""
-        self.is_paused = False
+        with self._cond:
+            self.is_paused = False
+            self._cond.notify_all()
     
     def stop(self):
-        """Stop playback"""
-        self.should_stop = True
-        # Release all pressed keys
-        for key in list(self.pressed_keys):
-            self.send_key(key, False)
-        self.pressed_keys.clear()
+        """Stop playback
+
+        Keys are released by the playback thread itself when it leaves the
+        timing loop, so no key can be left held by a half-finished SendInput.
+        """
+        with self._cond:
+            self.should_stop = True
+            self._cond.notify_all()
     
-    def set_bpm(self, new_bpm):
-        """Change BPM in real-time"""
-        self.bpm = max(40, min(2000, new_bpm))
+    def seek(self, seconds):
+        """Jump to a position in song seconds"""
+        with self._cond:
+            self._seek_to = max(0.0, min(float(seconds), self.total_time))
+            self._cond.notify_all()
     
-    def play(self, progress_callback=None, note_callback=None):
-        """Play MIDI with callbacks for progress and note visualization"""
-        real_time = float(120 / self.bpm)
-        
-        for msg in self.midi:
-            # Check for stop
-            if self.should_stop:
-                break
-            
-            # Handle pause
-            while self.is_paused and not self.should_stop:
-                time.sleep(0.01)
+    def set_bpm(self, new_bpm, over=0.0):
+        """Change BPM in real-time, ramping to it over `over` song seconds"""
+        with self._cond:
+            if not self.is_paused:
+                now = self.clock.now()
+                self._rebase(self._song_position(now), now)
+            self.bpm = max(40, min(2000, new_bpm))
+            self._warp.ramp(self._origin, self.bpm, over)
+            self._cond.notify_all()
+    
+    def current_bpm(self, now=None):
+        """BPM at clock time `now`, part way through a ramp if one is running"""
+        with self._cond:
+            if self.is_paused:
+                return self._warp.bpm_at(self._origin)
+            return self._warp.bpm_at(self._song_position(self.clock.now() if now is None else now))
+    
+    def _relay(self):
+        """Wake the timing loop for every post to the bus, on its own thread"""
+        while True:
+            self._posted.wait()
+            self._posted.clear()
+            with self._cond:
+                if not self._relaying:
+                    return
+                self._cond.notify_all()
+    
+    def _woken(self):
+        """Whether the timing loop has something to do (caller holds _cond)"""
+        return (not self.is_paused or self.should_stop or self._seek_to is not None or
+                bool(self.bus))
+    
+    def _apply_commands(self):
+        """Apply everything posted to the bus, returning each pause state it went through (caller holds _cond)"""
+        changes = []
+        for command in self.bus.drain():
+            name, args = command.name, command.args
+            if name == 'toggle':
+                name = 'resume' if self.is_paused else 'pause'
             
-            # Update BPM dynamically
-            real_time = float(120 / self.bpm)
+            was_paused = self.is_paused
+            if name == 'pause' and not self.is_paused:
+                # Freeze the position now, not when the loop gets to the pause
+                now = self.clock.now()
+                self._rebase(self._song_position(now), now)
+                self.is_paused = True
+            elif name == 'resume':
+                self.is_paused = False
+            elif name == 'seek':
+                self.seek(*args)
+            elif name == 'bpm':
+                self.set_bpm(*args)
+            self.bus.done(command)
             
-            # Handle timing
-            if msg.time > 0:
-                time.sleep(float(msg.time) * real_time)
-                self.current_time += msg.time
+            if self.is_paused != was_paused:
+                changes.append(self.is_paused)
+        return changes
+    
+    def _restart_at(self, seconds):
+        """Refill the ring from `seconds` on (caller holds _cond)"""
+        if self.pipelined:
+            self._start_decoder(seconds)
+        else:
+            times = [event[0] for event in self.events]
+            self._ring = collections.deque(self.events[bisect.bisect_left(times, seconds):])
+    
+    def play(self, progress_callback=None, note_callback=None, start_at=None,
+             pause_callback=None):
+        """Play MIDI with callbacks for progress and note visualization
+
+        Every wait is an absolute deadline on the condition variable, so the
+        loop sleeps without polling and control calls wake it at once.
+        `start_at` is the clock time at which song time zero sounds; it
+        defaults to now. `pause_callback(paused)` is called when a command
+        from the bus pauses or resumes the song. Keys are released and
+        callbacks called with _cond released, so the loop never holds it
+        across SendInput or a slot.
+        """
+        ring = self._ring
+        
+        with self._cond:
+            if not self.pipelined:
+                ring = self._ring = collections.deque(self.events)
+            self._rebase(0.0, self.clock.now() if start_at is None else start_at)
+        
+        relay = None
+        if self.bus is not None:
+            # Commands posted before this song started aren't meant for it
+            self.bus.drain()
+            self._relaying = True
+            relay = threading.Thread(target=self._relay, name="CommandRelay", daemon=True)
+            relay.start()
+            self.bus.attach(self._posted.set)
+        
+        changes = []
+        release = seeked = False
+        try:
+            while True:
+                # Work the last pass left for outside the lock
+                if release:
+                    release = False
+                    self.release_all()
+                if pause_callback:
+                    for paused in changes:
+                        pause_callback(paused)
+                changes = []
+                if seeked:
+                    seeked = False
+                    if progress_callback:
+                        progress_callback(self.current_time, self.total_time)
                 
-                if progress_callback:
-                    progress_callback(self.current_time, self.total_time)
-            
-            # Handle note on
-            if msg.type == "note_on" and msg.velocity > 0:
-                note = int(msg.note) + self.key_add
+                with self._cond:
+                    diagnostics.wakeup("player")
+                    if self.should_stop:
+                        break
+                    
+                    if self.bus:
+                        changes = self._apply_commands()
+                    
+                    # Release held keys before a seek or pause and report pauses
+                    # outside the lock, then come back
+                    release = (self._seek_to is not None or self.is_paused) and bool(self.pressed_keys)
+                    if release or changes:
+                        continue
+                    
+                    if self._seek_to is not None:
+                        self.current_time = self._seek_to
+                        self._rebase(self._seek_to, self.clock.now())
+                        self._restart_at(self._seek_to)
+                        ring = self._ring
+                        self._seek_to = None
+                        seeked = True
+                        continue
+                    
+                    # Handle pause: block until resumed, stopped or seeked
+                    if self.is_paused:
+                        self._rebase(self._song_position(self.clock.now()))
+                        self._cond.wait_for(self._woken)
+                        self._anchor = self.clock.now()
+                        continue
+                    
+                    if not ring:
+                        if self._decode_done:
+                            break
+                        self._starved = True
+                        remaining = self._wall_until(self._decoded_until, self.clock.now())
+                        if remaining > 0:
+                            # Nothing decoded before _decoded_until: sleep up to it
+                            self.clock.wait(self._cond, remaining)
+                        else:
+                            # Underrun: hold the song clock until the decoder catches up
+                            self.underruns += 1
+                            held_at = self.clock.now()
+                            self._cond.wait_for(lambda: ring or self._decode_done or self.should_stop or
+                                                self.is_paused or self._seek_to is not None or
+                                                bool(self.bus))
+                            self._anchor += self.clock.now() - held_at
+                        self._starved = False
+                        continue
+                    
+                    if self._slew:
+                        self._apply_slew(self.clock.now())
+                    
+                    song_time, actions = ring[0]
+                    remaining = self._wall_until(song_time, self.clock.now())
+                    if remaining > 0:
+                        # Wake up regularly while a correction is being slewed in
+                        self.clock.wait(self._cond, min(remaining, 0.05) if self._slew else remaining)
+                        continue
+                    
+                    ring.popleft()
+                    self.late_max = max(self.late_max, -remaining)
+                    self.late_total -= remaining
+                    self.groups_played += 1
+                    if self._producer_waiting and len(ring) <= RING_SIZE // 2:
+                        self._producer_waiting = False
+                        self._cond.notify_all()
                 
-                # Skip out of range notes if not allowed
-                if not self.allow_out_range and note not in KEY_MAP:
-                    continue
+                if song_time > self.current_time:
+                    self.current_time = song_time
+                    if progress_callback:
+                        progress_callback(self.current_time, self.total_time)
                 
-                key = noteTrans(note)
-                if key:
-                    self.send_key(key, True)
-                    self.pressed_keys.add(key)
-                    
-                    if note_callback:
-                        note_callback(key)
-            
-            # Handle note off
-            elif (msg.type == "note_off") or (msg.type == "note_on" and msg.velocity == 0):
-                note = int(msg.note) + self.key_add
-                key = noteTrans(note)
+                # One output call per sink for the whole group
+                batches = {}
+                for part, is_press, chord in actions:
+                    if is_press:
+                        batches.setdefault(part, []).append((chord, True))
+                        self.pressed_keys.add((part, chord))
+                    elif (part, chord) in self.pressed_keys:
+                        batches.setdefault(part, []).append((chord, False))
+                        self.pressed_keys.remove((part, chord))
+                for part, batch in batches.items():
+                    self.send_keys(batch, part)
                 
-                if key and key in self.pressed_keys:
-                    self.send_key(key, False)
-                    self.pressed_keys.remove(key)
-        
-        # Release any remaining keys
-        for key in list(self.pressed_keys):
-            self.send_key(key, False)
-        self.pressed_keys.clear()
+                if note_callback:
+                    for part, is_press, chord in actions:
+                        if is_press:
+                            note_callback(chord[1])
+        finally:
+            if relay is not None:
+                self.bus.attach(None)
+                with self._cond:
+                    self._relaying = False
+                self._posted.set()
+                relay.join()
+            # Release any remaining keys
+            self.release_all()
+            if pause_callback:
+                for paused in changes:
+                    pause_callback(paused)
 
 
 def counter(m_second):
@@ -1,44 +1,58 @@
 # Transfer midi file to Keyboard sheet
 import Player as GZP
-import os
+import midireader
+import sections
 
-def printMidiSheet(m_file_name, m_key_add):
-    """Generate sheet music notation from MIDI file"""
+# Song seconds per sheet bar
+BAR_SECONDS = 2
+
+def buildMidiSheet(m_file_name, m_key_add, profile=None, key_plan=None):
+    """Generate sheet bars as (start_time, text) pairs, in song seconds
+
+    With a key plan (see sections.py) each note uses its section's shift.
+    """
     # init
     ret = []
     cur = "1 "
+    cur_start = 0
     cur_time = 0
     cur_bar = 1
-    
+    last_time = 0
+
     # Add Path
-    file_name = "." + os.sep + "midi_repo" + os.sep + m_file_name
-    
+    file_name = GZP.midiPath(m_file_name)
+
     # Read midi_file
     try:
-        midi_file = GZP.mido.MidiFile(file_name)
+        stream = midireader.MidiStream(file_name, kinds=midireader.NOTE_KINDS)
+
+        # Show info
+        for song_time, tick, kind, track, channel, note, velocity in stream:
+            cur_time = cur_time + song_time - last_time
+            last_time = song_time
+            if cur_time >= BAR_SECONDS:
+                ret.append((cur_start, cur))
+                cur_bar = cur_bar + 1
+                cur = str(cur_bar) + " "
+                cur_start = song_time
+                cur_time = 0
+
+            if kind == "note_on":
+                key_add = sections.shift_at(key_plan, song_time) if key_plan else int(m_key_add)
+                key = GZP.noteTrans(note + key_add, profile)
+                if key:
+                    cur = cur + key
+                else:
+                    cur = cur + "?"  # Out of range indicator
     except Exception as e:
-        return [f"Error loading MIDI: {str(e)}"]
-    
-    # Show info
-    for msg in midi_file:
-        cur_time = msg.time + cur_time
-        if cur_time >= 2:
-            ret.append(cur)
-            cur = ""
-            cur_bar = cur_bar + 1
-            cur = cur + str(cur_bar) + " "
-            cur_time = 0
-            
-        if msg.type == "note_on":
-            note = int(msg.note) + int(m_key_add)
-            key = GZP.noteTrans(note)
-            if key:
-                cur = cur + key
-            else:
-                cur = cur + "?"  # Out of range indicator
-    
+        return [(0, f"Error loading MIDI: {str(e)}")]
+
     # Add last bar if not empty
     if cur.strip() and cur.strip() != str(cur_bar):
-        ret.append(cur)
-    
-    return ret
\ No newline at end of file
+        ret.append((cur_start, cur))
+
+    return ret
+
+def printMidiSheet(m_file_name, m_key_add, profile=None):
+    """Generate sheet music notation from MIDI file"""
+    return [text for start, text in buildMidiSheet(m_file_name, m_key_add, profile)]
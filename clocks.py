@@ -0,0 +1,40 @@
+"""
+Clocks for the playback loop
+
+The player asks its clock for the time and waits through it. RealClock is
+perf_counter() and condition-variable waits. VirtualClock never sleeps: a
+timed wait just moves the clock forward to the deadline, so a song renders
+as fast as the CPU allows and the same input always gives the same timeline.
+"""
+import math
+import time
+
+
+class RealClock:
+    def now(self):
+        return time.perf_counter()
+
+    def wait(self, cond, timeout=None):
+        """Wait on `cond` (held by the caller) for up to `timeout` seconds"""
+        return cond.wait(timeout)
+
+
+class VirtualClock:
+    """Deterministic clock that jumps to every deadline instantly
+
+    Only timed waits advance it; an untimed wait (e.g. while paused) still
+    blocks until another thread notifies the condition.
+    """
+
+    def __init__(self, start=0.0):
+        self.time = start
+
+    def now(self):
+        return self.time
+
+    def wait(self, cond, timeout=None):
+        if timeout is None:
+            return cond.wait()
+        # Always move forward, even by less than the float resolution allows
+        self.time = max(self.time + max(0.0, timeout), math.nextafter(self.time, math.inf))
+        return False
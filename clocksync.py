@@ -0,0 +1,235 @@
+"""
+Clock sync between player instances over UDP
+
+One instance is the leader: when it starts a song it tells every follower
+when song time zero is on its clock, then sends position beacons while the
+song plays. Followers estimate the offset between the two clocks with
+ping/pong round trips (keeping the sample with the shortest round trip),
+start their own armed song at the matching local time, and turn beacon
+errors into gradual corrections of their player's anchor.
+
+Messages are small JSON datagrams, so everything works on 127.0.0.1 as well
+as across a LAN. Run this module directly for a loopback self-check that
+prints the measured offsets.
+"""
+import json
+import socket
+import threading
+import time
+
+import diagnostics
+
+DEFAULT_PORT = 47000
+
+# Round-trip samples kept for the offset estimate
+OFFSET_SAMPLES = 16
+
+
+def _now():
+    return time.perf_counter()
+
+
+class SyncLeader:
+    """Announces song starts and positions to every follower that pings it"""
+
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT, beacon_interval=0.5):
+        self.beacon_interval = beacon_interval
+        self.followers = set()
+        self.position_source = None
+        self._lock = threading.Lock()
+        self._running = True
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.address = self.sock.getsockname()
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _send(self, message, address):
+        try:
+            self.sock.sendto(json.dumps(message).encode(), address)
+        except OSError:
+            pass
+
+    def _broadcast(self, message):
+        with self._lock:
+            followers = list(self.followers)
+        for address in followers:
+            self._send(message, address)
+
+    def _run(self):
+        while self._running:
+            # Only wake up on a timer while there is a song to report on
+            self.sock.settimeout(self.beacon_interval if self.position_source else None)
+            try:
+                data, address = self.sock.recvfrom(1024)
+            except socket.timeout:
+                diagnostics.wakeup("sync leader")
+                self._send_beacon()
+                continue
+            except OSError:
+                break
+            diagnostics.wakeup("sync leader")
+
+            received_at = _now()
+            try:
+                message = json.loads(data)
+            except ValueError:
+                continue
+
+            if message.get('type') == 'ping':
+                with self._lock:
+                    self.followers.add(address)
+                self._send({'type': 'pong', 'id': message.get('id'), 'leader_time': received_at}, address)
+
+    def _send_beacon(self):
+        source = self.position_source
+        if source:
+            now = _now()
+            position = source(now)
+            if position is not None:
+                self._broadcast({'type': 'beacon', 'leader_time': now, 'position': position})
+
+    def announce_start(self, start_at, position_source):
+        """Tell followers that song time zero is at `start_at` on our clock
+
+        `position_source(now)` returns our song position for beacons.
+        """
+        self.position_source = position_source
+        self._broadcast({'type': 'start', 'leader_time': start_at})
+        # Wake the receive loop so it starts sending beacons
+        self._send({'type': 'wake'}, self.address)
+
+    def announce_stop(self):
+        self.position_source = None
+        self._broadcast({'type': 'stop'})
+
+    def close(self):
+        self._running = False
+        self.sock.close()
+
+
+class SyncFollower:
+    """Follows a leader's song starts and position beacons
+
+    on_start(local_start_at) is called when the leader starts a song,
+    on_stop() when it stops, and on_error(song_seconds) with how far our
+    position (from position_source(now)) is ahead of the leader's.
+    """
+
+    def __init__(self, leader_host='127.0.0.1', port=DEFAULT_PORT, on_start=None,
+                 on_stop=None, on_error=None, position_source=None, ping_interval=1.0):
+        self.leader = (leader_host, port)
+        self.on_start = on_start
+        self.on_stop = on_stop
+        self.on_error = on_error
+        self.position_source = position_source
+        self.ping_interval = ping_interval
+
+        # Leader clock minus our clock, round trip and last beacon error
+        self.offset = None
+        self.rtt = None
+        self.error = None
+
+        self._samples = []
+        self._pings = {}
+        self._next_id = 0
+        self._running = True
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('', 0))
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _ping(self):
+        self._next_id += 1
+        self._pings[self._next_id] = _now()
+        try:
+            self.sock.sendto(json.dumps({'type': 'ping', 'id': self._next_id}).encode(), self.leader)
+        except OSError:
+            pass
+
+    def _run(self):
+        next_ping = 0.0
+        while self._running:
+            now = _now()
+            if now >= next_ping:
+                self._ping()
+                # Ping quickly until the estimate has settled
+                interval = self.ping_interval if len(self._samples) >= 4 else 0.05
+                next_ping = now + interval
+
+            self.sock.settimeout(max(0.0, next_ping - _now()))
+            try:
+                data, _ = self.sock.recvfrom(1024)
+            except socket.timeout:
+                diagnostics.wakeup("sync follower")
+                continue
+            except OSError:
+                break
+            diagnostics.wakeup("sync follower")
+
+            received_at = _now()
+            try:
+                message = json.loads(data)
+            except ValueError:
+                continue
+            self._handle(message, received_at)
+
+    def _handle(self, message, received_at):
+        kind = message.get('type')
+
+        if kind == 'pong':
+            sent_at = self._pings.pop(message.get('id'), None)
+            if sent_at is None:
+                return
+            rtt = received_at - sent_at
+            offset = message['leader_time'] - (sent_at + received_at) / 2
+            self._samples = (self._samples + [(rtt, offset)])[-OFFSET_SAMPLES:]
+            self.rtt, self.offset = min(self._samples)
+
+        elif self.offset is None:
+            return
+
+        elif kind == 'start' and self.on_start:
+            self.on_start(message['leader_time'] - self.offset)
+
+        elif kind == 'stop' and self.on_stop:
+            self.on_stop()
+
+        elif kind == 'beacon' and self.position_source:
+            position = self.position_source(message['leader_time'] - self.offset)
+            if position is not None:
+                self.error = position - message['position']
+                if self.on_error:
+                    self.on_error(self.error)
+
+    def close(self):
+        self._running = False
+        self.sock.close()
+
+
+if __name__ == "__main__":
+    # Loopback self-check: one leader, two followers, offsets printed
+    leader = SyncLeader(port=0)
+    host, port = leader.address
+    starts = {}
+    followers = []
+    for name in ("A", "B"):
+        follower = SyncFollower(host, port, on_start=lambda at, name=name: starts.__setitem__(name, at),
+                                position_source=lambda now: now - starts.get("A", now))
+        followers.append(follower)
+
+    time.sleep(0.5)
+    start_at = _now() + 0.2
+    leader.announce_start(start_at, lambda now: now - start_at)
+    time.sleep(1.2)
+
+    for name, follower in zip(("A", "B"), followers):
+        print(f"Follower {name}: offset {follower.offset * 1000:+.3f} ms, "
+              f"rtt {follower.rtt * 1000:.3f} ms, "
+              f"start error {(starts.get(name, 0) - start_at) * 1000:+.3f} ms, "
+              f"beacon error {(follower.error or 0) * 1000:+.3f} ms")
+        follower.close()
+    leader.close()
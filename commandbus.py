@@ -0,0 +1,111 @@
+"""
+Command bus between control sources and the player
+
+Hotkeys, GUI buttons and the engine process all post playback commands
+(pause, resume, toggle, seek, bpm) to one bus instead of calling into the
+player from their own threads. The bus is a bounded deque, whose append
+and popleft are atomic, so posting never takes a lock the timing loop
+holds. Posting calls the attached wakeup, which only sets an event the
+player relays to its timing loop, and the player drains and applies every
+pending command as soon as it wakes.
+
+Each command carries the time it was posted; the consumer reports when it
+took effect, which gives the hotkey-to-effect latency. A command identical
+to the previous one from the same source within DEBOUNCE seconds (a key
+held down, a double click) is dropped.
+"""
+import collections
+import threading
+import time
+
+# Commands kept before the oldest is dropped
+MAX_PENDING = 64
+
+# Seconds within which a repeat of the same command is ignored
+DEBOUNCE = 0.2
+
+Command = collections.namedtuple('Command', ['name', 'args', 'source', 'posted_at'])
+
+
+class CommandBus:
+    """Bounded queue of Commands with a wakeup and latency stats"""
+
+    def __init__(self, maxlen=MAX_PENDING, debounce=DEBOUNCE):
+        self.debounce = debounce
+        self._pending = collections.deque(maxlen=maxlen)
+        self._last = {}         # source -> (name, args, posted_at) of its last command
+        self._last_lock = threading.Lock()      # never taken by the player
+        self._wakeup = None
+
+        self.debounced = 0
+        self.overflows = 0
+        self.applied = 0
+        self.latency_last = 0.0
+        self.latency_max = 0.0
+        self.latency_total = 0.0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def attach(self, wakeup):
+        """Call `wakeup()` after every post; None detaches"""
+        self._wakeup = wakeup
+
+    def repeated(self, name, args=(), source='gui', now=None):
+        """True if this repeats the source's last command within DEBOUNCE
+
+        Otherwise the command is remembered as the source's last one.
+        """
+        now = time.perf_counter() if now is None else now
+        with self._last_lock:
+            last = self._last.get(source)
+            if last and last[:2] == (name, args) and now - last[2] < self.debounce:
+                self.debounced += 1
+                return True
+            self._last[source] = (name, args, now)
+            return False
+
+    def push(self, name, *args, source='gui', posted_at=None):
+        """Queue a command without debouncing it"""
+        command = Command(name, args, source, time.perf_counter() if posted_at is None else posted_at)
+        if len(self._pending) == self._pending.maxlen:
+            self.overflows += 1
+        self._pending.append(command)
+        wakeup = self._wakeup
+        if wakeup:
+            wakeup()
+        return command
+
+    def post(self, name, *args, source='gui', posted_at=None):
+        """Queue a command; None if it was debounced"""
+        posted_at = time.perf_counter() if posted_at is None else posted_at
+        if self.repeated(name, args, source, posted_at):
+            return None
+        return self.push(name, *args, source=source, posted_at=posted_at)
+
+    def drain(self):
+        """Every pending command, oldest first"""
+        commands = []
+        while True:
+            try:
+                commands.append(self._pending.popleft())
+            except IndexError:
+                return commands
+
+    def done(self, command, at=None):
+        """Record that `command` took effect at perf_counter() time `at`"""
+        latency = (time.perf_counter() if at is None else at) - command.posted_at
+        self.applied += 1
+        self.latency_last = latency
+        self.latency_max = max(self.latency_max, latency)
+        self.latency_total += latency
+
+    def stats(self):
+        return {
+            'applied': self.applied,
+            'latency_last': self.latency_last,
+            'latency_max': self.latency_max,
+            'latency_mean': self.latency_total / self.applied if self.applied else 0.0,
+            'debounced': self.debounced,
+            'overflows': self.overflows,
+        }
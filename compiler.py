@@ -0,0 +1,531 @@
+"""
+Staged song compiler with a per-stage result cache
+
+Preparing a song for the player runs a chain of stages:
+
+    parse      MIDI file -> note and tempo events
+    tracks     track filter: drop muted tracks, tag notes with their part
+    transpose  shift pitches by the key (or the section plan's shifts)
+    fold       fold pitches onto layout keys, skipping what doesn't fit
+    quantise   snap to the tempo grid and coalesce chords into groups
+    key states count the notes holding each key, dropping redundant key events
+    compile    the (song_time, actions) groups MidiPlayer plays
+
+Every stage's output up to key states is cached under a hash of the file's
+contents and the parameters of that stage and all stages before it, so
+changing a setting only re-runs the stages from the one it belongs to
+onwards: a new key starts at transpose, a new quantise preset at quantise.
+BPM is applied by the timing loop and never recompiles anything. The compile
+stage builds its groups lazily from the cached key states output instead of
+keeping millions of tuples around.
+
+Stages work on columns of NumPy arrays, so re-running one is mostly array
+operations. The exception is coalescing in quantise with a window, or after
+the grid has put events out of order: each event joins the group started
+before it, so that grouping is sequential and loops over the events in
+Python. Only a song that has never been parsed takes the streaming path
+instead: the same chain as generators, so the pipelined player gets its
+first groups as soon as they are decoded, while the file is parsed into the
+cache in the background.
+"""
+import array
+import collections
+import hashlib
+import threading
+
+import numpy as np
+
+import keymaps
+import library
+import midireader
+
+# Bytes of stage outputs kept, least recently used dropped first
+CACHE_BYTES = 128 << 20
+
+# Groups built per step of the compile stage
+GROUP_CHUNK = 1024
+
+# Event kinds in the kind column
+NOTE_OFF, NOTE_ON, SET_TEMPO = 0, 1, 2
+KIND_CODES = {'note_off': NOTE_OFF, 'note_on': NOTE_ON, 'set_tempo': SET_TEMPO}
+
+# Cached stages, in order
+STAGES = ('parse', 'tracks', 'transpose', 'fold', 'quantise', 'key states')
+
+# stage key -> (output, info, size)
+_cache = collections.OrderedDict()
+_cache_bytes = 0
+_lock = threading.Lock()
+
+# Parse stage keys being parsed in the background
+_parsing = set()
+
+# profile name -> (chords, note -> chord index array)
+_chord_tables = {}
+
+
+def _store(key, output, info):
+    global _cache_bytes
+    size = sum(column.nbytes for column in output.values())
+    with _lock:
+        if key in _cache:
+            _cache_bytes -= _cache.pop(key)[2]
+        _cache[key] = (output, info, size)
+        _cache_bytes += size
+        while _cache_bytes > CACHE_BYTES and len(_cache) > 1:
+            _cache_bytes -= _cache.popitem(last=False)[1][2]
+
+
+def chord_table(profile):
+    """The layout's chords, and an array giving each MIDI note's chord index (-1: none)"""
+    tables = _chord_tables.get(profile.name)
+    if tables is None:
+        chords = sorted(set(chord for chord in profile.table if chord))
+        index = {chord: i for i, chord in enumerate(chords)}
+        ids = np.array([index[chord] if chord else -1 for chord in profile.table])
+        tables = _chord_tables[profile.name] = (chords, ids)
+    return tables
+
+
+# ==================== Grouped array helpers ====================
+
+def run_starts(keys):
+    """True where a run of equal keys begins"""
+    starts = np.ones(len(keys), dtype=bool)
+    starts[1:] = keys[1:] != keys[:-1]
+    return starts
+
+
+def grouped_cumsum(values, starts):
+    """Cumulative sums restarting at every run start"""
+    total = np.cumsum(values)
+    base = (total - values)[starts]
+    return total - base[np.cumsum(starts) - 1]
+
+
+def _held_before(steps, starts):
+    """Count held before each +1 (start) / -1 (end) step, per run
+
+    An end with nothing held is ignored, so the count is the cumulative sum
+    minus its running minimum (clamped at zero).
+    """
+    n = len(steps)
+    level = grouped_cumsum(steps, starts)
+    # Offset each run far below the previous ones so the running minimum
+    # never reaches back into an earlier run
+    run = np.cumsum(starts) - 1
+    offset = run.astype(np.int64) * (2 * n + 1)
+    floor = np.minimum(np.minimum.accumulate(level - offset) + offset, 0)
+    after = level - floor
+    before = np.zeros(n, dtype=after.dtype)
+    before[1:] = after[:-1]
+    before[starts] = 0
+    return before
+
+
+# ==================== Stages ====================
+
+def parse(path):
+    """Columns of every note and tempo event, and the song length
+
+    `data` holds the note, or the tempo for set_tempo rows.
+    """
+    stream = midireader.MidiStream(path)
+    times, kinds, tracks, channels, data = (array.array('d'), array.array('b'), array.array('i'),
+                                            array.array('b'), array.array('i'))
+    for event in stream:
+        times.append(event[0])
+        kinds.append(KIND_CODES[event[2]])
+        tracks.append(event[3])
+        channels.append(event[4])
+        data.append(event[5])
+
+    columns = {'time': np.array(times, dtype=np.float64), 'kind': np.array(kinds, dtype=np.int8),
+               'track': np.array(tracks, dtype=np.int32), 'channel': np.array(channels, dtype=np.int32),
+               'data': np.array(data, dtype=np.int64)}
+    return columns, stream.length
+
+
+def filter_tracks(columns, track_parts):
+    """Rows of played tracks (and all tempo rows), with part and source columns
+
+    `source` identifies (track, channel, note) as written in the file.
+    """
+    kind, track = columns['kind'], columns['track']
+    if track_parts is None:
+        part = np.zeros(len(kind), dtype=np.int32)
+    else:
+        size = max(list(track_parts) + [int(track.max()) if len(track) else 0]) + 1
+        lookup = np.full(size, -1, dtype=np.int32)
+        for played, to_part in track_parts.items():
+            lookup[played] = to_part
+        part = lookup[track]
+        part[kind == SET_TEMPO] = 0
+
+    keep = part >= 0
+    source = (track.astype(np.int64) * 16 + columns['channel']) * 128 + columns['data']
+    return {'time': columns['time'][keep], 'kind': kind[keep], 'part': part[keep],
+            'source': source[keep], 'data': columns['data'][keep]}
+
+
+def transpose(columns, key_plan):
+    """Shift notes by the plan's (song_seconds, key_add) section shifts"""
+    starts = np.array([start for start, shift in key_plan[1:]], dtype=np.float64)
+    shifts = np.array([shift for start, shift in key_plan], dtype=np.int64)
+    section = np.searchsorted(starts, columns['time'], side='right')
+    data = np.where(columns['kind'] == SET_TEMPO, columns['data'], columns['data'] + shifts[section])
+    return dict(columns, data=data)
+
+
+def fold(columns, profile):
+    """Map notes to chord indexes of the layout
+
+    Out-of-range notes are skipped, as are note_offs without a sounding
+    note_on from the same source. A note_off releases the chord its note_on
+    pressed (first in, first out), even if the section's shift has changed
+    in between. Tempo rows are kept.
+    """
+    chords, ids = chord_table(profile)
+    kind, data, source = columns['kind'], columns['data'], columns['source']
+    notes = kind != SET_TEMPO
+
+    chord = np.full(len(kind), -1, dtype=np.int64)
+    playable = notes & (data >= 0) & (data < 128)
+    chord[playable] = ids[data[playable]]
+    on = (kind == NOTE_ON) & (chord >= 0)
+    off = kind == NOTE_OFF
+
+    # Per source, in file order: a note_off only counts while a note sounds
+    rows = np.flatnonzero(on | off)
+    rows = rows[np.argsort(source[rows], kind='stable')]
+    starts = run_starts(source[rows])
+    is_on = on[rows]
+    released = ~is_on & (_held_before(np.where(is_on, 1, -1), starts) > 0)
+
+    # The k-th release of a source ends its k-th note_on
+    run = np.cumsum(starts) - 1
+    on_positions = np.flatnonzero(is_on)
+    first_on = np.searchsorted(run[on_positions], run)
+    rank = grouped_cumsum(released.astype(np.int64), starts)
+    matched = on_positions[first_on[released] + rank[released] - 1]
+    chord[rows[released]] = chord[rows[matched]]
+
+    keep = on | ~notes
+    keep[rows[released]] = True
+    return {'time': columns['time'][keep], 'kind': kind[keep], 'part': columns['part'][keep],
+            'chord': chord[keep], 'data': data[keep]}
+
+
+def quantise(columns, window=0.0, division=0):
+    """Snap key events to a 1/division note grid and coalesce them
+
+    The grid follows the tempo map; with division 0 times are kept as they
+    are. An event joins the current group while it is within `window`
+    seconds of the group's first event, whose time the group takes.
+    """
+    kind, time = columns['kind'], columns['time']
+    if division:
+        tempo_rows = np.maximum.accumulate(np.where(kind == SET_TEMPO, np.arange(len(kind)), -1))
+        has_tempo = tempo_rows >= 0
+        last = np.maximum(tempo_rows, 0)
+        grid = np.where(has_tempo, columns['data'][last] / 1e6 * 4 / division, 0.5 * 4 / division)
+        origin = np.where(has_tempo, time[last], 0)
+        time = origin + np.round((time - origin) / grid) * grid
+
+    keys = kind != SET_TEMPO
+    time = time[keys]
+    if window == 0 and np.all(time[1:] >= time[:-1]):
+        starts = run_starts(time)
+    else:
+        starts = np.zeros(len(time), dtype=bool)
+        group_time = None
+        for i, event_time in enumerate(time.tolist()):
+            if group_time is None or event_time - group_time > window:
+                group_time = event_time
+                starts[i] = True
+
+    group = np.cumsum(starts) - 1
+    return {'group': group, 'group_time': time[starts], 'part': columns['part'][keys],
+            'is_press': kind[keys] == NOTE_ON, 'chord': columns['chord'][keys]}
+
+
+def key_states(columns, chord_count):
+    """Keep only real key transitions; returns (columns, dropped)
+
+    Several source notes can land on one key (transposition folds pitches
+    together, tracks double each other). A key is pressed when its first note
+    starts and released when its last one ends, so a held note is never cut
+    off by another note's note_off and a key that is already down gets no
+    second press. A note starting on a key held since an earlier group
+    re-strikes it (release + press) so the game sounds it again. The
+    `merged` column lists the groups of note starts that were merged into a
+    press of the same key in their group.
+    """
+    group, is_press = columns['group'], columns['is_press']
+    key = columns['part'].astype(np.int64) * chord_count + columns['chord']
+
+    rows = np.argsort(key, kind='stable')
+    starts = run_starts(key[rows])
+    held = np.empty(len(rows), dtype=np.int64)
+    held[rows] = _held_before(np.where(is_press[rows], 1, -1), starts)
+
+    # Only the first press of a key in a group can re-strike it
+    presses = rows[is_press[rows]]
+    first = np.zeros(len(key), dtype=bool)
+    group_count = group[-1] + 1 if len(group) else 1
+    first[presses] = run_starts(key[presses] * group_count + group[presses])
+    restrike = is_press & (held > 0) & first
+    kept = np.where(is_press, (held == 0) | restrike, held == 1)
+
+    # A re-strike becomes a release followed by a press
+    copies = kept.astype(np.int64) + restrike
+    events = np.repeat(np.arange(len(key)), copies)
+    press = is_press[events] & ~(restrike[events] & run_starts(events))
+    result = {'group': group[events], 'group_time': columns['group_time'], 'part': columns['part'][events],
+              'is_press': press, 'chord': columns['chord'][events],
+              'merged': group[is_press & ~kept]}
+    return result, int(len(key) - kept.sum())
+
+
+def build_groups(columns, chords):
+    """(song_time, [(part, is_press, chord), ...]) groups for the player
+
+    Built lazily, GROUP_CHUNK groups at a time, so a player can start on the
+    first groups before the rest exist.
+    """
+    group, part, is_press, chord = (columns['group'], columns['part'], columns['is_press'],
+                                     columns['chord'])
+    bounds = np.append(np.flatnonzero(run_starts(group)), len(group))
+    times = columns['group_time'][group[bounds[:-1]]]
+    for first in range(0, len(times), GROUP_CHUNK):
+        last = min(first + GROUP_CHUNK, len(times))
+        low, high = bounds[first], bounds[last]
+        actions = list(zip(part[low:high].tolist(), is_press[low:high].tolist(),
+                           [chords[i] for i in chord[low:high].tolist()]))
+        starts = (bounds[first:last + 1] - low).tolist()
+        for song_time, start, end in zip(times[first:last].tolist(), starts, starts[1:]):
+            yield (song_time, actions[start:end])
+
+
+# ==================== Streaming path ====================
+
+def _stream_groups(events, key_plan, profile, track_parts, window, division, stats):
+    """The stage chain as generators over midireader events"""
+    section = 0
+    table = profile.transposed(key_plan[0][1])
+    sounding = {}
+    grid = 0
+    grid_origin = 0
+
+    def key_events():
+        nonlocal section, table, grid, grid_origin
+        for song_time, tick, kind, track, channel, data1, data2 in events:
+            if kind == 'set_tempo':
+                if division:
+                    grid = data1 / 1e6 * 4 / division
+                    grid_origin = song_time
+                continue
+
+            if track_parts is None:
+                part = 0
+            else:
+                part = track_parts.get(track)
+                if part is None:
+                    continue
+
+            while section + 1 < len(key_plan) and key_plan[section + 1][0] <= song_time:
+                section += 1
+                table = profile.transposed(key_plan[section][1])
+
+            source = (track, channel, data1)
+            if kind == 'note_on':
+                chord = table[data1]
+                if not chord:
+                    continue
+                sounding.setdefault(source, []).append(chord)
+            elif sounding.get(source):
+                chord = sounding[source].pop(0)
+            else:
+                continue
+
+            if division:
+                if not grid:
+                    grid = 0.5 * 4 / division   # MIDI default tempo
+                song_time = grid_origin + round((song_time - grid_origin) / grid) * grid
+            yield (song_time, part, kind == 'note_on', chord)
+
+    # Coalesce, then reference-count key states as key_states does
+    counts = {}
+    dropped = 0
+    group = None
+    for song_time, part, is_press, chord in key_events():
+        if group and song_time - group[0] <= window:
+            group[1].append((part, is_press, chord))
+            continue
+        if group:
+            kept, dropped = _refcount(group[1], counts, dropped)
+            if kept:
+                yield (group[0], kept)
+        group = (song_time, [(part, is_press, chord)])
+    if group:
+        kept, dropped = _refcount(group[1], counts, dropped)
+        if kept:
+            yield (group[0], kept)
+    stats['dropped'] = dropped
+
+
+def _refcount(actions, counts, dropped):
+    struck = set()
+    kept = []
+    for part, is_press, chord in actions:
+        key = (part, chord)
+        count = counts.get(key, 0)
+        if is_press:
+            if count == 0:
+                kept.append((part, True, chord))
+            elif key not in struck:
+                kept.append((part, False, chord))
+                kept.append((part, True, chord))
+            else:
+                dropped += 1
+            struck.add(key)
+            counts[key] = count + 1
+        elif count == 0:
+            dropped += 1
+        elif count == 1:
+            kept.append((part, False, chord))
+            del counts[key]
+        else:
+            counts[key] = count - 1
+            dropped += 1
+    return kept, dropped
+
+
+def _parse_into_cache(path, key):
+    try:
+        columns, length = parse(path)
+        _store(key, columns, {'length': length})
+    except Exception:
+        pass    # the streaming path reports the error
+    finally:
+        with _lock:
+            _parsing.discard(key)
+
+
+def _streamed(path, parse_key, key_plan, profile, track_parts, window, division, stats):
+    """Stream the song while a background thread parses it for the cache
+
+    The stream itself only advances as fast as the player consumes it, so
+    it can't be relied on to fill the cache before the next setting change.
+    """
+    with _lock:
+        start = parse_key not in _parsing
+        _parsing.add(parse_key)
+    if start:
+        threading.Thread(target=_parse_into_cache, args=(path, parse_key), daemon=True).start()
+
+    stream = midireader.MidiStream(path)
+    yield from _stream_groups(stream, key_plan, profile, track_parts, window, division, stats)
+    stats['length'] = stream.length
+
+
+# ==================== Entry point ====================
+
+def _stage_key(upstream, name, params):
+    return hashlib.sha1(repr((upstream, name, params)).encode()).hexdigest()
+
+
+def _compile(path, key_plan, profile, track_parts, quantize_window, quantize_division, stage,
+             streaming):
+    """(output, info, key) of a stage, or None if it should be streamed"""
+    chords = chord_table(profile)[0]
+
+    def counted(columns, info):
+        columns, info['dropped'] = key_states(columns, len(chords))
+        return columns
+
+    stages = [
+        (None, None),   # parsed below or in the background, see _streamed
+        (sorted(track_parts.items()) if track_parts is not None else None,
+         lambda columns, info: filter_tracks(columns, track_parts)),
+        (list(key_plan), lambda columns, info: transpose(columns, key_plan)),
+        (profile.name, lambda columns, info: fold(columns, profile)),
+        ((quantize_window, quantize_division),
+         lambda columns, info: quantise(columns, quantize_window, quantize_division)),
+        (None, counted),
+    ]
+    stages = stages[:STAGES.index(stage) + 1]
+
+    keys = []
+    upstream = library.content_hash(path)
+    for name, (params, run) in zip(STAGES, stages):
+        upstream = _stage_key(upstream, name, params)
+        keys.append(upstream)
+
+    # Start after the last stage whose output is cached. Earlier stages
+    # count as used too, so a run of setting changes can't evict the parse
+    output, info, first = None, {}, 0
+    with _lock:
+        for i, key in enumerate(keys):
+            if key in _cache:
+                _cache.move_to_end(key)
+                output, info = _cache[key][:2]
+                first = i + 1
+
+    if first == 0:
+        if streaming:
+            return None
+        output, length = parse(path)
+        info = {'length': length}
+        _store(keys[0], output, info)
+        first = 1
+
+    for i in range(first, len(stages)):
+        info = dict(info)
+        output = stages[i][1](output, info)
+        _store(keys[i], output, info)
+    return output, info, keys[-1]
+
+
+def compile_columns(path, key_plan, profile=None, track_parts=None, quantize_window=0.0,
+                    quantize_division=0, stage='key states'):
+    """(columns, info, cache key) of one stage, running and caching what it needs
+
+    For analyses of the compiled song; the cache key changes whenever the
+    columns do.
+    """
+    return _compile(path, key_plan, keymaps.get_profile(profile), track_parts, quantize_window,
+                    quantize_division, stage, False)
+
+
+def compile_groups(path, key_plan, profile=None, track_parts=None, quantize_window=0.0,
+                   quantize_division=0, stats=None, streaming=False):
+    """Compiled (song_time, actions) groups of a song, reusing cached stages
+
+    `key_plan` is a list of (song_seconds, key_add); use [(0.0, key_add)]
+    for a single key. Once the groups have been consumed, stats holds
+    'length' (song seconds) and 'dropped' (redundant key events). With
+    `streaming`, a song that isn't parsed yet is streamed instead of parsed
+    up front.
+    """
+    profile = keymaps.get_profile(profile)
+    if stats is None:
+        stats = {}
+
+    compiled = _compile(path, key_plan, profile, track_parts, quantize_window, quantize_division,
+                        STAGES[-1], streaming)
+    if compiled is None:
+        parse_key = _stage_key(library.content_hash(path), STAGES[0], None)
+        return _streamed(path, parse_key, key_plan, profile, track_parts, quantize_window,
+                         quantize_division, stats)
+
+    output, info, key = compiled
+    stats.update(info)
+    return build_groups(output, chord_table(profile)[0])
+
+
+def clear_cache():
+    global _cache_bytes
+    with _lock:
+        _cache.clear()
+        _cache_bytes = 0
@@ -0,0 +1,36 @@
+"""
+Wakeup counters for spotting background cost
+
+Every periodic or event-driven loop calls wakeup() with its component name
+each time it runs. rates() turns the counts into wakeups per second since
+the previous call, so an idle app should report nothing but zeros (apart
+from the diagnostics display itself, while it is shown).
+"""
+import threading
+import time
+
+_lock = threading.Lock()
+_counts = {}
+_since = time.monotonic()
+
+
+def wakeup(component):
+    with _lock:
+        _counts[component] = _counts.get(component, 0) + 1
+
+
+def rates():
+    """{component: wakeups per second} since the last call, then reset"""
+    global _since
+    now = time.monotonic()
+    with _lock:
+        elapsed = max(now - _since, 1e-9)
+        result = {component: count / elapsed for component, count in _counts.items()}
+        for component in _counts:
+            _counts[component] = 0
+        _since = now
+    return result
+
+
+def format_rates(result):
+    return " · ".join(f"{component} {rate:.1f}/s" for component, rate in sorted(result.items()))
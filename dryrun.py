@@ -0,0 +1,205 @@
+"""
+Playability dry run over a compiled song
+
+Answers "will the game keep up?" before a song is played: how many notes
+are lost and where, how many keys are held at once, the busiest stretch in
+key events per second, how quickly keys are struck again, and the highest
+BPM at which every part stays under an input-rate limit. Everything is
+computed from the cached compiler stages with array operations, and
+reports are cached per compiled song and settings.
+"""
+import numpy as np
+
+import compiler
+import keymaps
+
+# Key events per second a game client is assumed to keep up with, and the
+# sliding window (wall seconds) the rate is measured over
+DEFAULT_RATE_LIMIT = 60
+RATE_WINDOW = 1.0
+
+# Wall seconds between two strikes of one key below which the game may
+# miss the second one
+FAST_RESTRIKE = 0.05
+
+# Song seconds per bucket when reporting where notes are dropped
+DROP_BUCKET = 10.0
+
+# BPM range the player accepts
+MIN_BPM = 40
+MAX_BPM = 2000
+
+# (compiled key, bpm, rate limit, window) -> report
+_report_cache = {}
+MAX_REPORTS = 64
+
+
+def window_peak(times, weights, span):
+    """(largest weight sum in any [t, t + span) window, its start time)"""
+    if not len(times):
+        return 0, 0.0
+    totals = np.concatenate(([0], np.cumsum(weights)))
+    ends = np.searchsorted(times, times + span, side='left')
+    sums = totals[ends] - totals[:-1]
+    best = int(np.argmax(sums))
+    return int(sums[best]), float(times[best])
+
+
+def max_safe_bpm(parts, limit, window=RATE_WINDOW):
+    """Highest BPM at which no part sends more than `limit` events/sec
+
+    `parts` is a list of (times, weights) in song seconds. The busiest
+    window only grows with the BPM, so a binary search finds the edge.
+    None if even the slowest BPM is too fast.
+    """
+    def safe(bpm):
+        span = window * bpm / 120
+        return all(window_peak(times, weights, span)[0] <= limit * window for times, weights in parts)
+
+    if not safe(MIN_BPM):
+        return None
+    low, high = MIN_BPM, MAX_BPM
+    if safe(high):
+        return high
+    while high - low > 1:
+        middle = (low + high) // 2
+        if safe(middle):
+            low = middle
+        else:
+            high = middle
+    return low
+
+
+def _stroke_counts(columns, chords):
+    """SendInput strokes per action: modifiers go down and up around a press"""
+    modifiers = np.array([len(chord[0]) for chord in chords], dtype=np.int64)
+    return np.where(columns['is_press'], 1 + 2 * modifiers[columns['chord']], 1)
+
+
+def _polyphony(part, is_press, group):
+    """Most keys held down at once on one part, counted after each group"""
+    if not len(part):
+        return 0
+    rows = np.argsort(part, kind='stable')
+    starts = compiler.run_starts(part[rows])
+    held = compiler.grouped_cumsum(np.where(is_press[rows], 1, -1), starts)
+    # Only the state after a whole group counts: it's sent as one batch
+    ends = np.ones(len(rows), dtype=bool)
+    ends[:-1] = compiler.run_starts(part[rows] * (group[-1] + 1) + group[rows])[1:]
+    return int(held[ends].max())
+
+
+def _drop_buckets(times):
+    """[(start, end, count)] for every DROP_BUCKET of song with dropped notes"""
+    if not len(times):
+        return []
+    buckets, counts = np.unique((times // DROP_BUCKET).astype(np.int64), return_counts=True)
+    return [(bucket * DROP_BUCKET, (bucket + 1) * DROP_BUCKET, int(count))
+            for bucket, count in zip(buckets.tolist(), counts.tolist())]
+
+
+def analyse(path, bpm, key_plan, profile=None, track_parts=None, quantize_window=0.0,
+            quantize_division=0, rate_limit=DEFAULT_RATE_LIMIT, window=RATE_WINDOW):
+    """Dry-run report of a song as it would be played with these settings
+
+    Returns a dict; times are song seconds, rates and intervals are at
+    `bpm` in wall-clock terms.
+    """
+    profile = keymaps.get_profile(profile)
+    compiled, info, key = compiler.compile_columns(path, key_plan, profile, track_parts,
+                                                   quantize_window, quantize_division)
+    cache_key = (key, bpm, rate_limit, window)
+    report = _report_cache.get(cache_key)
+    if report is not None:
+        return report
+
+    # Notes lost to the layout's range
+    transposed = compiler.compile_columns(path, key_plan, profile, track_parts,
+                                          stage='transpose')[0]
+    chords, ids = compiler.chord_table(profile)
+    starts = transposed['kind'] == compiler.NOTE_ON
+    notes = transposed['data'][starts]
+    playable = (notes >= 0) & (notes < 128)
+    playable[playable] = ids[notes[playable]] >= 0
+    out_of_range = transposed['time'][starts][~playable]
+
+    # Notes merged into a press of the same key
+    group_time = compiled['group_time']
+    merged = group_time[compiled['merged']]
+    dropped = np.sort(np.concatenate((out_of_range, merged)))
+
+    times = group_time[compiled['group']]
+    part, is_press, chord = compiled['part'], compiled['is_press'], compiled['chord']
+    strokes = _stroke_counts(compiled, chords)
+    parts = [(times[part == p], strokes[part == p]) for p in np.unique(part).tolist()]
+
+    # Busiest window at this BPM, on the busiest part
+    peak, peak_at = 0, 0.0
+    for part_times, part_strokes in parts:
+        count, at = window_peak(part_times, part_strokes, window * bpm / 120)
+        if count > peak:
+            peak, peak_at = count, at
+
+    # Time between strikes of the same key, in wall seconds
+    pressed = np.flatnonzero(is_press)
+    keys = part[pressed].astype(np.int64) * len(chords) + chord[pressed]
+    order = np.argsort(keys, kind='stable')
+    same_key = ~compiler.run_starts(keys[order])
+    intervals = np.diff(times[pressed][order])[same_key[1:]] * 120 / bpm
+
+    report = {
+        'length': info['length'],
+        'notes': int(starts.sum()),
+        'out_of_range': len(out_of_range),
+        'merged': len(merged),
+        'dropped_times': dropped,
+        'dropped_buckets': _drop_buckets(dropped),
+        'polyphony': _polyphony(part, is_press, compiled['group']),
+        'peak_rate': peak / window,
+        'peak_at': peak_at,
+        'restrike_min': float(intervals.min()) if len(intervals) else None,
+        'fast_restrikes': int((intervals < FAST_RESTRIKE).sum()),
+        'rate_limit': rate_limit,
+        'max_safe_bpm': max_safe_bpm(parts, rate_limit, window),
+    }
+    if len(_report_cache) >= MAX_REPORTS:
+        _report_cache.clear()
+    _report_cache[cache_key] = report
+    return report
+
+
+def _clock(seconds):
+    return f"{int(seconds // 60)}:{int(seconds % 60):02d}"
+
+
+def format_report(report, bpm, song_bpm=120):
+    """Report as text lines for a dialog
+
+    BPMs are shown scaled to the song's own tempo of `song_bpm`.
+    """
+    def shown(value):
+        return round(value * song_bpm / 120)
+
+    lines = []
+    dropped = report['out_of_range'] + report['merged']
+    lines.append(f"Notes dropped: {dropped} of {report['notes']} "
+                 f"({report['out_of_range']} out of range, {report['merged']} merged into the same key)")
+    worst = sorted(report['dropped_buckets'], key=lambda bucket: -bucket[2])[:3]
+    for start, end, count in sorted(worst):
+        lines.append(f"    {_clock(start)}–{_clock(end)}: {count} dropped")
+
+    lines.append(f"Most keys held at once: {report['polyphony']}")
+    lines.append(f"Peak input rate at {shown(bpm)} BPM: {report['peak_rate']:.0f} events/s "
+                 f"at {_clock(report['peak_at'])} (limit {report['rate_limit']}/s)")
+    if report['restrike_min'] is not None:
+        lines.append(f"Fastest re-strike of one key: {report['restrike_min'] * 1000:.0f} ms "
+                     f"({report['fast_restrikes']} under {FAST_RESTRIKE * 1000:.0f} ms)")
+
+    safe = report['max_safe_bpm']
+    if safe is None:
+        lines.append(f"⚠ Too fast for the input limit even at {shown(MIN_BPM)} BPM")
+    elif safe < bpm:
+        lines.append(f"⚠ Max safe BPM: {shown(safe)} (current {shown(bpm)} overruns the limit)")
+    else:
+        lines.append(f"✓ Max safe BPM: {shown(safe)}")
+    return lines
@@ -0,0 +1,444 @@
+"""
+Playback engine in a separate process
+
+The GUI and the timing loop share one GIL when playback runs in a thread,
+so a slow repaint or list refresh can delay a note. EngineClient is a
+drop-in replacement for threads.PlaybackThread that runs the same worker in
+a child process at raised priority instead:
+
+- commands (arm, fire, pause, ...) go to the child over a pipe, and the
+  child sends back events (started, paused, finished, error) on the same
+  pipe. Nothing waits for an answer: fire and toggle come from the
+  keyboard hook, so they decide from the status block what the engine
+  will do with them;
+- whether a song is armed, position, held keys and timing stats are
+  published by the child into a shared-memory block, which the GUI polls
+  only while a song is playing.
+
+The block is written by one process and read by the other under a seqlock:
+the writer makes the sequence number odd while it writes and even again
+afterwards, and a reader retries until it sees the same even number on both
+sides of its copy. perf_counter() is system-wide, so times can be passed
+between the two processes as they are.
+"""
+import collections
+import ctypes
+import multiprocessing
+import os
+import struct
+import sys
+import threading
+import time
+from multiprocessing import shared_memory
+
+from PyQt5.QtCore import QObject, Qt, QTimer, pyqtSignal
+import diagnostics
+
+# GUI poll interval while a song plays, ms
+POLL_INTERVAL = 15
+
+# Most recent key presses kept for the note visualisation
+PRESS_RING = 64
+
+# Seconds to wait for the engine to exit
+EXIT_TIMEOUT = 1.0
+
+Status = collections.namedtuple('Status', [
+    'seq', 'armed', 'playing', 'paused',
+    'current',          # song time of the last group sent
+    'position', 'position_at', 'total', 'bpm',
+    'start_latency', 'late_max', 'late_mean', 'underruns',
+    'command_latency', 'command_max', 'debounced',
+    'presses', 'recent', 'held',
+])
+STATUS = struct.Struct('<Q???8dI2dIQ64s64s')
+SEQ = struct.Struct('<Q')
+
+
+def read_status(buf):
+    """Consistent Status copied out of a status block"""
+    while True:
+        seq = SEQ.unpack_from(buf)[0]
+        if not seq & 1:
+            status = Status._make(STATUS.unpack_from(buf))
+            if SEQ.unpack_from(buf)[0] == seq:
+                return status
+        time.sleep(0)
+
+
+# ==================== Engine process ====================
+
+def _raise_priority():
+    try:
+        if sys.platform == 'win32':
+            HIGH_PRIORITY_CLASS = 0x80
+            kernel32 = ctypes.windll.kernel32
+            if not kernel32.SetPriorityClass(kernel32.GetCurrentProcess(), HIGH_PRIORITY_CLASS):
+                raise OSError(ctypes.GetLastError())
+        else:
+            os.nice(-10)
+    except OSError as e:
+        print(f"[DEBUG] Engine runs at normal priority: {e}")
+
+
+class _StatusWriter:
+    """Engine side of the status block"""
+
+    def __init__(self, name):
+        # Spawned children share the GUI's resource tracker, so attaching
+        # doesn't make this process an owner of the block
+        self.shm = shared_memory.SharedMemory(name=name)
+        self.fields = read_status(self.shm.buf)._asdict()
+        self.recent = bytearray(PRESS_RING)
+        self.lock = threading.Lock()
+
+    def publish(self, **changes):
+        with self.lock:
+            self.fields.update(changes)
+            self._write()
+
+    def press(self, key, **changes):
+        with self.lock:
+            presses = self.fields['presses']
+            self.recent[presses % PRESS_RING] = ord(key[:1]) if key.isascii() and key else ord('?')
+            self.fields.update(changes, presses=presses + 1, recent=bytes(self.recent))
+            self._write()
+
+    def _write(self):
+        buf = self.shm.buf
+        seq = self.fields['seq'] + 1
+        SEQ.pack_into(buf, 0, seq)
+        self.fields['seq'] = seq + 1
+        STATUS.pack_into(buf, 0, *Status(**dict(self.fields, seq=seq)))
+        SEQ.pack_into(buf, 0, seq + 1)
+
+    def close(self):
+        self.shm.close()
+
+
+def _worker_stats(worker, held=True):
+    """Timing stats and held keys of a PlaybackThread, as status fields
+
+    Held keys change on the playback thread as it sends them, so only that
+    thread asks for them; other callers pass held=False.
+    """
+    commands = worker.bus.stats()
+    fields = {
+        'command_latency': commands['latency_last'],
+        'command_max': commands['latency_max'],
+        'debounced': commands['debounced'],
+    }
+    player = worker.player
+    if player:
+        groups = player.groups_played
+        fields.update(late_max=player.late_max,
+                      late_mean=player.late_total / groups if groups else 0.0,
+                      underruns=player.underruns)
+        if held:
+            keys = ''.join(sorted({chord[1] for part, chord in player.pressed_keys}))
+            fields['held'] = keys.encode('ascii', 'replace')[:64]
+    return fields
+
+
+def engine_main(conn, status_name):
+    """Entry point of the engine process: serve commands until 'quit'"""
+    # Imported here so the GUI process doesn't need them to start the engine
+    import sinks
+    from threads import PlaybackThread
+
+    _raise_priority()
+    status = _StatusWriter(status_name)
+    send_lock = threading.Lock()
+
+    def send(*event):
+        with send_lock:
+            conn.send(event)
+
+    worker = PlaybackThread()
+
+    def rebase(bpm=None):
+        # Re-anchor the GUI's position estimate after a clock change
+        player = worker.player
+        if player:
+            now = time.perf_counter()
+            status.publish(position=player.position(now), position_at=now, bpm=bpm or player.current_bpm(now),
+                           paused=player.is_paused, **_worker_stats(worker, held=False))
+
+    def progress(current, total):
+        player = worker.player
+        now = time.perf_counter()
+        status.publish(current=current, total=total, position=player.position(now),
+                       position_at=now, bpm=player.current_bpm(now), **_worker_stats(worker))
+
+    def note_played(key):
+        status.press(key, **_worker_stats(worker))
+
+    def started(delay):
+        player = worker.player
+        status.publish(armed=False, playing=True, paused=False, current=0.0, total=player.total_time,
+                       position=0.0, position_at=worker._fired_at, bpm=player.bpm,
+                       start_latency=worker.start_latency, **_worker_stats(worker))
+        send('started', delay)
+
+    def paused(is_paused):
+        rebase()
+        send('paused', is_paused)
+
+    def ended(*event):
+        status.publish(playing=False, **_worker_stats(worker))
+        send(*event)
+
+    # No event loop runs here: slots are called on the worker thread itself
+    worker.progress_signal.connect(progress, Qt.DirectConnection)
+    worker.note_played_signal.connect(note_played, Qt.DirectConnection)
+    worker.started_signal.connect(started, Qt.DirectConnection)
+    worker.paused_signal.connect(paused, Qt.DirectConnection)
+    worker.armed_signal.connect(lambda: status.publish(armed=True, bpm=worker.player.bpm), Qt.DirectConnection)
+    worker.finished_signal.connect(lambda: ended('finished'), Qt.DirectConnection)
+    worker.error_signal.connect(lambda message: ended('error', message), Qt.DirectConnection)
+    worker.start()
+
+    while True:
+        try:
+            command, args = conn.recv()
+        except EOFError:
+            break
+        if command == 'quit':
+            break
+
+        if command in ('arm', 'stop'):
+            # Whatever was armed is gone; armed_signal says when the new song is
+            status.publish(armed=False)
+
+        if command == 'arm':
+            bpm, file_name, keyadd, allow_out_range, profile, options, windows = args
+            if windows:
+                options['sinks'] = [sinks.WindowSink(hwnd) for hwnd in windows]
+            worker.bpm = bpm
+            worker.arm(file_name, keyadd, allow_out_range, profile, **options)
+        else:
+            getattr(worker, command)(*args)
+            if command == 'set_bpm':
+                # The song picks the new BPM up from the bus a moment later;
+                # a ramp starts from the current one
+                new_bpm, source, over = args
+                rebase(None if over > 0 else max(40, min(2000, new_bpm)))
+
+    worker.shutdown()
+    status.close()
+
+
+# ==================== GUI side ====================
+
+class EngineClient(QObject):
+    """PlaybackThread's interface, backed by an engine process
+
+    Signals are emitted on the GUI thread: events arrive through a listener
+    thread blocked on the pipe, and progress and notes come from polling the
+    status block, which only happens while a song is playing.
+    """
+    progress_signal = pyqtSignal(float, float)
+    started_signal = pyqtSignal(float)
+    paused_signal = pyqtSignal(bool)
+    finished_signal = pyqtSignal()
+    note_played_signal = pyqtSignal(str)
+    error_signal = pyqtSignal(str)
+    _event_signal = pyqtSignal(tuple)
+
+    def __init__(self):
+        super().__init__()
+        self.bpm = 120
+        self.start_delay = 0
+        self.sync_leader = None
+        self.process = None
+        self._send_lock = threading.Lock()
+        self._fired_seq = None    # status seq at the last start sent, so it's sent once
+        self._closing = False
+        self._seen = None
+
+        self.shm = shared_memory.SharedMemory(create=True, size=STATUS.size)
+        self.shm.buf[:STATUS.size] = bytes(STATUS.size)
+
+        self._event_signal.connect(self._handle_event)
+        self.poll_timer = QTimer(self)
+        self.poll_timer.setInterval(POLL_INTERVAL)
+        self.poll_timer.timeout.connect(self.poll)
+
+    def start(self):
+        """Launch the engine process"""
+        # Spawn rather than fork: the child must not inherit the Qt state
+        context = multiprocessing.get_context('spawn')
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=engine_main, args=(child_conn, self.shm.name),
+                                       name="playback engine", daemon=True)
+        self.process.start()
+        child_conn.close()
+        threading.Thread(target=self._listen, daemon=True).start()
+
+    def _send(self, command, *args):
+        try:
+            with self._send_lock:
+                self.conn.send((command, args))
+            return True
+        except (OSError, ValueError):
+            return False
+
+    def _listen(self):
+        while True:
+            try:
+                event = self.conn.recv()
+            except (EOFError, OSError):
+                if not self._closing:
+                    self._event_signal.emit(('error', "Playback engine stopped"))
+                break
+            self._event_signal.emit(event)
+
+    def _handle_event(self, event):
+        kind = event[0]
+        if kind == 'started':
+            self._seen = None
+            self.poll_timer.start()
+            self.started_signal.emit(self.start_delay)
+            return
+        if kind == 'paused':
+            self.poll()
+            self.paused_signal.emit(event[1])
+            return
+
+        self.poll()
+        self.poll_timer.stop()
+        if self.sync_leader and self.sync_leader.position_source:
+            self.sync_leader.announce_stop()
+        if kind == 'finished':
+            self.finished_signal.emit()
+        elif kind == 'error':
+            self.error_signal.emit(event[1])
+
+    def status(self):
+        return read_status(self.shm.buf)
+
+    def poll(self):
+        """Turn status changes into progress and note signals"""
+        diagnostics.wakeup("engine poll")
+        status = self.status()
+        seen = self._seen
+        self._seen = status
+        if seen is None:
+            seen = status._replace(current=-1.0, presses=status.presses)
+        elif status.seq == seen.seq:
+            return
+
+        if status.current != seen.current:
+            self.progress_signal.emit(status.current, status.total)
+        new = min(status.presses - seen.presses, PRESS_RING)
+        for press in range(status.presses - new, status.presses):
+            self.note_played_signal.emit(chr(status.recent[press % PRESS_RING]))
+
+    @property
+    def start_latency(self):
+        return self.status().start_latency
+
+    def arm(self, file_name, keyadd, allow_out_range, profile=None, **options):
+        """Prepare a song in the engine; see PlaybackThread.arm"""
+        # Window sinks are rebuilt from their handles on the other side
+        windows = [sink.hwnd for sink in options.pop('sinks', None) or []]
+        self._send('arm', self.bpm, file_name, keyadd, allow_out_range, profile, options, windows)
+
+    @property
+    def armed(self):
+        return self.status().armed
+
+    def fire(self, start_at=None):
+        """Release the armed song; see PlaybackThread.fire
+
+        Doesn't wait for the engine: the answer comes from the status block.
+        """
+        pressed_at = time.perf_counter()
+        if start_at is None:
+            start_at = pressed_at + self.start_delay
+        status = self.status()
+        if (not status.armed or status.playing or status.seq == self._fired_seq
+                or not self._send('fire', start_at, pressed_at)):
+            return False
+        self._fired_seq = status.seq
+        if self.sync_leader:
+            self.sync_leader.announce_start(start_at, self.position)
+        return True
+
+    def toggle(self, source='gui'):
+        """Start, pause or resume; see PlaybackThread.toggle
+
+        Called on the keyboard hook thread, so it never waits for the engine.
+        Debouncing happens there, so a repeat also reports 'toggled'.
+        """
+        pressed_at = time.perf_counter()
+        start_at = pressed_at + self.start_delay
+        status = self.status()
+        if status.playing:
+            result = 'toggled'
+        elif status.armed and status.seq != self._fired_seq:
+            result = 'started'
+            self._fired_seq = status.seq
+        else:
+            return None
+        if not self._send('toggle', source, pressed_at, start_at):
+            return None
+        if result == 'started' and self.sync_leader:
+            self.sync_leader.announce_start(start_at, self.position)
+        return result
+
+    def command_stats(self):
+        """Command latency and debounce counts, as far as the status block has them"""
+        status = self.status()
+        return {'latency_last': status.command_latency, 'latency_max': status.command_max,
+                'debounced': status.debounced}
+
+    def current_bpm(self):
+        status = self.status()
+        return status.bpm if status.playing else self.bpm
+
+    def position(self, now=None):
+        """Current song position, or None when nothing is playing"""
+        status = self.status()
+        if not status.playing:
+            return None
+        if status.paused:
+            return status.position
+        now = time.perf_counter() if now is None else now
+        return status.position + (now - status.position_at) * status.bpm / 120
+
+    def slew(self, error):
+        self._send('slew', error)
+
+    def pause(self, source='gui'):
+        self._send('pause', source)
+
+    def resume(self, source='gui'):
+        self._send('resume', source)
+
+    def seek(self, seconds, source='gui'):
+        self._send('seek', seconds, source)
+
+    def stop(self):
+        """Disarm and stop the current song"""
+        self._send('stop')
+        if self.sync_leader and self.sync_leader.position_source:
+            self.sync_leader.announce_stop()
+
+    def set_bpm(self, new_bpm, source='gui', over=0.0):
+        self.bpm = new_bpm
+        self._send('set_bpm', new_bpm, source, over)
+
+    def shutdown(self):
+        """Stop playback, end the engine process and free the status block"""
+        self._closing = True
+        self.poll_timer.stop()
+        if self.process:
+            self.stop()
+            self._send('quit')
+            self.process.join(EXIT_TIMEOUT)
+            if self.process.is_alive():
+                self.process.terminate()
+            self.conn.close()
+        self.shm.close()
+        self.shm.unlink()
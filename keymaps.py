@@ -0,0 +1,103 @@
+"""
+Keyboard layouts for the in-game instruments
+
+A layout is compiled once into a 128-entry table indexed by MIDI note. Each
+entry is either None (the note can't be played) or a chord: a tuple of
+(modifiers, key), e.g. ((), 'z') or (('shift',), 'z') for a sharp in the
+36-key mode.
+"""
+
+# Natural notes of the C major scale, as semitones above C
+NATURALS = [0, 2, 4, 5, 7, 9, 11]
+SHARPS = [1, 3, 6, 8, 10]
+
+# Keyboard rows from the lowest octave to the highest
+ROWS = ['zxcvbnm', 'asdfghj', 'qwertyu']
+
+# How chords are written in sheets
+MODIFIER_LABELS = {'shift': '#', 'ctrl': 'b'}
+
+
+class KeyProfile:
+    """A keyboard layout compiled into a 128-entry key table"""
+
+    def __init__(self, name, mapping):
+        self.name = name
+        self.table = [None] * 128
+        self.notes = {}
+        for note, chord in mapping.items():
+            self.table[note] = chord
+            self.notes[chord] = note
+
+        playable = [note for note, chord in enumerate(self.table) if chord]
+        self.low = min(playable)
+        self.high = max(playable)
+        self.uses_modifiers = any(chord[0] for chord in self.table if chord)
+        self._tables = {}
+
+    def chord(self, note):
+        """Chord for a MIDI note, or None if it's out of range"""
+        if 0 <= note < 128:
+            return self.table[note]
+        return None
+
+    def in_range(self, note):
+        return self.chord(note) is not None
+
+    def transposed(self, key_add):
+        """Table indexed by source note for a given transposition (cached)"""
+        table = self._tables.get(key_add)
+        if table is None:
+            table = [self.chord(note + key_add) for note in range(128)]
+            self._tables[key_add] = table
+        return table
+
+    def note(self, chord):
+        """MIDI note the game plays for a chord"""
+        return self.notes[chord]
+
+    def label(self, chord):
+        """Sheet text for a chord, e.g. 'z' or '#z'"""
+        modifiers, key = chord
+        return "".join(MODIFIER_LABELS.get(m, m + "+") for m in modifiers) + key
+
+
+def diatonic_layout(base_note=60):
+    """Three octaves of natural notes, one keyboard row per octave"""
+    mapping = {}
+    for octave, row in enumerate(ROWS):
+        for degree, key in zip(NATURALS, row):
+            mapping[base_note + octave * 12 + degree] = ((), key)
+    return mapping
+
+
+def chromatic_layout(base_note=60):
+    """36-key mode: naturals as above, sharps as Shift + the natural below"""
+    mapping = diatonic_layout(base_note)
+    for octave, row in enumerate(ROWS):
+        for degree, key in zip(NATURALS, row):
+            if degree + 1 in SHARPS:
+                mapping[base_note + octave * 12 + degree + 1] = (('shift',), key)
+    return mapping
+
+
+PROFILES = {}
+
+
+def register_profile(profile):
+    PROFILES[profile.name] = profile
+    return profile
+
+
+def get_profile(name=None):
+    """Look up a layout by name, falling back to the default one
+
+    A KeyProfile is returned as it is, so callers can pass either.
+    """
+    if isinstance(name, KeyProfile):
+        return name
+    return PROFILES.get(name, DEFAULT_PROFILE)
+
+
+DEFAULT_PROFILE = register_profile(KeyProfile("21 keys", diatonic_layout()))
+register_profile(KeyProfile("36 keys", chromatic_layout()))
@@ -0,0 +1,258 @@
+"""
+Song library helpers
+"""
+import functools
+import hashlib
+import json
+import os
+import uuid
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+import keymaps
+import midireader
+
+# Bytes hashed per read
+HASH_BLOCK_SIZE = 1 << 20
+
+# path -> ((mtime_ns, size), digest)
+_hash_cache = {}
+
+
+def content_hash(path):
+    """SHA-1 of a file's contents, cached until the file changes"""
+    stat = os.stat(path)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+
+    cached = _hash_cache.get(path)
+    if cached and cached[0] == stamp:
+        return cached[1]
+
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+
+    _hash_cache[path] = (stamp, digest.hexdigest())
+    return _hash_cache[path][1]
+
+
+# ==================== Bulk import ====================
+
+MIDI_EXTENSIONS = ('.mid', '.midi')
+INDEX_FILE = "library_index.json"
+
+# Sources handed to each worker at a time
+IMPORT_CHUNK = 32
+
+# Per-worker state: hashes already in the library, open zip archives
+_known_hashes = frozenset()
+_open_zips = {}
+
+
+def is_midi_name(name):
+    return os.path.splitext(name)[1].lower() in MIDI_EXTENSIONS
+
+
+def atomic_write_json(path, data):
+    """Write JSON via a temp file and rename, so readers never see half a file"""
+    temp_path = path + ".tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+def load_index(path=INDEX_FILE):
+    """Library index: content hash -> {file, stamp, duration, pitches, ...}"""
+    try:
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+    except Exception as e:
+        print(f"Error loading library index: {e}")
+    return {}
+
+
+def seed_hash_cache(index, path_for):
+    """Trust indexed hashes for files whose mtime and size still match"""
+    for digest, entry in index.items():
+        _hash_cache[path_for(entry['file'])] = (tuple(entry['stamp']), digest)
+
+
+def find_sources(paths):
+    """Expand files, folders and zip archives into (path, zip member) pairs"""
+    sources = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                sources.extend(find_sources(os.path.join(root, name) for name in sorted(files)
+                                            if is_midi_name(name) or name.lower().endswith('.zip')))
+        elif path.lower().endswith('.zip'):
+            try:
+                with zipfile.ZipFile(path) as archive:
+                    sources.extend((path, info.filename) for info in archive.infolist()
+                                   if not info.is_dir() and is_midi_name(info.filename))
+            except (OSError, zipfile.BadZipFile) as e:
+                print(f"❌ Skipping archive {path}: {e}")
+        elif is_midi_name(path):
+            sources.append((path, None))
+    return sources
+
+
+def analyse_file(path, profile=None):
+    """Duration, pitches, best key and notes still out, in one parse"""
+    import Player as GZP
+
+    song = midireader.MidiArrays(path, kinds=('note_on',))
+    pitches = set()
+    for track in song.tracks:
+        pitches.update(track['data1'].tolist())
+
+    fit = GZP.pitchFit(pitches, profile)
+    best_key = GZP.bestKeyForFit(fit, len(pitches))
+    return {
+        'duration': song.length,
+        'pitches': sorted(pitches),
+        'profile': keymaps.get_profile(profile).name,
+        'best_key': best_key,
+        'out': fit[best_key],
+    }
+
+
+def _init_worker(known_hashes):
+    global _known_hashes
+    _known_hashes = frozenset(known_hashes)
+
+
+def _read_source(path, member):
+    if member is None:
+        with open(path, 'rb') as f:
+            return f.read()
+    archive = _open_zips.get(path)
+    if archive is None:
+        archive = _open_zips[path] = zipfile.ZipFile(path)
+    return archive.read(member)
+
+
+def _import_one(source, repo_dir, profile):
+    """Hash, stage and analyse one source (runs in a worker process)
+
+    New files are written to a temp file inside the library folder, so the
+    main process only has to rename the ones it keeps.
+    """
+    path, member, in_place = source
+    name = os.path.basename(member or path)
+    result = {'source': source, 'name': name}
+    temp_path = None
+    try:
+        if in_place:
+            digest = content_hash(path)
+            staged = path
+        else:
+            data = _read_source(path, member)
+            digest = hashlib.sha1(data).hexdigest()
+            if digest in _known_hashes:
+                result.update(status='duplicate', hash=digest)
+                return result
+            staged = temp_path = os.path.join(repo_dir, f".import-{uuid.uuid4().hex}.tmp")
+            with open(staged, 'wb') as f:
+                f.write(data)
+
+        result.update(hash=digest, staged=staged)
+        result['info'] = analyse_file(staged, profile)
+        result['status'] = 'ok'
+    except Exception as e:
+        result.update(status='invalid', error=str(e))
+    finally:
+        # Only a successful import hands its staged file to the main process
+        if temp_path and result.get('status') != 'ok':
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+    return result
+
+
+def _unique_name(repo_dir, name, taken):
+    stem, ext = os.path.splitext(name)
+    candidate = name
+    n = 2
+    while candidate.lower() in taken or os.path.exists(os.path.join(repo_dir, candidate)):
+        candidate = f"{stem} ({n}){ext}"
+        n += 1
+    taken.add(candidate.lower())
+    return candidate
+
+
+def import_sources(paths, repo_dir, profile=None, index_path=INDEX_FILE, workers=None, progress=None):
+    """Import MIDI files, folders and zip archives into the library
+
+    Every source is hashed so a song already in the library (under any name)
+    is skipped, parsed once to reject broken files and to record its
+    duration, pitches and best key, and copied by a pool of worker
+    processes. Library files that are not indexed yet are analysed in the
+    same pass, and the index is rewritten atomically at the end.
+    progress(done, total) is called from this thread as results arrive.
+    Returns a summary dict of imported names, duplicate and invalid sources.
+    """
+    os.makedirs(repo_dir, exist_ok=True)
+    index = load_index(index_path)
+    existing = {name for name in os.listdir(repo_dir) if is_midi_name(name)}
+
+    # Drop entries for deleted files, then pick up unindexed library files
+    index = {digest: entry for digest, entry in index.items() if entry.get('file') in existing}
+    indexed = {entry['file'] for entry in index.values()}
+    sources = [(os.path.join(repo_dir, name), None, True) for name in sorted(existing - indexed)]
+    sources += [(path, member, False) for path, member in find_sources(paths)]
+
+    summary = {'imported': [], 'duplicates': [], 'invalid': [], 'indexed': 0}
+    total = len(sources)
+    if progress:
+        progress(0, total)
+    if not sources:
+        atomic_write_json(index_path, index)
+        return summary
+
+    profile_name = keymaps.get_profile(profile).name
+    taken = {name.lower() for name in existing}
+    workers = workers or min(8, os.cpu_count() or 1)
+    job = functools.partial(_import_one, repo_dir=repo_dir, profile=profile_name)
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(tuple(index),)) as pool:
+        for done, result in enumerate(pool.map(job, sources, chunksize=IMPORT_CHUNK), 1):
+            status = result['status']
+            digest = result.get('hash')
+            in_place = result['source'][2]
+
+            if status == 'ok' and digest in index:
+                # Same song earlier in this batch
+                if not in_place:
+                    os.remove(result['staged'])
+                status = 'duplicate'
+
+            if status == 'ok':
+                if in_place:
+                    name = result['name']
+                    summary['indexed'] += 1
+                else:
+                    name = _unique_name(repo_dir, result['name'], taken)
+                    final_path = os.path.join(repo_dir, name)
+                    os.replace(result['staged'], final_path)
+                    summary['imported'].append(name)
+
+                stat = os.stat(os.path.join(repo_dir, name))
+                index[digest] = dict(result['info'], file=name, stamp=[stat.st_mtime_ns, stat.st_size])
+            elif status == 'duplicate':
+                summary['duplicates'].append(result['name'])
+            else:
+                summary['invalid'].append((result['name'], result.get('error', '')))
+
+            if progress:
+                progress(done, total)
+
+    atomic_write_json(index_path, index)
+    return summary
@@ -0,0 +1,404 @@
+"""
+Streaming Standard MIDI File reader
+
+Track chunks are decoded lazily straight from the file, a small block at a
+time, and merged by a heap over one cursor per track. Only the events the
+player needs are produced, as plain tuples:
+
+    (seconds, tick, kind, track, channel, data1, data2)
+
+where kind is 'note_on', 'note_off' or 'set_tempo'. For notes data1/data2
+are the note and velocity (note_on with velocity 0 is reported as note_off);
+for set_tempo data1 is the tempo in microseconds per beat. Memory use depends
+on the number of tracks, not on the size of the file.
+
+For analysis, MidiArrays decodes every track chunk on its own into
+tick-stamped NumPy arrays, one track after another in the calling process.
+Seconds come from one vectorised pass over the tempo map, and the tracks
+are only merged into one timeline when merged() is asked for: pitch sets,
+note counts and song lengths don't need it.
+"""
+import array
+import heapq
+import struct
+
+import numpy as np
+
+# Bytes read from a track chunk at a time
+BLOCK_SIZE = 8192
+
+DEFAULT_TEMPO = 500000
+NOTE_KINDS = ('note_on', 'note_off')
+PLAYER_KINDS = ('note_on', 'note_off', 'set_tempo')
+
+# Kind codes in MidiArrays columns
+NOTE_OFF, NOTE_ON, SET_TEMPO = 0, 1, 2
+KIND_CODES = {'note_off': NOTE_OFF, 'note_on': NOTE_ON, 'set_tempo': SET_TEMPO}
+
+
+class MidiFormatError(Exception):
+    pass
+
+
+class _TrackCursor:
+    """Decodes one track chunk on demand"""
+
+    def __init__(self, f, offset, length, track):
+        self.f = f
+        self.track = track
+        self.file_pos = offset
+        self.end = offset + length
+        self.buf = b''
+        self.pos = 0
+        self.tick = 0
+        self.status = 0
+
+    def _fill(self, n):
+        """Make n bytes available at pos (fewer only at the end of the chunk)"""
+        avail = len(self.buf) - self.pos
+        if avail >= n or self.file_pos >= self.end:
+            return
+        self.f.seek(self.file_pos)
+        data = self.f.read(min(max(n - avail, BLOCK_SIZE), self.end - self.file_pos))
+        self.file_pos += len(data)
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+
+    def _skip(self, n):
+        avail = len(self.buf) - self.pos
+        if n <= avail:
+            self.pos += n
+        else:
+            self.file_pos += n - avail
+            self.buf = b''
+            self.pos = 0
+
+    def _varlen(self):
+        value = 0
+        while True:
+            self._fill(1)
+            byte = self.buf[self.pos]
+            self.pos += 1
+            value = (value << 7) | (byte & 0x7F)
+            if byte < 0x80:
+                return value
+
+    def next_event(self):
+        """Next (tick, kind, channel, data1, data2), or None at the end"""
+        try:
+            while True:
+                if self.pos >= len(self.buf) and self.file_pos >= self.end:
+                    return None
+
+                self.tick += self._varlen()
+                self._fill(3)
+                buf = self.buf
+                status = buf[self.pos]
+                if status >= 0x80:
+                    self.pos += 1
+                    if status < 0xF0:
+                        self.status = status
+                elif self.status:
+                    status = self.status    # running status
+                else:
+                    raise MidiFormatError(f"Missing status byte in track {self.track}")
+
+                if status < 0xF0:
+                    kind = status & 0xF0
+                    if kind == 0xC0 or kind == 0xD0:
+                        self.pos += 1
+                        continue
+
+                    data1 = buf[self.pos]
+                    data2 = buf[self.pos + 1]
+                    self.pos += 2
+                    if kind == 0x90:
+                        return (self.tick, 'note_on' if data2 else 'note_off', status & 0x0F, data1, data2)
+                    if kind == 0x80:
+                        return (self.tick, 'note_off', status & 0x0F, data1, data2)
+                    continue
+
+                if status == 0xFF:
+                    self._fill(1)
+                    meta_type = self.buf[self.pos]
+                    self.pos += 1
+                    length = self._varlen()
+                    if meta_type == 0x51 and length == 3:
+                        self._fill(3)
+                        tempo = int.from_bytes(self.buf[self.pos:self.pos + 3], 'big')
+                        self.pos += 3
+                        return (self.tick, 'set_tempo', 0, tempo, 0)
+                    self._skip(length)
+                    if meta_type == 0x2F:
+                        return (self.tick, 'end_of_track', 0, 0, 0)
+                    continue
+
+                if status == 0xF0 or status == 0xF7:
+                    self._skip(self._varlen())
+        except IndexError:
+            # Truncated chunk: treat as the end of the track
+            return None
+
+
+def read_header(path):
+    """(format, track count, division, [(offset, size)] of each track chunk)"""
+    with open(path, 'rb') as f:
+        chunk_id, size = struct.unpack('>4sI', f.read(8) or b'\0' * 8)
+        if chunk_id != b'MThd' or size < 6:
+            raise MidiFormatError("Not a MIDI file")
+        file_format, track_count, division = struct.unpack('>HHh', f.read(6))
+        f.seek(8 + size)
+
+        # Locate the track chunks without reading them
+        tracks = []
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                break
+            chunk_id, size = struct.unpack('>4sI', header)
+            offset = f.tell()
+            if chunk_id == b'MTrk':
+                tracks.append((offset, size))
+            f.seek(offset + size)
+    return file_format, track_count, division, tracks
+
+
+def seconds_per_tick(division, tempo):
+    if division < 0:
+        # SMPTE timing: frames per second * ticks per frame
+        fps = -(division >> 8)
+        return 1.0 / (fps * (division & 0xFF))
+    return tempo / 1e6 / division
+
+
+class MidiStream:
+    """Iterate a MIDI file as merged event tuples without loading it
+
+    `length` holds the song length in seconds once iteration has finished.
+    """
+
+    def __init__(self, path, kinds=PLAYER_KINDS):
+        self.path = path
+        self.kinds = kinds
+        self.length = 0.0
+        self.format, self.track_count, self.division, self.tracks = read_header(path)
+
+    def _seconds_per_tick(self, tempo):
+        return seconds_per_tick(self.division, tempo)
+
+    def __iter__(self):
+        kinds = self.kinds
+        seconds = 0.0
+        last_tick = 0
+        seconds_per_tick = self._seconds_per_tick(DEFAULT_TEMPO)
+
+        with open(self.path, 'rb') as f:
+            cursors = [_TrackCursor(f, offset, size, track)
+                       for track, (offset, size) in enumerate(self.tracks)]
+            heap = []
+            for cursor in cursors:
+                event = cursor.next_event()
+                if event:
+                    heap.append((event[0], cursor.track, event))
+            heapq.heapify(heap)
+
+            while heap:
+                tick, track, event = heap[0]
+                following = cursors[track].next_event()
+                if following:
+                    heapq.heapreplace(heap, (following[0], track, following))
+                else:
+                    heapq.heappop(heap)
+
+                seconds += (tick - last_tick) * seconds_per_tick
+                last_tick = tick
+                kind = event[1]
+                if kind == 'set_tempo':
+                    seconds_per_tick = self._seconds_per_tick(event[3])
+
+                if kind in kinds:
+                    yield (seconds, tick, kind, track, event[2], event[3], event[4])
+
+        self.length = seconds
+
+
+def midi_length(path):
+    """Song length in seconds, from the tempo map alone"""
+    return MidiArrays(path, kinds=()).length
+
+
+def track_note_counts(path):
+    """Number of notes in each track, indexed by track"""
+    return [len(columns['tick']) for columns in MidiArrays(path, kinds=('note_on',)).tracks]
+
+
+# ==================== Array decoding ====================
+
+def decode_track(data, codes=(NOTE_OFF, NOTE_ON), track=0):
+    """Notes and tempos of one track chunk's bytes as arrays
+
+    Returns ({'tick', 'kind', 'channel', 'data1', 'data2'} for the events
+    whose kind code is in `codes`, (tempo ticks, tempos), tick of the last
+    event). Tempos are returned separately even when not in `codes`, since
+    seconds depend on them. Follows _TrackCursor exactly, including where a
+    truncated chunk ends.
+    """
+    ticks, kinds, channels, data1s, data2s = (array.array('q'), array.array('b'), array.array('b'),
+                                              array.array('i'), array.array('i'))
+    tempo_ticks, tempos = array.array('q'), array.array('q')
+    want_on, want_off, want_tempo = NOTE_ON in codes, NOTE_OFF in codes, SET_TEMPO in codes
+    end, pos, tick, running, last_tick = len(data), 0, 0, 0, 0
+
+    try:
+        while pos < end:
+            value = 0
+            while True:
+                byte = data[pos]
+                pos += 1
+                value = (value << 7) | (byte & 0x7F)
+                if byte < 0x80:
+                    break
+            tick += value
+
+            status = data[pos]
+            if status >= 0x80:
+                pos += 1
+                if status < 0xF0:
+                    running = status
+            elif running:
+                status = running
+            else:
+                raise MidiFormatError(f"Missing status byte in track {track}")
+
+            if status < 0xF0:
+                kind = status & 0xF0
+                if kind == 0xC0 or kind == 0xD0:
+                    pos += 1
+                    continue
+                data1 = data[pos]
+                data2 = data[pos + 1]
+                pos += 2
+                if kind == 0x90 or kind == 0x80:
+                    last_tick = tick
+                    on = kind == 0x90 and data2 > 0
+                    if want_on if on else want_off:
+                        ticks.append(tick)
+                        kinds.append(NOTE_ON if on else NOTE_OFF)
+                        channels.append(status & 0x0F)
+                        data1s.append(data1)
+                        data2s.append(data2)
+                continue
+
+            if status == 0xFF:
+                meta_type = data[pos]
+                pos += 1
+                length = 0
+                while True:
+                    byte = data[pos]
+                    pos += 1
+                    length = (length << 7) | (byte & 0x7F)
+                    if byte < 0x80:
+                        break
+                if meta_type == 0x51 and length == 3:
+                    last_tick = tick
+                    tempo = int.from_bytes(data[pos:pos + 3], 'big')
+                    tempo_ticks.append(tick)
+                    tempos.append(tempo)
+                    if want_tempo:
+                        ticks.append(tick)
+                        kinds.append(SET_TEMPO)
+                        channels.append(0)
+                        data1s.append(tempo)
+                        data2s.append(0)
+                elif meta_type == 0x2F:
+                    last_tick = tick
+                pos += length
+                continue
+
+            if status == 0xF0 or status == 0xF7:
+                length = 0
+                while True:
+                    byte = data[pos]
+                    pos += 1
+                    length = (length << 7) | (byte & 0x7F)
+                    if byte < 0x80:
+                        break
+                pos += length
+    except IndexError:
+        # Truncated chunk: treat as the end of the track
+        pass
+
+    columns = {'tick': np.array(ticks, dtype=np.int64), 'kind': np.array(kinds, dtype=np.int8),
+               'channel': np.array(channels, dtype=np.int8), 'data1': np.array(data1s, dtype=np.int64),
+               'data2': np.array(data2s, dtype=np.int64)}
+    return columns, (np.array(tempo_ticks, dtype=np.int64), np.array(tempos, dtype=np.int64)), last_tick
+
+
+def _decode_chunk(path, offset, size, codes, track):
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read(size)
+    return decode_track(data, codes, track)
+
+
+class MidiArrays:
+    """Every track of a MIDI file decoded into arrays
+
+    tracks[i] holds 'tick', 'kind' (KIND_CODES), 'channel', 'data1', 'data2'
+    and 'seconds' arrays for the events of `kinds` in track i, in file order.
+    `length` is the song length in seconds, as MidiStream reports it.
+    """
+
+    def __init__(self, path, kinds=PLAYER_KINDS):
+        self.path = path
+        self.format, self.track_count, self.division, chunks = read_header(path)
+        codes = tuple(KIND_CODES[kind] for kind in kinds if kind in KIND_CODES)
+        self._merged = None
+
+        decoded = [_decode_chunk(path, offset, size, codes, track)
+                   for track, (offset, size) in enumerate(chunks)]
+
+        self._build_tempo_map([tempo for columns, tempo, last in decoded])
+        self.tracks = []
+        for columns, tempo, last in decoded:
+            columns['seconds'] = self.seconds(columns['tick'])
+            self.tracks.append(columns)
+        self.length = float(self.seconds(np.array([max([last for columns, tempo, last in decoded] + [0])]))[0])
+
+    def _build_tempo_map(self, tempo_tracks):
+        """Tempo segments: start tick, seconds at that tick, seconds per tick"""
+        ticks = np.concatenate([np.zeros(1, dtype=np.int64)] + [ticks for ticks, tempos in tempo_tracks])
+        tempos = np.concatenate([np.array([DEFAULT_TEMPO], dtype=np.int64)] +
+                                [tempos for ticks, tempos in tempo_tracks])
+        # Merge order is by tick, then track: the last tempo at a tick wins
+        order = np.argsort(ticks, kind='stable')
+        ticks, tempos = ticks[order], tempos[order]
+        last = np.ones(len(ticks), dtype=bool)
+        last[:-1] = ticks[1:] != ticks[:-1]
+        ticks, tempos = ticks[last], tempos[last]
+
+        if self.division < 0:
+            per_tick = np.full(len(ticks), seconds_per_tick(self.division, DEFAULT_TEMPO))
+        else:
+            per_tick = tempos / 1e6 / self.division
+        starts = np.zeros(len(ticks))
+        starts[1:] = np.cumsum(np.diff(ticks) * per_tick[:-1])
+        self.tempo_ticks, self.tempo_starts, self.tempo_per_tick = ticks, starts, per_tick
+
+    def seconds(self, ticks):
+        """Song seconds at each tick, from the tempo map"""
+        segment = np.searchsorted(self.tempo_ticks, ticks, side='right') - 1
+        return self.tempo_starts[segment] + (ticks - self.tempo_ticks[segment]) * self.tempo_per_tick[segment]
+
+    def merged(self):
+        """All tracks as one timeline with a 'track' column, in MidiStream order"""
+        if self._merged is None:
+            tracks = self.tracks or [dict(decode_track(b'')[0], seconds=np.zeros(0))]
+            merged = {name: np.concatenate([columns[name] for columns in tracks]) for name in tracks[0]}
+            merged['track'] = np.concatenate([np.full(len(columns['tick']), index, dtype=np.int32)
+                                              for index, columns in enumerate(tracks)])
+            # Tracks are concatenated in order, so a stable sort by tick is
+            # the heap merge's (tick, track) order
+            order = np.argsort(merged['tick'], kind='stable')
+            self._merged = {name: column[order] for name, column in merged.items()}
+        return self._merged
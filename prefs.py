@@ -0,0 +1,86 @@
+"""
+Per-song preferences store
+"""
+import copy
+import json
+import os
+import threading
+import time
+
+from library import atomic_write_json
+
+
+class SongPrefs:
+    """Per-song settings keyed by content hash, written behind in batches
+
+    Changes only touch the in-memory dict. A flush is scheduled `delay`
+    seconds after the last change (but never later than `max_delay` after the
+    first unsaved one), and the file is replaced atomically, so a crash
+    leaves either the old or the new file, never a half-written one.
+    """
+
+    def __init__(self, path="song_prefs.json", delay=2.0, max_delay=10.0):
+        self.path = path
+        self.delay = delay
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()    # one flush at a time, in order
+        self._timer = None
+        self._first_change = None
+        self._songs = {}
+
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self._songs = json.load(f)
+        except Exception as e:
+            print(f"Error loading song preferences: {e}")
+
+    def get(self, song_hash):
+        """Saved settings for a song, or an empty dict"""
+        with self._lock:
+            return dict(self._songs.get(song_hash, {}))
+
+    def update(self, song_hash, **values):
+        """Merge values into a song's settings and schedule a flush"""
+        with self._lock:
+            entry = self._songs.setdefault(song_hash, {})
+            changed = {k: v for k, v in values.items() if entry.get(k) != v}
+            if not changed:
+                return
+            entry.update(changed)
+            self._schedule()
+
+    def _schedule(self):
+        now = time.monotonic()
+        if self._first_change is None:
+            self._first_change = now
+        if self._timer:
+            self._timer.cancel()
+
+        delay = min(self.delay, self._first_change + self.max_delay - now)
+        self._timer = threading.Timer(max(0.0, delay), self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def flush(self):
+        """Write pending changes now via write-to-temp and rename
+
+        The write lock is held from the snapshot to the rename, so a timer
+        flush and a flush on exit never share the temp file, and an older
+        snapshot can't replace a newer one.
+        """
+        with self._write_lock:
+            with self._lock:
+                if self._first_change is None:
+                    return
+                if self._timer:
+                    self._timer.cancel()
+                    self._timer = None
+                self._first_change = None
+                data = copy.deepcopy(self._songs)
+
+            try:
+                atomic_write_json(self.path, data)
+            except Exception as e:
+                print(f"Error saving song preferences: {e}")
@@ -0,0 +1,201 @@
+"""
+Audio preview of the compiled key stream
+
+The song is compiled by MidiPlayer exactly as it would be played (layout,
+transposition, skipped notes, quantize, ensemble tracks), and every key
+press is rendered as the note the game would sound. Tones come from a
+per-pitch wavetable of decaying harmonics built with NumPy, mixed into
+fixed-size chunks so memory stays flat however long the song is, and
+written to a WAV file. Renders are cached on disk per song content and
+settings, so switching back to a transposition heard before is instant.
+"""
+import hashlib
+import os
+import wave
+
+import numpy as np
+
+import Player as GZP
+import keymaps
+import library
+import sinks
+
+try:
+    import winsound
+    WINSOUND_AVAILABLE = True
+except ImportError:
+    WINSOUND_AVAILABLE = False
+
+SAMPLE_RATE = 22050
+CHUNK_SECONDS = 5.0
+CACHE_DIR = "preview_cache"
+
+# Renders kept on disk; the least recently used go first
+CACHE_MAX_FILES = 40
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Plucked tone: harmonic amplitudes, decay per second of the fundamental
+HARMONICS = np.array([1.0, 0.5, 0.3, 0.2, 0.12, 0.08])
+DECAY = 3.0
+TONE_SECONDS = 1.5
+ATTACK_SECONDS = 0.004
+RELEASE_SECONDS = 0.05
+GAIN = 0.25
+
+_tones = {}
+
+
+def tone(note, sample_rate=SAMPLE_RATE):
+    """Wavetable for one MIDI note (cached)"""
+    key = (note, sample_rate)
+    table = _tones.get(key)
+    if table is None:
+        t = np.arange(int(TONE_SECONDS * sample_rate)) / sample_rate
+        k = np.arange(1, len(HARMONICS) + 1)[:, None]
+        freq = 440.0 * 2 ** ((note - 69) / 12)
+        partials = HARMONICS[:, None] * np.sin(2 * np.pi * freq * k * t) * np.exp(-DECAY * k ** 0.7 * t)
+        table = partials.sum(axis=0) * np.minimum(1.0, t / ATTACK_SECONDS)
+        table = _tones[key] = (GAIN * table).astype(np.float32)
+    return table
+
+
+def note_spans(events, bpm, profile):
+    """(start, end, note) arrays in seconds at `bpm` from compiled player events
+
+    Mirrors the play loop: a press sounds until its release, or until the
+    same key is struck again.
+    """
+    scale = 120 / bpm
+    held = {}
+    spans = []
+    for song_time, actions in events:
+        now = song_time * scale
+        for part, is_press, chord in actions:
+            start = held.pop((part, chord), None)
+            if start is not None:
+                spans.append((start, now, profile.note(chord)))
+            if is_press:
+                held[(part, chord)] = now
+    for (part, chord), start in held.items():
+        spans.append((start, start + TONE_SECONDS, profile.note(chord)))
+
+    spans.sort()
+    if not spans:
+        return np.zeros(0), np.zeros(0), np.zeros(0, dtype=int)
+    starts, ends, notes = zip(*spans)
+    return np.array(starts), np.array(ends), np.array(notes)
+
+
+def render_chunks(starts, ends, notes, sample_rate=SAMPLE_RATE):
+    """Yield the mix as int16 arrays of CHUNK_SECONDS each"""
+    chunk = int(CHUNK_SECONDS * sample_rate)
+    tone_len = int(TONE_SECONDS * sample_rate)
+    release = int(RELEASE_SECONDS * sample_rate)
+    fade = np.linspace(1.0, 0.0, release, dtype=np.float32)
+
+    start_samples = (starts * sample_rate).astype(np.int64)
+    lengths = np.minimum(tone_len, ((ends - starts) * sample_rate).astype(np.int64) + release)
+    total = int((start_samples + lengths).max()) if len(starts) else 0
+
+    carry = np.zeros(tone_len, dtype=np.float32)
+    first = 0
+    for chunk_start in range(0, total, chunk):
+        buf = np.zeros(chunk + tone_len, dtype=np.float32)
+        buf[:tone_len] += carry
+        last = np.searchsorted(start_samples, chunk_start + chunk)
+        for i in range(first, last):
+            offset = start_samples[i] - chunk_start
+            n = lengths[i]
+            segment = tone(notes[i], sample_rate)[:n]
+            if n < tone_len:
+                segment = segment.copy()
+                segment[-release:] *= fade[-len(segment):] if n < release else fade
+            buf[offset:offset + n] += segment
+        first = last
+
+        carry = buf[chunk:]
+        out = buf[:min(chunk, total - chunk_start)]
+        yield (np.tanh(out) * 32767).astype(np.int16)
+
+
+def write_wav(path, chunks, sample_rate=SAMPLE_RATE):
+    """Stream chunks into a mono 16-bit WAV, replacing `path` atomically"""
+    temp_path = path + ".tmp"
+    with wave.open(temp_path, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        for samples in chunks:
+            f.writeframes(samples.tobytes())
+    os.replace(temp_path, path)
+
+
+def preview_path(file_name, bpm, key_add, allow_out_range, profile, options, cache_dir=CACHE_DIR):
+    song_hash = library.content_hash(GZP.midiPath(file_name))
+    settings = repr((bpm, key_add, allow_out_range, keymaps.get_profile(profile).name,
+                     sorted(options.items()), SAMPLE_RATE))
+    digest = hashlib.sha1((song_hash + settings).encode()).hexdigest()[:20]
+    return os.path.join(cache_dir, digest + ".wav")
+
+
+def render_preview(file_name, bpm, key_add, allow_out_range=False, profile=None,
+                   cache_dir=CACHE_DIR, **options):
+    """Render a song as it would be played and return the WAV path (cached)
+
+    `options` are MidiPlayer keyword options (quantize, track_parts); output
+    sinks are replaced by recorders, so nothing is typed.
+    """
+    options.pop('sinks', None)
+    path = preview_path(file_name, bpm, key_add, allow_out_range, profile, options, cache_dir)
+    if os.path.exists(path):
+        # The mtime is the last use, for eviction
+        os.utime(path)
+        return path
+
+    track_parts = options.get('track_parts')
+    part_count = max(track_parts.values()) + 1 if track_parts else 1
+    player = GZP.MidiPlayer(file_name, bpm, key_add, allow_out_range, profile,
+                            sinks=[sinks.RecordingSink() for _ in range(part_count)], **options)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    write_wav(path, render_chunks(*note_spans(player.events, bpm, player.profile)))
+    prune_cache(cache_dir, keep=path)
+    return path
+
+
+def prune_cache(cache_dir=CACHE_DIR, max_files=CACHE_MAX_FILES, max_bytes=CACHE_MAX_BYTES, keep=None):
+    """Delete the least recently used renders beyond the count and size limits"""
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith(".wav"):
+            path = os.path.join(cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    entries.sort(reverse=True)
+    count = total = 0
+    for mtime, size, path in entries:
+        count += 1
+        total += size
+        if path != keep and (count > max_files or total > max_bytes):
+            try:
+                os.remove(path)
+            except OSError:
+                # Still open for playback: it goes next time
+                pass
+
+
+def play(path):
+    """Play a WAV on the sound device without blocking"""
+    if not WINSOUND_AVAILABLE:
+        return False
+    winsound.PlaySound(path, winsound.SND_FILENAME | winsound.SND_ASYNC)
+    return True
+
+
+def stop():
+    if WINSOUND_AVAILABLE:
+        winsound.PlaySound(None, 0)
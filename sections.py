@@ -0,0 +1,111 @@
+"""
+Per-section transposition
+
+A single shift for the whole song loses entire passages when the song
+modulates or spans more octaves than the layout. Here the song is cut into
+bars, a (bar x shift) matrix of notes that would be dropped is built from
+pitch histograms with NumPy, and dynamic programming picks the shift for
+every bar that minimises dropped notes plus a penalty for each key change.
+The result is a key plan, [(song_seconds, shift), ...], which MidiPlayer
+and the sheet follow.
+"""
+import numpy as np
+
+import keymaps
+import midireader
+
+# Shifts tried, as in Player.KEY_SHIFTS
+SHIFTS = np.arange(-48, 48)
+
+# Dropped notes a key change has to save before it is worth making
+CHANGE_PENALTY = 4.0
+
+# Tie-break towards small shifts, per semitone (well below one note)
+SHIFT_COST = 0.001
+
+# Segment length when the file has no musical time base (SMPTE timing)
+FALLBACK_SEGMENT_SECONDS = 2.0
+
+
+def segment_histograms(path, bars_per_segment=1):
+    """Segment start times and a (segments x 128) note_on histogram, one pass"""
+    stream = midireader.MidiStream(path, kinds=('note_on',))
+    seconds, ticks, notes = [], [], []
+    for event in stream:
+        seconds.append(event[0])
+        ticks.append(event[1])
+        notes.append(event[5])
+
+    if not notes:
+        return np.zeros(0), np.zeros((0, 128))
+    seconds = np.array(seconds)
+    notes = np.array(notes)
+
+    if stream.division > 0:
+        segment = np.array(ticks) // (stream.division * 4 * bars_per_segment)
+    else:
+        segment = (seconds // FALLBACK_SEGMENT_SECONDS).astype(np.int64)
+
+    # Drop empty bars; each segment starts at its first note
+    ids, first, index = np.unique(segment, return_index=True, return_inverse=True)
+    hist = np.bincount(index * 128 + notes, minlength=len(ids) * 128).reshape(len(ids), 128)
+    return seconds[first], hist
+
+
+def cost_matrix(hist, profile=None):
+    """(segments x shifts) notes dropped, plus the small-shift tie-break"""
+    table = keymaps.get_profile(profile).table
+    playable = np.array([chord is not None for chord in table] + [False])
+    targets = np.arange(128)[None, :] + SHIFTS[:, None]
+    targets = np.where((targets >= 0) & (targets < 128), targets, 128)
+    dropped = ~playable[targets]
+    return hist @ dropped.T.astype(float) + SHIFT_COST * np.abs(SHIFTS)[None, :]
+
+
+def solve(cost, penalty=CHANGE_PENALTY):
+    """Shift index per segment minimising total cost plus penalty per change"""
+    segments = len(cost)
+    if not segments:
+        return np.zeros(0, dtype=int)
+    back = np.zeros(cost.shape, dtype=np.int64)
+    best = cost[0].copy()
+    for s in range(1, segments):
+        switch_from = int(np.argmin(best))
+        switch = best[switch_from] + penalty
+        stay = best <= switch
+        back[s] = np.where(stay, np.arange(len(best)), switch_from)
+        best = np.where(stay, best, switch) + cost[s]
+
+    path = np.zeros(segments, dtype=np.int64)
+    path[-1] = int(np.argmin(best))
+    for s in range(segments - 1, 0, -1):
+        path[s - 1] = back[s, path[s]]
+    return path
+
+
+def plan_sections(path, profile=None, penalty=CHANGE_PENALTY, bars_per_segment=1):
+    """Key plan [(song_seconds, shift), ...] and the number of notes it drops"""
+    starts, hist = segment_histograms(path, bars_per_segment)
+    if not len(starts):
+        return [(0.0, 0)], 0
+
+    cost = cost_matrix(hist, profile)
+    choice = solve(cost, penalty)
+    dropped = int(round(cost[np.arange(len(choice)), choice].sum() - SHIFT_COST * np.abs(SHIFTS[choice]).sum()))
+
+    plan = []
+    for start, index in zip(starts, choice):
+        shift = int(SHIFTS[index])
+        if not plan or plan[-1][1] != shift:
+            plan.append((float(start) if plan else 0.0, shift))
+    return plan, dropped
+
+
+def shift_at(plan, song_time):
+    """Shift in force at a song time"""
+    shift = plan[0][1]
+    for start, value in plan:
+        if start > song_time:
+            break
+        shift = value
+    return shift
@@ -0,0 +1,194 @@
+"""
+Similarity and duplicate search over the song library
+
+Every song is reduced to one feature vector:
+
+- a pitch-class histogram, rotated so the song's estimated key is at C,
+  so the same song in another key still matches;
+- a histogram of melodic intervals between successive onsets, taking the
+  highest note of each chord as the melody;
+- an onset-density profile over the song's length, so arrangements at a
+  different tempo line up.
+
+Each part is normalised, and the whole vector is scaled to unit length. The
+library is then one float32 matrix, and cosine similarity against every song
+is a single matrix-vector product. The index is saved as .npz next to the
+library index. update() only extracts features for files whose size or mtime
+changed, and reuses the vector of a file that was only renamed.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import compiler
+import library
+
+INDEX_FILE = "similarity_index.npz"
+
+INTERVAL_RANGE = 12     # intervals are clipped to +-this many semitones
+DENSITY_BINS = 32
+FEATURE_SIZE = 12 + 2 * INTERVAL_RANGE + 1 + DENSITY_BINS
+
+# Scores at or above this count as the same song
+DUPLICATE_THRESHOLD = 0.97
+
+# Rows compared at a time in the duplicate search
+DUPLICATE_BLOCK = 1024
+
+# Files to extract before a process pool is worth starting
+POOL_MIN_FILES = 8
+
+# Krumhansl-Kessler major key profile, C first
+MAJOR_PROFILE = np.array([6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88])
+
+
+def _unit(vector):
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def features(path):
+    """Unit-length float32 feature vector of a MIDI file"""
+    columns, length = compiler.parse(path)
+    starts = columns['kind'] == compiler.NOTE_ON
+    times, notes = columns['time'][starts], columns['data'][starts]
+    vector = np.zeros(FEATURE_SIZE, dtype=np.float64)
+    if not len(notes):
+        return vector.astype(np.float32)
+
+    # Pitch classes, rotated so the best-matching major key is at 0
+    classes = np.bincount(notes % 12, minlength=12).astype(np.float64)
+    profiles = np.array([np.roll(MAJOR_PROFILE, shift) for shift in range(12)])
+    tonic = int(np.argmax(profiles @ classes))
+    pitch = np.roll(classes, -tonic)
+
+    # Melody intervals: highest note per onset, then successive differences
+    onsets, inverse = np.unique(times, return_inverse=True)
+    melody = np.full(len(onsets), -1, dtype=np.int64)
+    np.maximum.at(melody, inverse, notes)
+    steps = np.clip(np.diff(melody), -INTERVAL_RANGE, INTERVAL_RANGE) + INTERVAL_RANGE
+    intervals = np.bincount(steps, minlength=2 * INTERVAL_RANGE + 1).astype(np.float64)
+
+    # Onsets per slice of the song
+    bins = np.minimum((onsets / max(length, 1e-9) * DENSITY_BINS).astype(np.int64), DENSITY_BINS - 1)
+    density = np.bincount(bins, minlength=DENSITY_BINS).astype(np.float64)
+
+    vector = np.concatenate((_unit(pitch), _unit(intervals), _unit(density)))
+    return _unit(vector).astype(np.float32)
+
+
+def _features_or_none(path):
+    try:
+        return features(path)
+    except Exception:
+        return None
+
+
+class SimilarityIndex:
+    """Feature matrix of the library with nearest-neighbour queries"""
+
+    def __init__(self, names=(), hashes=(), stamps=None, matrix=None):
+        self.names = list(names)
+        self.hashes = list(hashes)
+        self.stamps = np.zeros((0, 2), dtype=np.int64) if stamps is None else stamps
+        self.matrix = np.zeros((0, FEATURE_SIZE), dtype=np.float32) if matrix is None else matrix
+        self._rows = {name: row for row, name in enumerate(self.names)}
+
+    @classmethod
+    def load(cls, path=INDEX_FILE):
+        try:
+            if os.path.exists(path):
+                with np.load(path) as data:
+                    if data['matrix'].shape[1] == FEATURE_SIZE:
+                        return cls(data['names'].tolist(), data['hashes'].tolist(),
+                                   data['stamps'], data['matrix'])
+        except Exception as e:
+            print(f"Error loading similarity index: {e}")
+        return cls()
+
+    def save(self, path=INDEX_FILE):
+        temp_path = path + ".tmp.npz"
+        np.savez(temp_path, names=np.array(self.names, dtype=str), hashes=np.array(self.hashes, dtype=str),
+                 stamps=self.stamps, matrix=self.matrix)
+        os.replace(temp_path, path)
+
+    def __len__(self):
+        return len(self.names)
+
+    def update(self, repo_dir, path_for=None, workers=None):
+        """Bring the index in line with the files in `repo_dir`
+
+        Returns the number of files whose features were extracted.
+        """
+        path_for = path_for or (lambda name: os.path.join(repo_dir, name))
+        names = sorted(name for name in os.listdir(repo_dir) if library.is_midi_name(name))
+        by_hash = {digest: row for row, digest in enumerate(self.hashes)}
+
+        rows, hashes, stamps, missing = [], [], [], []
+        for name in names:
+            path = path_for(name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            stamp = (stat.st_mtime_ns, stat.st_size)
+            row = self._rows.get(name)
+            if row is not None and tuple(self.stamps[row]) == stamp:
+                digest = self.hashes[row]
+            else:
+                digest = library.content_hash(path)
+                row = by_hash.get(digest)
+            rows.append(row)
+            hashes.append(digest)
+            stamps.append(stamp)
+            if row is None:
+                missing.append(len(rows) - 1)
+
+        # Extract what's new, in parallel when there is enough of it
+        paths = [path_for(names[i]) for i in missing]
+        if len(paths) >= POOL_MIN_FILES:
+            with ProcessPoolExecutor(max_workers=workers or min(8, os.cpu_count() or 1)) as pool:
+                vectors = list(pool.map(_features_or_none, paths, chunksize=4))
+        else:
+            vectors = [_features_or_none(path) for path in paths]
+        new = dict(zip(missing, vectors))
+
+        keep = [i for i in range(len(names)) if i not in new or new[i] is not None]
+        matrix = np.zeros((len(keep), FEATURE_SIZE), dtype=np.float32)
+        for out, i in enumerate(keep):
+            matrix[out] = new[i] if i in new else self.matrix[rows[i]]
+
+        self.names = [names[i] for i in keep]
+        self.hashes = [hashes[i] for i in keep]
+        self.stamps = np.array([stamps[i] for i in keep], dtype=np.int64).reshape(-1, 2)
+        self.matrix = matrix
+        self._rows = {name: row for row, name in enumerate(self.names)}
+        return len(missing)
+
+    def similar(self, name, count=10):
+        """[(name, score)] of the `count` songs most like `name`, best first"""
+        row = self._rows.get(name)
+        if row is None:
+            return []
+        scores = self.matrix @ self.matrix[row]
+        scores[row] = -np.inf
+        count = min(count, len(scores) - 1)
+        if count <= 0:
+            return []
+        best = np.argpartition(-scores, count - 1)[:count]
+        best = best[np.argsort(-scores[best])]
+        return [(self.names[i], float(scores[i])) for i in best]
+
+    def duplicates(self, threshold=DUPLICATE_THRESHOLD):
+        """[(name, name, score)] of every pair scoring at least `threshold`, best first"""
+        pairs = []
+        for start in range(0, len(self.names), DUPLICATE_BLOCK):
+            block = self.matrix[start:start + DUPLICATE_BLOCK] @ self.matrix.T
+            rows, columns = np.nonzero(block >= threshold)
+            # Each pair once, and never a song with itself
+            upper = columns > rows + start
+            for row, column in zip(rows[upper].tolist(), columns[upper].tolist()):
+                pairs.append((self.names[start + row], self.names[column], float(block[row, column])))
+        pairs.sort(key=lambda pair: -pair[2])
+        return pairs
@@ -0,0 +1,152 @@
+"""
+Output sinks for key events
+
+A sink receives batches of (chord, is_press) actions, one batch per
+scheduler tick. Chords are (modifiers, key) tuples from keymaps.
+"""
+import ctypes
+import time
+
+# SendInput related definitions
+PUL = ctypes.POINTER(ctypes.c_ulong)
+
+class KeyBdInput(ctypes.Structure):
+    _fields_ = [("wVk", ctypes.c_ushort),
+                ("wScan", ctypes.c_ushort),
+                ("dwFlags", ctypes.c_ulong),
+                ("time", ctypes.c_ulong),
+                ("dwExtraInfo", PUL)]
+
+class HardwareInput(ctypes.Structure):
+    _fields_ = [("uMsg", ctypes.c_ulong),
+                ("wParamL", ctypes.c_short),
+                ("wParamH", ctypes.c_ushort)]
+
+class MouseInput(ctypes.Structure):
+    _fields_ = [("dx", ctypes.c_long),
+                ("dy", ctypes.c_long),
+                ("mouseData", ctypes.c_ulong),
+                ("dwFlags", ctypes.c_ulong),
+                ("time",ctypes.c_ulong),
+                ("dwExtraInfo", PUL)]
+
+class Input_I(ctypes.Union):
+    _fields_ = [("ki", KeyBdInput),
+                ("mi", MouseInput),
+                ("hi", HardwareInput)]
+
+class Input(ctypes.Structure):
+    _fields_ = [("type", ctypes.c_ulong),
+                ("ii", Input_I)]
+
+INPUT_KEYBOARD = 1
+KEYEVENTF_KEYUP = 0x0002
+WM_KEYDOWN = 0x0100
+WM_KEYUP = 0x0101
+MODIFIER_VK = {'shift': 0x10, 'ctrl': 0x11, 'alt': 0x12}
+
+
+def chord_strokes(chord, is_press):
+    """(virtual key, is_down) strokes that press or release a chord
+
+    Modifiers are held only around the key press itself, so a Shift for
+    one sharp never leaks onto other keys that are still sounding.
+    """
+    modifiers, key = chord
+    vk_code = ord(key.upper())
+    if not is_press:
+        return [(vk_code, False)]
+
+    return ([(MODIFIER_VK[m], True) for m in modifiers] + [(vk_code, True)] +
+            [(MODIFIER_VK[m], False) for m in reversed(modifiers)])
+
+
+def batch_strokes(actions):
+    strokes = []
+    for chord, is_press in actions:
+        strokes.extend(chord_strokes(chord, is_press))
+    return strokes
+
+
+class SendInputSink:
+    """Types into whichever window has focus, one SendInput call per batch"""
+
+    # Whether the target sees Shift/Ctrl held around a key
+    supports_modifiers = True
+
+    def __init__(self):
+        self.SendInput = ctypes.windll.user32.SendInput
+        self.MapVirtualKey = ctypes.windll.user32.MapVirtualKeyW
+        self._scan_codes = {}
+
+    def _scan_code(self, vk_code):
+        scan_code = self._scan_codes.get(vk_code)
+        if scan_code is None:
+            scan_code = self._scan_codes[vk_code] = self.MapVirtualKey(vk_code, 0)
+        return scan_code
+
+    def write(self, actions):
+        strokes = batch_strokes(actions)
+        if not strokes:
+            return
+
+        extra = ctypes.c_ulong(0)
+        inputs = (Input * len(strokes))()
+        for i, (vk_code, is_down) in enumerate(strokes):
+            flags = 0 if is_down else KEYEVENTF_KEYUP
+            inputs[i].type = INPUT_KEYBOARD
+            inputs[i].ii.ki = KeyBdInput(vk_code, self._scan_code(vk_code), flags, 0, ctypes.pointer(extra))
+
+        self.SendInput(len(strokes), inputs, ctypes.sizeof(Input))
+
+
+class WindowSink(SendInputSink):
+    """Posts key messages to one window, focused or not
+
+    Used for ensemble play with several game windows. Modifier state is not
+    seen by the target through posted messages, so a sharp would sound as
+    the natural below it: layouts with modifier chords can't use this sink.
+    """
+    supports_modifiers = False
+
+    def __init__(self, hwnd):
+        super().__init__()
+        self.hwnd = hwnd
+        self.PostMessage = ctypes.windll.user32.PostMessageW
+
+    def write(self, actions):
+        for vk_code, is_down in batch_strokes(actions):
+            lparam = 1 | (self._scan_code(vk_code) << 16)
+            if is_down:
+                self.PostMessage(self.hwnd, WM_KEYDOWN, vk_code, lparam)
+            else:
+                lparam |= 0xC0000000
+                self.PostMessage(self.hwnd, WM_KEYUP, vk_code, lparam)
+
+
+class RecordingSink:
+    """Keeps every batch with the time it was written, for testing"""
+    supports_modifiers = True
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.batches = []
+
+    def write(self, actions):
+        if actions:
+            self.batches.append((self.clock(), list(actions)))
+
+
+def find_windows(title):
+    """Handles of all visible top-level windows with the given title"""
+    import win32gui
+
+    handles = []
+
+    def collect(hwnd, _):
+        if win32gui.IsWindowVisible(hwnd) and win32gui.GetWindowText(hwnd) == title:
+            handles.append(hwnd)
+        return True
+
+    win32gui.EnumWindows(collect, None)
+    return handles
@@ -0,0 +1,191 @@
+"""
+Stall monitor for the GUI thread
+
+The GUI beats a heartbeat from a QTimer every HEARTBEAT seconds; how late
+each beat arrives is the event loop's latency. A helper thread sleeps until
+the next beat is overdue by THRESHOLD, so it wakes about once per beat and
+never while the heartbeat is paused (the app in the background). Once a beat
+is overdue it samples the GUI thread's stack with sys._current_frames()
+every SAMPLE_INTERVAL until the loop beats again, then logs the stall: its
+length and the stacks it was sampled in most often, each with the time
+spent there. The log is a rotating file, so it can be attached to a bug
+report as is.
+
+Samples only land when the GUI thread lets go of the GIL, which pure-Python
+stalls do every few milliseconds; a stall inside one long C call shows up
+as a single stack.
+"""
+import collections
+import logging
+import logging.handlers
+import os
+import sys
+import threading
+import time
+
+LOG_FILE = "stalls.log"
+LOG_BYTES = 512 * 1024
+LOG_BACKUPS = 2
+
+HEARTBEAT = 0.25            # seconds between beats
+THRESHOLD = 0.2             # a beat this late starts sampling
+SAMPLE_INTERVAL = 0.005
+STACK_DEPTH = 40            # innermost frames kept per sample
+HOT_STACKS = 5              # stacks logged per stall
+RECENT = 10                 # stalls kept for the overlay
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+Stall = collections.namedtuple('Stall', ['at', 'duration', 'samples', 'stacks', 'where'])
+
+
+def _stack(frame):
+    """(file, line, function) tuples of a frame's stack, outermost first"""
+    stack = []
+    while frame is not None and len(stack) < STACK_DEPTH:
+        code = frame.f_code
+        stack.append((code.co_filename, frame.f_lineno, code.co_name))
+        frame = frame.f_back
+    return tuple(reversed(stack))
+
+
+def _where(stack):
+    """Innermost frame of our own code in a stack, as 'function (file:line)'"""
+    for filename, line, name in reversed(stack):
+        if os.path.dirname(os.path.abspath(filename)) == PACKAGE_DIR:
+            break
+    else:
+        if not stack:
+            return "?"
+        filename, line, name = stack[-1]
+    return f"{name} ({os.path.basename(filename)}:{line})"
+
+
+def format_stall(stall):
+    """Stall as log lines: a summary, then its hot stacks"""
+    lines = [f"Stall of {stall.duration * 1000:.0f} ms at {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stall.at))}"
+             f" in {stall.where}, {stall.samples} samples"]
+    per_sample = stall.duration / stall.samples if stall.samples else 0.0
+    for count, stack in stall.stacks:
+        lines.append(f"  {count * per_sample * 1000:.0f} ms ({count} samples):")
+        for filename, line, name in stack:
+            lines.append(f"    {name} ({filename}:{line})")
+    return lines
+
+
+class StallMonitor:
+    """Heartbeat latency and sampled stacks of GUI thread stalls"""
+
+    def __init__(self, log_file=LOG_FILE, heartbeat=HEARTBEAT, threshold=THRESHOLD,
+                 sample_interval=SAMPLE_INTERVAL):
+        self.heartbeat = heartbeat
+        self.threshold = threshold
+        self.sample_interval = sample_interval
+        self.thread_id = threading.get_ident()
+        self.recent = collections.deque(maxlen=RECENT)
+        self.stalls = 0
+        self.latency_last = 0.0
+        self.latency_max = 0.0
+
+        self._cond = threading.Condition()
+        self._beat_at = time.perf_counter()
+        self._active = False
+        self._stopping = False
+        self._thread = None
+
+        self._log = logging.getLogger(f"stalls.{id(self)}")
+        self._log.propagate = False
+        self._log.setLevel(logging.INFO)
+        self._handler = None
+        if log_file:
+            try:
+                self._handler = logging.handlers.RotatingFileHandler(
+                    log_file, maxBytes=LOG_BYTES, backupCount=LOG_BACKUPS, encoding='utf-8', delay=True)
+                self._log.addHandler(self._handler)
+            except OSError as e:
+                print(f"❌ Stall log unavailable: {e}")
+
+    def start(self):
+        """Start watching beats from the calling (GUI) thread"""
+        self.thread_id = threading.get_ident()
+        self._thread = threading.Thread(target=self._run, name="StallMonitor", daemon=True)
+        self._thread.start()
+        self.resume()
+
+    def beat(self):
+        """Called by the heartbeat timer on the GUI thread"""
+        now = time.perf_counter()
+        latency = max(0.0, now - self._beat_at - self.heartbeat)
+        self.latency_last = latency
+        self.latency_max = max(self.latency_max, latency)
+        # A single float store: the helper thread reads it without a lock
+        self._beat_at = now
+
+    def resume(self):
+        """The heartbeat is running (again)"""
+        with self._cond:
+            self._beat_at = time.perf_counter()
+            self._active = True
+            self._cond.notify_all()
+
+    def pause(self):
+        """The heartbeat is stopped: stop expecting beats"""
+        with self._cond:
+            self._active = False
+            self._cond.notify_all()
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join()
+        if self._handler:
+            self._log.removeHandler(self._handler)
+            self._handler.close()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._active or self._stopping)
+                if self._stopping:
+                    return
+                beat_at = self._beat_at
+                overdue = time.perf_counter() - (beat_at + self.heartbeat + self.threshold)
+                if overdue < 0:
+                    self._cond.wait(-overdue)
+                    continue
+            self._sample(beat_at)
+
+    def _sample(self, beat_at):
+        """Sample the GUI thread's stack until it beats again"""
+        stacks = collections.Counter()
+        samples = 0
+        while self._beat_at == beat_at and self._active and not self._stopping:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                stacks[_stack(frame)] += 1
+                samples += 1
+            del frame
+            time.sleep(self.sample_interval)
+        duration = (self._beat_at if self._beat_at != beat_at else time.perf_counter()) - beat_at - self.heartbeat
+        self._record(duration, samples, stacks)
+
+    def _record(self, duration, samples, stacks):
+        hot = [(count, stack) for stack, count in stacks.most_common(HOT_STACKS)]
+        stall = Stall(time.time(), duration, samples, hot, _where(hot[0][1]) if hot else "?")
+        self.stalls += 1
+        self.recent.append(stall)
+        try:
+            self._log.info("\n".join(format_stall(stall)))
+        except Exception as e:
+            print(f"❌ Error logging stall: {e}")
+
+    def format_recent(self, count=3):
+        """Overlay text: totals, then the latest stalls, newest first"""
+        lines = [f"Stalls: {self.stalls} · beat latency last {self.latency_last * 1000:.0f} ms,"
+                 f" max {self.latency_max * 1000:.0f} ms"]
+        for stall in list(self.recent)[::-1][:count]:
+            lines.append(f"    {time.strftime('%H:%M:%S', time.localtime(stall.at))}"
+                         f" {stall.duration * 1000:.0f} ms in {stall.where}")
+        return "\n".join(lines)
@@ -1,60 +1,331 @@
 """
 Thread classes for MIDI playback
 """
-from PyQt5.QtCore import QThread, pyqtSignal
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from PyQt5.QtCore import QObject, QThread, pyqtSignal
 import Player as GZP
+import commandbus
+import diagnostics
+import library
+import thumbnails
 import win32gui
 
+GAME_WINDOW_TITLE = "逆水寒手游桌面版"
+
 
 class PlaybackThread(QThread):
-    """Background thread for MIDI playback"""
+    """Long-lived background worker for MIDI playback
+
+    The thread is started once and then blocks on a command queue, so it costs
+    nothing while idle. Playback is two-phase: arm() queues the expensive work
+    (parsing, compiling the schedule, finding the game window) and leaves the
+    worker parked on an event; fire() only sets that event, so the song clock
+    starts at the instant of the hotkey. The player decodes on a pipeline, so
+    arming only waits for the first few seconds of the song. Pause, resume, seek and BPM changes are
+    posted to a commandbus.CommandBus that the playing song drains as soon as
+    it wakes, and paused_signal reports when a pause or resume took effect.
+    stop() acts at once: every request carries the generation it was issued
+    in, and stop() bumps the generation so anything queued or armed before
+    it is dropped.
+    """
     progress_signal = pyqtSignal(float, float)
+    started_signal = pyqtSignal(float)
+    paused_signal = pyqtSignal(bool)
+    armed_signal = pyqtSignal()
     finished_signal = pyqtSignal()
     note_played_signal = pyqtSignal(str)
     error_signal = pyqtSignal(str)
-    
-    def __init__(self, file_name, keyadd, bpm, allow_out_range):
+
+    def __init__(self):
         super().__init__()
-        self.file_name = file_name
-        self.keyadd = keyadd
-        self.bpm = bpm
-        self.allow_out_range = allow_out_range
+        self.commands = queue.Queue()
         self.player = None
+        self.bpm = 120
+        self.start_delay = 0
+        self.armed = False
+        self.playing = False
+        self.start_latency = 0.0
+        self.bus = commandbus.CommandBus()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._release = threading.Event()
+        self._fired_at = None
+        self._pressed_at = None
+        self._hwnd = None
         
+        # Optional clocksync.SyncLeader told about every start and stop
+        self.sync_leader = None
+
     def run(self):
+        while True:
+            command, args, generation = self.commands.get()
+            diagnostics.wakeup("playback thread")
+            if command == 'quit':
+                break
+
+            with self._lock:
+                if generation != self._generation:
+                    continue
+
+            try:
+                if command == 'arm':
+                    self._arm(generation, *args)
+            except Exception as e:
+                self.error_signal.emit(str(e))
+
+    def _game_window(self):
+        """Resolve the game window once and reuse it while it stays valid"""
+        if not (self._hwnd and win32gui.IsWindow(self._hwnd)):
+            self._hwnd = win32gui.FindWindow(None, GAME_WINDOW_TITLE)
+        return self._hwnd
+
+    def _arm(self, generation, file_name, keyadd, allow_out_range, profile, options):
+        # Decode on a pipeline so arming takes the same time for any file size
+        player = GZP.MidiPlayer(file_name, self.bpm, keyadd, allow_out_range, profile,
+                                pipelined=True, bus=self.bus, **options)
         try:
-            # Activate game window
-            hwnd = win32gui.FindWindow(None, "逆水寒手游桌面版")
-            if hwnd:
-                win32gui.SetForegroundWindow(hwnd)
-                win32gui.SetActiveWindow(hwnd)
-            
-            # Create player instance
-            self.player = GZP.MidiPlayer(self.file_name, self.bpm, self.keyadd, self.allow_out_range)
-            
-            # Play with callbacks
-            self.player.play(
+            player.wait_prebuffered()
+            hwnd = self._game_window()
+        except Exception:
+            player.stop()
+            raise
+
+        with self._lock:
+            if generation != self._generation:
+                # Re-armed meanwhile: end this player's decoder thread
+                player.stop()
+                return
+            self.player = player
+            self.armed = True
+            release = self._release
+        player.set_bpm(self.bpm)
+        self.armed_signal.emit()
+
+        # Park until fire() or stop()
+        release.wait()
+
+        with self._lock:
+            self.armed = False
+            fired_at = self._fired_at
+            if generation != self._generation or fired_at is None:
+                player.stop()
+                return
+
+        self.start_latency = time.perf_counter() - self._pressed_at
+
+        # Activate game window
+        if hwnd and win32gui.GetForegroundWindow() != hwnd:
+            win32gui.SetForegroundWindow(hwnd)
+            win32gui.SetActiveWindow(hwnd)
+
+        self.started_signal.emit(self.start_delay)
+
+        # Play with callbacks, with song time zero at the hotkey plus countdown
+        self.playing = True
+        try:
+            player.play(
                 progress_callback=self.progress_signal.emit,
-                note_callback=self.note_played_signal.emit
+                note_callback=self.note_played_signal.emit,
+                start_at=fired_at,
+                pause_callback=self.paused_signal.emit
             )
-            
+        finally:
+            self.playing = False
+
+        if player.underruns:
+            print(f"[DEBUG] Decoder underruns: {player.underruns}")
+        
+        if self.sync_leader and self.sync_leader.position_source:
+            self.sync_leader.announce_stop()
+        if player.decode_error:
+            self.error_signal.emit(f"Failed to load MIDI: {player.decode_error}")
+        else:
             self.finished_signal.emit()
-        except Exception as e:
-            self.error_signal.emit(str(e))
-    
-    def pause(self):
-        if self.player:
-            self.player.pause()
-    
-    def resume(self):
+
+    def arm(self, file_name, keyadd, allow_out_range, profile=None, **options):
+        """Prepare a song and wait for fire(); replaces any previous arm
+
+        Extra keyword options are passed on to MidiPlayer.
+        """
+        with self._lock:
+            if self.armed and self.player:
+                # Its decoder would otherwise block on a full ring for good
+                self.player.stop()
+            self._generation += 1
+            self._release.set()
+            self._release = threading.Event()
+            self._fired_at = None
+            self.commands.put(('arm', (file_name, keyadd, allow_out_range, profile, options), self._generation))
+
+    def fire(self, start_at=None, pressed_at=None):
+        """Release the armed song; safe to call from any thread
+
+        Song time zero is `start_at` (a perf_counter() time, used by sync
+        followers) or now plus the countdown. `pressed_at` is when the
+        hotkey was pressed, if that was before this call. Returns False when
+        nothing is armed, e.g. while the song is still being prepared or is
+        already playing.
+        """
+        pressed_at = time.perf_counter() if pressed_at is None else pressed_at
+        with self._lock:
+            if not self.armed or self._fired_at is not None:
+                return False
+            self._pressed_at = pressed_at
+            self._fired_at = pressed_at + self.start_delay if start_at is None else start_at
+            self._release.set()
+            fired_at = self._fired_at
+
+        if self.sync_leader:
+            self.sync_leader.announce_start(fired_at, self.position)
+        return True
+
+    def toggle(self, source='gui', pressed_at=None, start_at=None):
+        """Start the armed song, or pause/resume the playing one
+
+        Safe to call from any thread, e.g. straight from a hotkey hook.
+        `start_at` is as for fire(). Repeated presses within
+        commandbus.DEBOUNCE are swallowed. Returns 'started', 'toggled' or
+        'repeat', or None when there is nothing to start or pause yet.
+        """
+        pressed_at = time.perf_counter() if pressed_at is None else pressed_at
+        if self.bus.repeated('toggle', (), source, pressed_at):
+            return 'repeat'
+        if self.fire(start_at, pressed_at):
+            return 'started'
+        if not self.playing:
+            return None
+        self.bus.push('toggle', source=source, posted_at=pressed_at)
+        return 'toggled'
+
+    def command_stats(self):
+        """Latency and debounce counts of commands, see CommandBus.stats()"""
+        return self.bus.stats()
+
+    def position(self, now=None):
+        """Current song position, or None when nothing is playing"""
+        player = self.player
+        if not player or self.armed:
+            return None
+        return player.position(now)
+
+    def current_bpm(self):
+        """BPM being played right now, part way through a ramp if one is running"""
+        player = self.player
+        if not player or self.armed:
+            return self.bpm
+        return player.current_bpm()
+
+    def slew(self, error):
         if self.player:
-            self.player.resume()
-    
+            self.player.slew(error)
+
+    def pause(self, source='gui'):
+        self.bus.post('pause', source=source)
+
+    def resume(self, source='gui'):
+        self.bus.post('resume', source=source)
+
+    def seek(self, seconds, source='gui'):
+        self.bus.post('seek', seconds, source=source)
+
     def stop(self):
-        if self.player:
-            self.player.stop()
-        self.terminate()
-    
-    def set_bpm(self, new_bpm):
-        if self.player:
-            self.player.set_bpm(new_bpm)
\ No newline at end of file
+        """Disarm, cancel queued requests and stop the current song"""
+        with self._lock:
+            self._generation += 1
+            self._release.set()
+            player = self.player
+        if player:
+            player.stop()
+        if self.sync_leader and self.sync_leader.position_source:
+            self.sync_leader.announce_stop()
+
+    def set_bpm(self, new_bpm, source='gui', over=0.0):
+        """Change BPM, ramping to it over `over` song seconds while playing"""
+        self.bpm = new_bpm
+        if self.playing:
+            self.bus.post('bpm', new_bpm, over, source=source)
+        elif self.player:
+            # An armed song doesn't drain the bus until it starts
+            self.player.set_bpm(new_bpm)
+
+    def shutdown(self):
+        """Stop playback and end the worker thread"""
+        self.stop()
+        self.commands.put(('quit', (), None))
+        self.wait()
+
+
+class ImportThread(QThread):
+    """Runs a bulk library import off the GUI thread"""
+    progress_signal = pyqtSignal(int, int)
+    finished_signal = pyqtSignal(object)
+    error_signal = pyqtSignal(str)
+
+    def __init__(self, paths, repo_dir, profile=None):
+        super().__init__()
+        self.paths = paths
+        self.repo_dir = repo_dir
+        self.profile = profile
+
+    def run(self):
+        try:
+            summary = library.import_sources(self.paths, self.repo_dir, self.profile,
+                                             progress=self.progress_signal.emit)
+            self.finished_signal.emit(summary)
+        except Exception as e:
+            self.error_signal.emit(str(e))
+
+
+class IndexThread(QThread):
+    """Brings the similarity index up to date and saves it, off the GUI thread"""
+    finished_signal = pyqtSignal(int)
+    error_signal = pyqtSignal(str)
+
+    def __init__(self, index, repo_dir):
+        super().__init__()
+        self.index = index
+        self.repo_dir = repo_dir
+
+    def run(self):
+        try:
+            extracted = self.index.update(self.repo_dir, GZP.midiPath)
+            self.index.save()
+            self.finished_signal.emit(extracted)
+        except Exception as e:
+            self.error_signal.emit(str(e))
+
+
+class ThumbnailLoader(QObject):
+    """Renders song thumbnails in a small process pool
+
+    request() never blocks: it queues the song (once) and ready_signal
+    delivers (name, grid) on the GUI thread when the worker is done.
+    """
+    ready_signal = pyqtSignal(str, object)
+
+    def __init__(self, workers=2):
+        super().__init__()
+        self.pool = ProcessPoolExecutor(max_workers=workers)
+        self.pending = set()
+        self.closed = False
+
+    def request(self, name, path):
+        if name in self.pending or self.closed:
+            return
+        self.pending.add(name)
+        future = self.pool.submit(thumbnails.load_thumbnail, name, path)
+        future.add_done_callback(lambda f, name=name: self._done(name, f))
+
+    def _done(self, name, future):
+        self.pending.discard(name)
+        if future.cancelled() or future.exception():
+            return
+        self.ready_signal.emit(*future.result())
+
+    def shutdown(self):
+        self.closed = True
+        self.pool.shutdown(wait=False, cancel_futures=True)
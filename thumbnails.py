@@ -0,0 +1,95 @@
+"""
+Piano-roll thumbnails for the song list
+
+A thumbnail is a small (pitch x time) intensity grid: every note is binned
+into the columns it spans with NumPy difference arrays, so rendering costs
+one pass over the file plus a few array operations. Grids are cached on disk
+as .npy files named by content hash and tinted into images by the GUI, so
+they follow the theme without re-rendering.
+"""
+import os
+import tempfile
+
+import numpy as np
+
+import library
+import midireader
+
+THUMB_WIDTH = 96
+THUMB_HEIGHT = 24
+CACHE_DIR = "thumb_cache"
+
+
+def note_spans(path):
+    """(start, end, note) arrays of every note in song seconds"""
+    stream = midireader.MidiStream(path, kinds=midireader.NOTE_KINDS)
+    sounding = {}
+    spans = []
+    for song_time, tick, kind, track, channel, note, velocity in stream:
+        source = (track, channel, note)
+        if kind == 'note_on':
+            sounding.setdefault(source, []).append(song_time)
+        elif sounding.get(source):
+            spans.append((sounding[source].pop(0), song_time, note))
+    for (track, channel, note), starts in sounding.items():
+        spans.extend((start, stream.length, note) for start in starts)
+
+    if not spans:
+        return np.zeros(0), np.zeros(0), np.zeros(0, dtype=np.int64)
+    starts, ends, notes = np.array(spans).T
+    return starts, ends, notes.astype(np.int64)
+
+
+def render_grid(path, width=THUMB_WIDTH, height=THUMB_HEIGHT):
+    """uint8 (height x width) piano roll, high notes at the top"""
+    starts, ends, notes = note_spans(path)
+    grid = np.zeros((height, width), dtype=np.uint8)
+    if not len(notes):
+        return grid
+
+    length = max(ends.max(), 1e-9)
+    x0 = np.clip((starts / length * width).astype(np.int64), 0, width - 1)
+    x1 = np.clip((ends / length * width).astype(np.int64), x0, width - 1)
+
+    low, high = notes.min(), notes.max()
+    span = max(high - low, height - 1)
+    centre = (low + high - span) / 2
+    y = np.clip(((notes - centre) / span * (height - 1)).round().astype(np.int64), 0, height - 1)
+    y = height - 1 - y
+
+    # +1 where a note starts, -1 after it ends, then a running sum per row
+    diff = np.zeros((height, width + 1), dtype=np.int32)
+    np.add.at(diff, (y, x0), 1)
+    np.add.at(diff, (y, x1 + 1), -1)
+    counts = np.cumsum(diff, axis=1)[:, :width]
+
+    scale = max(np.percentile(counts[counts > 0], 90), 1) if counts.any() else 1
+    return (np.minimum(counts / scale, 1.0) * 255).astype(np.uint8)
+
+
+def load_thumbnail(name, path, cache_dir=CACHE_DIR):
+    """(name, grid) for a song, from the cache or freshly rendered
+
+    Runs in worker processes; `name` is passed through for the caller.
+    """
+    cache_path = os.path.join(cache_dir, library.content_hash(path) + ".npy")
+    try:
+        return name, np.load(cache_path)
+    except (OSError, ValueError):
+        pass
+
+    grid = render_grid(path)
+    os.makedirs(cache_dir, exist_ok=True)
+    # A temp file of its own: two workers may render the same content at once
+    fd, temp_path = tempfile.mkstemp(suffix=".tmp.npy", dir=cache_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, grid)
+        os.replace(temp_path, cache_path)
+    except OSError:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+    return name, grid
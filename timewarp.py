@@ -0,0 +1,186 @@
+"""
+Song time to wall time, with smooth tempo ramps
+
+Song seconds already follow the file's own tempo map (see midireader), so
+playing at "120 BPM" in player units plays a file exactly as written. On
+top of that the player applies a user rate: a BPM in those units that is
+either constant or ramps linearly in song time (an accelerando or
+ritardando to a target over a number of bars). TimeWarp holds that rate as
+a list of precomputed segments and converts between song and wall seconds
+in O(1) per lookup, since playback only ever moves forward through them.
+
+TempoMap reads the file's tempo map itself, so the GUI can show real song
+BPM and turn "N bars from here" into song seconds.
+"""
+import bisect
+import math
+
+import numpy as np
+
+import library
+import midireader
+
+# Bars are counted in 4/4: time signatures aren't decoded
+BEATS_PER_BAR = 4
+
+# path -> (content hash, TempoMap)
+_maps = {}
+
+
+class TempoMap:
+    """A song's own tempo changes, in song seconds"""
+
+    def __init__(self, path):
+        song = midireader.MidiArrays(path, kinds=())
+        self._song = song
+        self.length = song.length
+        self.starts = song.tempo_starts
+        if song.division > 0:
+            self.ticks_per_beat = song.division
+            self.bpms = 60 / (song.tempo_per_tick * song.division)
+        else:
+            # SMPTE timing has no beats: count half-second beats
+            self.ticks_per_beat = 0.5 / song.tempo_per_tick[0]
+            self.bpms = np.full(len(self.starts), 120.0)
+
+    def bpm_at(self, seconds):
+        """The file's BPM at a song time"""
+        return float(self.bpms[max(0, np.searchsorted(self.starts, seconds, side='right') - 1)])
+
+    def main_bpm(self):
+        """The BPM the song spends the most time at"""
+        ends = np.append(self.starts[1:], max(self.length, self.starts[-1]))
+        spans = {}
+        for bpm, span in zip(self.bpms.tolist(), (ends - self.starts).tolist()):
+            spans[bpm] = spans.get(bpm, 0.0) + span
+        best = max(spans, key=lambda bpm: (spans[bpm], bpm == self.bpms[0]))
+        # Whole microseconds per beat put "195" at 195.0002
+        return round(best, 2)
+
+    def bars(self, seconds, count):
+        """Song seconds taken by `count` bars starting at `seconds`"""
+        segment = max(0, np.searchsorted(self.starts, seconds, side='right') - 1)
+        tick = self._song.tempo_ticks[segment] + (seconds - self.starts[segment]) / self._song.tempo_per_tick[segment]
+        end = tick + count * BEATS_PER_BAR * self.ticks_per_beat
+        return float(self._song.seconds(np.array([end]))[0]) - seconds
+
+
+def tempo_map(path):
+    """TempoMap of a file, cached until its contents change"""
+    digest = library.content_hash(path)
+    cached = _maps.get(path)
+    if cached and cached[0] == digest:
+        return cached[1]
+    _maps[path] = (digest, TempoMap(path))
+    return _maps[path][1]
+
+
+class TimeWarp:
+    """Wall seconds after `origin` for each song time, under a rate in player BPM
+
+    Segment i starts at song time starts[i] at BPM bpms[i] and moves
+    linearly to ends_bpm[i] by the next segment's start; the last segment
+    is constant. walls[i] is the wall time from the origin to starts[i].
+    """
+
+    def __init__(self, origin, bpm):
+        self._reset(origin, bpm)
+
+    def _reset(self, origin, bpm):
+        self.starts = [origin]
+        self.bpms = [bpm]
+        self.end_bpms = [bpm]
+        self.walls = [0.0]
+        self._cursor = 0
+
+    @property
+    def origin(self):
+        return self.starts[0]
+
+    @property
+    def bpm(self):
+        """The BPM once every ramp is done"""
+        return self.end_bpms[-1]
+
+    def _segment(self, values, value):
+        """Segment containing `value` in `values` (starts or walls)"""
+        cursor = self._cursor
+        last = len(values) - 1
+        if values[cursor] <= value and (cursor == last or value < values[cursor + 1]):
+            return cursor
+        cursor = max(0, bisect.bisect_right(values, value) - 1)
+        self._cursor = cursor
+        return cursor
+
+    def _span_wall(self, index, span):
+        """Wall seconds for `span` song seconds into segment `index`"""
+        bpm = self.bpms[index]
+        if self.end_bpms[index] == bpm:
+            return span * 120 / bpm
+        slope = (self.end_bpms[index] - bpm) / (self.starts[index + 1] - self.starts[index])
+        return 120 / slope * math.log1p(slope * span / bpm)
+
+    def _wall_span(self, index, wall):
+        """Song seconds covered in `wall` seconds into segment `index`"""
+        bpm = self.bpms[index]
+        if self.end_bpms[index] == bpm:
+            return wall * bpm / 120
+        slope = (self.end_bpms[index] - bpm) / (self.starts[index + 1] - self.starts[index])
+        return bpm * math.expm1(slope * wall / 120) / slope
+
+    def wall(self, song):
+        """Wall seconds from the origin until `song` sounds"""
+        index = self._segment(self.starts, song)
+        return self.walls[index] + self._span_wall(index, song - self.starts[index])
+
+    def song(self, wall):
+        """Song time reached `wall` seconds after the origin"""
+        index = self._segment(self.walls, wall)
+        return self.starts[index] + self._wall_span(index, wall - self.walls[index])
+
+    def bpm_at(self, song):
+        index = self._segment(self.starts, song)
+        if index == len(self.starts) - 1:
+            return self.end_bpms[index]
+        fraction = (song - self.starts[index]) / (self.starts[index + 1] - self.starts[index])
+        return self.bpms[index] + (self.end_bpms[index] - self.bpms[index]) * max(0.0, fraction)
+
+    def rebase(self, origin):
+        """Start the warp at `origin` instead, keeping ramps still ahead of it
+
+        Going back before the current origin drops the ramps and keeps the
+        final BPM.
+        """
+        if origin < self.starts[0]:
+            self._reset(origin, self.bpm)
+            return
+        index = self._segment(self.starts, origin)
+        bpm = self.bpm_at(origin)
+        self.starts = [origin] + self.starts[index + 1:]
+        self.bpms = [bpm] + self.bpms[index + 1:]
+        self.end_bpms = self.end_bpms[index:]
+        self._cursor = 0
+        self._update_walls()
+
+    def ramp(self, at, bpm, over=0.0):
+        """From song time `at` on, move to `bpm` linearly over `over` song seconds"""
+        index = self._segment(self.starts, at)
+        current = self.bpm_at(at)
+        keep = index + 1 if at > self.starts[index] else index
+        self.starts, self.bpms, self.end_bpms = self.starts[:keep], self.bpms[:keep], self.end_bpms[:keep]
+        if keep:
+            self.end_bpms[-1] = current
+        if over > 0:
+            self.starts.append(at)
+            self.bpms.append(current)
+            self.end_bpms.append(bpm)
+        self.starts.append(at + over if over > 0 else at)
+        self.bpms.append(bpm)
+        self.end_bpms.append(bpm)
+        self._cursor = 0
+        self._update_walls()
+
+    def _update_walls(self):
+        self.walls = [0.0]
+        for index in range(len(self.starts) - 1):
+            self.walls.append(self.walls[-1] + self._span_wall(index, self.starts[index + 1] - self.starts[index]))
@@ -0,0 +1,106 @@
+"""
+Render songs to key-event traces on a virtual clock
+
+Each song is played through MidiPlayer with a clocks.VirtualClock and a
+RecordingSink, so nothing is typed and no time is slept: a whole library
+renders in seconds. A trace is plain text, one line per key event:
+
+    <song seconds> <part> <+press|-release><key label>
+
+and the same song and settings always give the same bytes, so traces can be
+kept as golden files and compared after changes to the player.
+
+    python tracecheck.py lemon.mid                 # print a trace
+    python tracecheck.py --all --write golden      # save golden traces
+    python tracecheck.py --all --check golden      # compare against them
+"""
+import argparse
+import os
+import sys
+import time
+
+import Player as GZP
+import clocks
+import keymaps
+import sinks
+
+
+def render_trace(file_name, bpm=120, key_add=None, profile=None, **options):
+    """Key-event trace of a song as a list of text lines"""
+    profile = keymaps.get_profile(profile)
+    if key_add is None:
+        key_add = GZP.findBestKey(file_name, profile)
+
+    track_parts = options.get('track_parts')
+    part_count = max(track_parts.values()) + 1 if track_parts else 1
+
+    clock = clocks.VirtualClock()
+    recorders = [sinks.RecordingSink(clock=clock.now) for _ in range(part_count)]
+    player = GZP.MidiPlayer(file_name, bpm, key_add, profile=profile, sinks=recorders,
+                            clock=clock, **options)
+    player.play()
+
+    batches = sorted((at, part, actions) for part, recorder in enumerate(recorders)
+                     for at, actions in recorder.batches)
+    lines = [f"# {file_name} bpm={bpm} key={key_add:+d} layout={profile.name}"]
+    for at, part, actions in batches:
+        for chord, is_press in actions:
+            lines.append(f"{at:.6f} {part} {'+' if is_press else '-'}{profile.label(chord)}")
+    return lines
+
+
+def trace_path(folder, file_name):
+    return os.path.join(folder, file_name + ".trace")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render songs to deterministic key-event traces")
+    parser.add_argument("songs", nargs="*", help="file names in midi_repo")
+    parser.add_argument("--all", action="store_true", help="every song in midi_repo")
+    parser.add_argument("--bpm", type=int, default=120)
+    parser.add_argument("--key", type=int, default=None, help="transposition (default: best key)")
+    parser.add_argument("--layout", default=None, help="keyboard layout name")
+    parser.add_argument("--write", metavar="DIR", help="save traces as golden files")
+    parser.add_argument("--check", metavar="DIR", help="compare against golden files")
+    args = parser.parse_args(argv)
+
+    songs = GZP.midScanner() if args.all else args.songs
+    if args.write:
+        os.makedirs(args.write, exist_ok=True)
+
+    failures = 0
+    started = time.perf_counter()
+    for song in songs:
+        try:
+            text = "\n".join(render_trace(song, args.bpm, args.key, args.layout)) + "\n"
+        except Exception as e:
+            print(f"❌ {song}: {e}")
+            failures += 1
+            continue
+
+        if args.write:
+            with open(trace_path(args.write, song), 'w', encoding='utf-8', newline='\n') as f:
+                f.write(text)
+        elif args.check:
+            try:
+                with open(trace_path(args.check, song), 'r', encoding='utf-8', newline='\n') as f:
+                    golden = f.read()
+            except OSError:
+                print(f"❌ {song}: no golden trace")
+                failures += 1
+                continue
+            if golden != text:
+                got, want = text.splitlines(), golden.splitlines()
+                line = next((i for i, (a, b) in enumerate(zip(got, want)) if a != b), min(len(got), len(want)))
+                print(f"❌ {song}: differs at line {line + 1}")
+                failures += 1
+        else:
+            sys.stdout.write(text)
+
+    if args.write or args.check:
+        print(f"{len(songs)} songs, {failures} failed, {time.perf_counter() - started:.2f}s")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,14 +1,24 @@
 
-from PyQt5.QtWidgets import QWidget
+import bisect
+import time
+
+from PyQt5.QtWidgets import (QWidget, QDialog, QVBoxLayout, QHBoxLayout, QLabel,
+                             QComboBox, QDialogButtonBox, QScrollArea, QAbstractScrollArea)
 from PyQt5.QtCore import Qt, QTimer
-from PyQt5.QtGui import QPainter, QColor, QFont
+from PyQt5.QtGui import QPainter, QColor, QFont, QFontMetrics
+
+import diagnostics
+
+# How long a played key stays lit, in seconds
+NOTE_HOLD = 0.5
 
 
 class NoteVisualization(QWidget):
     
     def __init__(self, parent=None):
         super().__init__(parent)
-        self.active_notes = set()
+        # Lit keys and when they go dark (time.monotonic())
+        self.active_notes = {}
         
 
         self.note_rows = [
@@ -20,25 +30,34 @@ class NoteVisualization(QWidget):
         self.setMinimumHeight(180)
         self.setMaximumHeight(220)
         
-        # Timer to fade out notes
+        # One-shot timer, armed only while some key is lit
         self.fade_timer = QTimer()
+        self.fade_timer.setSingleShot(True)
         self.fade_timer.timeout.connect(self.fade_notes)
-        self.fade_timer.start(100)
     
     def add_note(self, key):
-        self.active_notes.add(key.upper())
+        self.active_notes[key.upper()] = time.monotonic() + NOTE_HOLD
         self.update()
         
-        # Auto-remove after 500ms
-        QTimer.singleShot(500, lambda: self.remove_note(key))
+        if not self.fade_timer.isActive():
+            self.fade_timer.start(int(NOTE_HOLD * 1000))
     
     def remove_note(self, key):
-        self.active_notes.discard(key.upper())
+        self.active_notes.pop(key.upper(), None)
         self.update()
     
     def fade_notes(self):
+        """Turn off expired keys and sleep until the next one expires"""
+        diagnostics.wakeup("visualization")
+        now = time.monotonic()
+        for key, expires in list(self.active_notes.items()):
+            if expires <= now:
+                del self.active_notes[key]
+        self.update()
+        
         if self.active_notes:
-            self.update()
+            next_expiry = min(self.active_notes.values())
+            self.fade_timer.start(max(1, int((next_expiry - now) * 1000) + 1))
     
     def paintEvent(self, event):
         painter = QPainter(self)
@@ -119,4 +138,134 @@ class NoteVisualization(QWidget):
                 
                 painter.setPen(text_color)
                 painter.drawText(int(x), int(start_y), int(key_size), int(key_size * 0.8), 
-                               Qt.AlignCenter, f"[{key}]")
\ No newline at end of file
+                               Qt.AlignCenter, f"[{key}]")
+
+
+class EnsembleDialog(QDialog):
+    """Assign the tracks of a song to game windows for ensemble play"""
+    
+    def __init__(self, track_counts, part_count, assignment=None, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Ensemble")
+        self.setMinimumWidth(360)
+        assignment = assignment or {}
+        
+        layout = QVBoxLayout(self)
+        layout.addWidget(QLabel(f"{part_count} game window(s) found. Choose a part for each track:"))
+        
+        rows = QWidget()
+        rows_layout = QVBoxLayout(rows)
+        self.track_combos = {}
+        for track, count in enumerate(track_counts):
+            if not count:
+                continue
+            
+            row = QHBoxLayout()
+            row.addWidget(QLabel(f"Track {track + 1} ({count} notes)"))
+            combo = QComboBox()
+            combo.addItem("Muted")
+            combo.addItems([f"Part {part + 1}" for part in range(part_count)])
+            combo.setCurrentIndex(assignment.get(track, 0) + 1)
+            row.addWidget(combo)
+            rows_layout.addLayout(row)
+            self.track_combos[track] = combo
+        
+        scroll = QScrollArea()
+        scroll.setWidgetResizable(True)
+        scroll.setWidget(rows)
+        layout.addWidget(scroll)
+        
+        buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        layout.addWidget(buttons)
+    
+    def assignment(self):
+        """Track index -> part index, leaving muted tracks out"""
+        return {track: combo.currentIndex() - 1
+                for track, combo in self.track_combos.items() if combo.currentIndex() > 0}
+
+
+
+class SheetView(QAbstractScrollArea):
+    """Sheet preview that only lays out the rows on screen
+
+    Bars are kept as plain strings with their start times in a sorted list,
+    so a song of any length opens instantly, and set_position() finds the
+    current bar by bisection to highlight and scroll to it during playback.
+    """
+    
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.starts = []
+        self.texts = []
+        self.current = -1
+        self.max_chars = 0
+        
+        self.setFont(QFont("Consolas", 10))
+        self.row_height = QFontMetrics(self.font()).height() + 4
+        self.char_width = QFontMetrics(self.font()).averageCharWidth()
+        self.verticalScrollBar().setSingleStep(self.row_height)
+    
+    def set_bars(self, bars):
+        """Show a list of (start_time, text) bars, sorted by start time"""
+        self.starts = [start for start, text in bars]
+        self.texts = [text for start, text in bars]
+        self.max_chars = max((len(text) for text in self.texts), default=0)
+        self.current = -1
+        self.verticalScrollBar().setValue(0)
+        self.horizontalScrollBar().setValue(0)
+        self.update_scrollbars()
+        self.viewport().update()
+    
+    def text(self):
+        return "\n".join(self.texts)
+    
+    def update_scrollbars(self):
+        viewport = self.viewport()
+        self.verticalScrollBar().setRange(0, max(0, len(self.texts) * self.row_height - viewport.height()))
+        self.verticalScrollBar().setPageStep(viewport.height())
+        self.horizontalScrollBar().setRange(0, max(0, (self.max_chars + 2) * self.char_width - viewport.width()))
+        self.horizontalScrollBar().setPageStep(viewport.width())
+    
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.update_scrollbars()
+    
+    def set_position(self, seconds):
+        """Highlight the bar playing at `seconds` and keep it in view"""
+        index = bisect.bisect_right(self.starts, seconds) - 1
+        if index == self.current:
+            return
+        self.current = index
+        
+        if index >= 0:
+            top = index * self.row_height
+            bar = self.verticalScrollBar()
+            if top < bar.value() or top + self.row_height > bar.value() + self.viewport().height():
+                bar.setValue(top - self.viewport().height() // 3)
+        self.viewport().update()
+    
+    def paintEvent(self, event):
+        painter = QPainter(self.viewport())
+        painter.setFont(self.font())
+        
+        dark_mode = getattr(self.window(), 'dark_mode', False)
+        painter.fillRect(self.viewport().rect(), QColor("#1e1e1e") if dark_mode else QColor("#ffffff"))
+        text_color = QColor("#d4d4d4") if dark_mode else QColor("#000000")
+        highlight = QColor(0, 122, 204, 110) if dark_mode else QColor(0, 120, 212, 70)
+        
+        offset_y = self.verticalScrollBar().value()
+        offset_x = self.horizontalScrollBar().value()
+        width = self.viewport().width()
+        
+        first = offset_y // self.row_height
+        last = min(len(self.texts), (offset_y + self.viewport().height()) // self.row_height + 1)
+        
+        for index in range(first, last):
+            y = index * self.row_height - offset_y
+            if index == self.current:
+                painter.fillRect(0, y, width, self.row_height, highlight)
+            painter.setPen(text_color)
+            painter.drawText(4 - offset_x, y, width + offset_x, self.row_height,
+                             Qt.AlignVCenter | Qt.TextSingleLine, self.texts[index])